@@ -0,0 +1,250 @@
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+# no display needed for the widget benchmarks
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from clock import Clock, AudioSchedule
+from benchmarks.fake_synth import FakeSynthWrapper
+from benchmarks.sessions import make_session, make_track_state
+
+ticks_per_second = 1024
+baselines_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+
+def best_time(func, repeats):
+    '''runs func repeats times, returns the fastest run in seconds'''
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def peak_memory(func):
+    '''runs func once, returns the peak of memory allocated during it in kB'''
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024
+
+
+def make_schedule(state, n_layers=1):
+    '''AudioSchedule from a state dict, the events are dealt out to n_layers
+       layers like overdubbed takes'''
+    schedule = AudioSchedule(state["bpm"], state["bpl"], [])
+    schedule.set_events(state["schedule_beats_beats"], state["schedule_beats_pitches"],
+                        state["schedule_beats_onoff"])
+    if n_layers > 1:
+        events = schedule.events
+        schedule.set_layers([events[i::n_layers] for i in range(n_layers)])
+    return schedule
+
+
+def bench_clock_on_update(n_tracks=32, n_events=2000, seconds=10, step=0.001, n_layers=1):
+    '''Clock.on_update with n_tracks tracks playing, driven by virtual time in
+       steps of step seconds. The events of each track are in n_layers layers'''
+    session = make_session(n_tracks, n_events)
+    n_updates = int(seconds / step)
+    result = {}
+
+    def run():
+        synths = [FakeSynthWrapper() for _ in range(n_tracks)]
+        clock = Clock(n_tracks, synths, ticks_per_second, metro_synth=FakeSynthWrapper())
+        now = [0.0]
+        clock.time_func = lambda: now[0]
+        for i in range(n_tracks):
+            clock.post_schedule(i, make_schedule(session[i], n_layers))
+            clock.enable_track(i, False)
+        for _ in range(n_updates):
+            now[0] += step
+            clock.on_update()
+        result["commands"] = sum(len(synth.commands) for synth in synths)
+
+    elapsed = best_time(run, 3)
+    return {"per_update_us": elapsed / n_updates * 1e6,
+            "events_per_s": result["commands"] / elapsed,
+            "peak_kb": peak_memory(run)}
+
+
+def bench_set_bpm(n_tracks=32, n_events=5000):
+    '''LoopingTrack.set_bpm on a track which all the other playing tracks are
+       synced to'''
+    from track import LoopingTrack, LooperState
+    session = make_session(n_tracks, n_events)
+    clock = Clock(n_tracks, [], ticks_per_second, metro_synth=FakeSynthWrapper())
+    loopers = [LoopingTrack(i, FakeSynthWrapper(), clock) for i in range(n_tracks)]
+    for i in range(n_tracks):
+        loopers[i].load_from_state(session[i])
+        loopers[i].change_state(LooperState.PLAY)
+        if i > 0:
+            loopers[i].sync_to(loopers[0])
+    bpms = iter(range(10 ** 9))
+    run = lambda: loopers[0].set_bpm(60 + next(bpms) % 120)
+    elapsed = best_time(run, 50)
+    return {"per_call_us": elapsed * 1e6,
+            "peak_kb": peak_memory(run)}
+
+
+def bench_load_from_state(n_tracks=32, n_events=5000):
+    '''LoopingTrack.load_from_state for a whole session'''
+    from track import LoopingTrack
+    session = make_session(n_tracks, n_events)
+    clock = Clock(n_tracks, [], ticks_per_second, metro_synth=FakeSynthWrapper())
+    loopers = [LoopingTrack(i, FakeSynthWrapper(), clock) for i in range(n_tracks)]
+
+    def run():
+        for i in range(n_tracks):
+            loopers[i].load_from_state(session[i])
+
+    elapsed = best_time(run, 10)
+    return {"per_track_us": elapsed / n_tracks * 1e6,
+            "events_per_s": n_tracks * n_events / elapsed,
+            "peak_kb": peak_memory(run)}
+
+
+def bench_plot_schedule(n_events=5000):
+    '''NoteVisualizer.plot_schedule on an offscreen widget'''
+    from PyQt5.QtWidgets import QApplication
+    from PyQt5.QtGui import QColor
+    from track import LoopingTrack
+    from looper import NoteVisualizer
+    app = QApplication.instance() or QApplication([])
+    clock = Clock(1, [], ticks_per_second, metro_synth=FakeSynthWrapper())
+    looper = LoopingTrack(0, FakeSynthWrapper(), clock)
+    looper.load_from_state(make_track_state(n_events))
+    visualizer = NoteVisualizer(looper, QColor("red"))
+    visualizer.resize(800, 100)
+    run = lambda: visualizer.plot_schedule()
+    elapsed = best_time(run, 20)
+    return {"per_call_us": elapsed * 1e6,
+            "events_per_s": n_events / elapsed,
+            "peak_kb": peak_memory(run)}
+
+
+def bench_plot_schedule_dense(n_events=100000, bpl=64):
+    '''NoteVisualizer.plot_schedule and drawing its note layer for a long
+       loop with far more notes than pixel columns'''
+    from PyQt5.QtWidgets import QApplication
+    from PyQt5.QtGui import QColor
+    from track import LoopingTrack
+    from looper import NoteVisualizer
+    app = QApplication.instance() or QApplication([])
+    clock = Clock(1, [], ticks_per_second, metro_synth=FakeSynthWrapper())
+    looper = LoopingTrack(0, FakeSynthWrapper(), clock)
+    looper.load_from_state(make_track_state(n_events, bpl=bpl))
+    visualizer = NoteVisualizer(looper, QColor("red"))
+    visualizer.resize(800, 100)
+
+    def run():
+        visualizer.plot_schedule()
+        visualizer.render_note_layer()
+    elapsed = best_time(run, 10)
+    return {"per_call_us": elapsed * 1e6,
+            "events_per_s": n_events / elapsed,
+            "peak_kb": peak_memory(run)}
+
+
+def bench_shared_ring(n_messages=10000):
+    '''SharedRing.put and get of the note commands the GUI sends to the
+       engine process, pickled like EngineProcess.send'''
+    import pickle
+    from shared_ring import SharedRing
+    ring = SharedRing(capacity=2 ** 16)
+    commands = [("synth", i % 32, "do_command", (i % 24, i % 2)) for i in range(n_messages)]
+
+    def run():
+        for command in commands:
+            ring.put(pickle.dumps(command, pickle.HIGHEST_PROTOCOL))
+            pickle.loads(ring.get())
+    elapsed = best_time(run, 5)
+    result = {"per_message_us": elapsed / n_messages * 1e6,
+              "peak_kb": peak_memory(run)}
+    ring.close()
+    return result
+
+
+def bench_clock_on_update_layers():
+    '''Clock.on_update with the events of each track in 4 overdubbed layers'''
+    return bench_clock_on_update(n_layers=4)
+
+
+def bench_set_transform(n_events=50000, n_layers=4):
+    '''Changing the quantize strength of a long loop in n_layers layers and
+       getting the layers as they are played'''
+    from transforms import Transform
+    schedule = make_schedule(make_track_state(n_events), n_layers)
+    strengths = iter(range(10 ** 9))
+
+    def run():
+        schedule.set_transform(Transform(quantize=True, grid=1 / 4, swing=0.6,
+                                         strength=next(strengths) % 100 / 100 + 0.01))
+        return schedule.layers
+    elapsed = best_time(run, 10)
+    return {"per_change_us": elapsed * 1e6,
+            "events_per_s": n_events / elapsed,
+            "peak_kb": peak_memory(run)}
+
+
+benchmarks = {"clock_on_update": bench_clock_on_update,
+              "clock_on_update_layers": bench_clock_on_update_layers,
+              "set_bpm": bench_set_bpm,
+              "load_from_state": bench_load_from_state,
+              "plot_schedule": bench_plot_schedule,
+              "plot_schedule_dense": bench_plot_schedule_dense,
+              "shared_ring": bench_shared_ring,
+              "set_transform": bench_set_transform}
+
+
+def is_compared(metric):
+    '''whether metric is checked against the baseline (lower is better)'''
+    return metric.endswith("_us") or metric.endswith("_kb")
+
+
+def check_regressions(results, baselines, tolerance):
+    '''returns list of messages for results worse than baseline * tolerance'''
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            baseline = baselines.get(name, {}).get(metric)
+            if baseline is not None and is_compared(metric) and value > baseline * tolerance:
+                regressions.append("%s.%s: %.1f, baseline %.1f" % (name, metric, value, baseline))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the looper hot paths")
+    parser.add_argument("--only", nargs="*", choices=list(benchmarks.keys()),
+                        help="benchmarks to run, all by default")
+    parser.add_argument("--save-baselines", action="store_true",
+                        help="store the results as the new baselines")
+    parser.add_argument("--tolerance", type=float, default=2.0,
+                        help="how many times the baseline a result may be")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.only or benchmarks.keys():
+        results[name] = benchmarks[name]()
+        print("%-20s %s" % (name, "  ".join("%s=%.1f" % item for item in results[name].items())))
+
+    if args.save_baselines:
+        with open(baselines_path, 'w') as baselines_file:
+            json.dump(results, baselines_file, indent=2, sort_keys=True)
+        print("Saved baselines to", baselines_path)
+    elif os.path.exists(baselines_path):
+        with open(baselines_path, 'r') as baselines_file:
+            regressions = check_regressions(results, json.load(baselines_file), args.tolerance)
+        if regressions:
+            print("REGRESSIONS (more than %.1fx the baseline):" % args.tolerance)
+            for message in regressions:
+                print("  " + message)
+            sys.exit(1)
+        print("No regressions")
@@ -0,0 +1,41 @@
+class FakeProgramSelector(object):
+    '''Stands in for ProgramSelector without a program file'''
+    def __init__(self, n_programs=128):
+        super(FakeProgramSelector, self).__init__()
+        self.program_strings = ["Program %d" % i for i in range(n_programs)]
+
+    def get_program_names(self):
+        return self.program_strings
+
+    def get_program_from_index(self, index):
+        return (0, index)
+
+
+class FakeSynthWrapper(object):
+    '''Has the interface of SynthWrapper but only records the commands it gets,
+       so the engine can be measured without FluidSynth or an audio device'''
+    def __init__(self):
+        super(FakeSynthWrapper, self).__init__()
+        self.volume = 60
+        self.program = 0
+        self.midi_offset = 60
+        self.program_selector = FakeProgramSelector()
+        self.commands = [] # list of (pitch, off_on)
+
+    def load(self):
+        pass
+
+    def set_volume(self, volume):
+        self.volume = volume
+
+    def set_midi_offset(self, offset):
+        self.midi_offset = offset
+
+    def set_instrument(self, program):
+        self.program = program
+
+    def turn_off_notes(self):
+        pass
+
+    def do_command(self, pitch, off_on):
+        self.commands.append((pitch, off_on))
@@ -0,0 +1,30 @@
+import numpy as np
+
+
+def make_track_state(n_events, bpm=120, bpl=16, rng=None):
+    '''state dict (see LoopingTrack.get_state) of a track with n_events random
+       notes, half note ons and half note offs'''
+    if rng is None:
+        rng = np.random.default_rng(0)
+    n_notes = n_events // 2
+    starts = rng.random(n_notes) * bpl
+    ends = (starts + rng.random(n_notes) * 0.5) % bpl
+    pitches = rng.integers(-5, 29, n_notes)
+    beats = np.concatenate((starts, ends))
+    order = np.argsort(beats, kind="stable")
+    return {"bpm": bpm,
+            "bpl": bpl,
+            "schedule_beats_beats": beats[order],
+            "schedule_beats_pitches": np.concatenate((pitches, pitches))[order],
+            "schedule_beats_onoff": np.concatenate((np.ones(n_notes, bool),
+                                                    np.zeros(n_notes, bool)))[order],
+            "program": 0,
+            "midi_offset": 60,
+            "volume": 60}
+
+
+def make_session(n_tracks, n_events, seed=0):
+    '''dict of track index -> state dict for n_tracks tracks with n_events
+       events each'''
+    rng = np.random.default_rng(seed)
+    return {i: make_track_state(n_events, rng=rng) for i in range(n_tracks)}
@@ -1,9 +1,37 @@
 import time
+import math
+import bisect
+import numpy as np
+import threading
+import heapq
+from collections import deque
+from enum import Enum
 from synth_wrapper import SynthWrapper
+from transforms import Transform, layer_bounds
+
+class LatePolicy(Enum):
+    '''What the clock does with the events of a track which are more than the
+    threshold of the track late, when it wakes up late (e.g. the gui thread
+    stalled). PLAY_ALL plays them all at once, DROP_LATE drops the late note
+    ons and the note offs of the notes they would have started, NOTE_OFFS_ONLY
+    drops the late note ons and plays every note off'''
+    PLAY_ALL = 1
+    DROP_LATE = 2
+    NOTE_OFFS_ONLY = 3
+
+    @property
+    def option(self):
+        '''name of the policy on the command line and in saved sessions'''
+        return self.name.lower().replace("_", "-")
+
+    @classmethod
+    def from_option(cls, option):
+        return cls[option.upper().replace("-", "_")]
+
 
 class Clock(object):
     '''Clock object keeps track of schedules from all the tracks and plays them when needed'''
-    def __init__(self, n_tracks, synths, tps):
+    def __init__(self, n_tracks, synths, tps, engine=None, metro_synth=None):
         super(Clock, self).__init__()
         self.offset = 0
         self.n_tracks = n_tracks
@@ -11,151 +39,742 @@ class Clock(object):
         self.tps = tps
         self.tick_length = 1/tps
         self.schedules = {}
-        self.counters = {} # index of next note to be played
-        self.prev_ticks = {} # previous tick in each loop used to track when we've crossed a loop
+        self.layers = {} # layers of the schedule as it was posted, played until it is posted again
+        self.counters = {} # index of next note to be played in each layer
+        self.prev_beats = {} # previous beat in each loop used to track when we've crossed a loop
         self.enabled = False
+        self.offset_is_set = False # offset was set by set_offset, so starting the clock keeps it
         self.track_is_active = {}
         self.track_offsets = {}
         self.use_metronome = False
         self.metro_track_idx = -1
-        self.metro_synth = SynthWrapper("./data/FluidR3_GM.sf2",
-                                             "./data/fluid_synth_programs.txt")
+        self.metro_synth = metro_synth
+        if metro_synth is None:
+            self.metro_synth = SynthWrapper("./data/FluidR3_GM.sf2",
+                                             "./data/fluid_synth_programs.txt",
+                                             engine)
         self.metro_synth.set_instrument(115) # wood block
         self.metro_synth.set_volume(100)
         self.metro_bpm = 60
         self.prev_metro_beat = 0
         self.metro_noteon = False
+        self.time_func = time.perf_counter # monotonic high resolution clock
+        # schedules are changed from the gui thread and read by the scheduler thread
+        self.lock = threading.RLock()
+        # merged timeline of all tracks, heap of (due tick, looper_id, generation)
+        self.queue = []
+        self.generations = {} # entries with an older generation are ignored
+        self.frozen = set() # tracks played from a rendered buffer instead (see FreezeManager)
+        self.metrics = None # TimingMetrics which record how late events go out
+        # seconds recorded notes are moved earlier to make up for the time
+        # until the player hears the loop (audio output latency)
+        self.latency_compensation = 0.0
+        # (LatePolicy, threshold in seconds) of the tracks without their own
+        self.default_late_policy = (LatePolicy.PLAY_ALL, 0.05)
+        self.late_policies = {} # track -> (LatePolicy, threshold in seconds)
+        # track -> layer index -> {pitch: number of late note ons dropped with DROP_LATE}
+        self.dropped_notes = {}
         
 
     def get_tick(self):
         '''gets current tick number'''
-        return int((time.time() - self.offset) * self.tps)
+        return int((self.time_func() - self.offset) * self.tps)
         
     def start(self):
         '''start clock'''
         if not self.enabled:
-            self.offset = time.time()
+            if not self.offset_is_set:
+                self.offset = self.time_func()
             self.enabled = True
     
     def disable_track(self, looper_id):
         '''disable track with number looper_id'''
-        self.track_is_active[looper_id] = False
+        with self.lock:
+            self.track_is_active[looper_id] = False
+            self.rearm(looper_id)
 
     def enable_track(self, looper_id, keep_offset):
         '''enable track with number looper id, if keep_offset is False, update the offset'''
-        if not self.enabled:
-            self.start()
-        self.track_is_active[looper_id] = True
-        self.prev_ticks[looper_id] = 0
-        self.counters[looper_id] = 0
+        with self.lock:
+            if not self.enabled:
+                self.start()
+            self.track_is_active[looper_id] = True
+            self.prev_beats[looper_id] = 0
+            self.counters[looper_id] = [0] * len(self.layers.get(looper_id, ()))
+            self.dropped_notes.pop(looper_id, None)
 
-        if (not keep_offset):
-            self.reset_track_offset(looper_id)
+            if (not keep_offset):
+                self.reset_track_offset(looper_id)
+            self.rearm(looper_id)
 
     def post_schedule(self, looper_id, schedule):
-        '''called by loopers to post their new schedules'''
-        # sort schedule by command beats
-        schedule.sort()
-        self.schedules[looper_id] = schedule
-        self.schedules[looper_id].get_schedule_ticks(self.tps)
+        '''called by loopers to post their new schedules, a playing track goes
+           on from the current beat with the layers of schedule'''
+        with self.lock:
+            self.schedules[looper_id] = schedule
+            self.layers[looper_id] = schedule.layers
+            self.seek(looper_id)
+            self.rearm(looper_id)
+
+    def seek(self, looper_id):
+        '''points the counters of track looper_id at its current beat if it is
+           playing, so the notes before it are not played, otherwise at the
+           start of the loop'''
+        layers = self.layers[looper_id]
+        if self.track_is_active.get(looper_id, False) and looper_id in self.track_offsets:
+            _, looper_beat = self.get_loop_position(looper_id, self.schedules[looper_id],
+                                                    self.get_tick())
+            self.counters[looper_id] = [int(np.searchsorted(layer.beats, looper_beat, side="right"))
+                                        for layer in layers]
+            self.prev_beats[looper_id] = looper_beat
+        else:
+            self.counters[looper_id] = [0] * len(layers)
+            self.prev_beats[looper_id] = 0
+        self.dropped_notes.pop(looper_id, None)
+
+    def set_tempo(self, looper_id, schedule, bpm=None, beats_per_loop=None, changes=None):
+        '''changes the tempo map of schedule of track looper_id, the events
+           are kept in beats so only the time the track is due again changes'''
+        with self.lock:
+            if bpm is not None:
+                schedule.tempo_map.set_bpm(bpm)
+            if beats_per_loop is not None:
+                schedule.tempo_map.set_beats_per_loop(beats_per_loop)
+            if changes is not None:
+                schedule.tempo_map.set_changes(changes)
+            self.rearm(looper_id)
 
     def reset_track_offset(self, looper_id):
         '''resets the track offset of track with number looper_id'''
-        self.track_offsets[looper_id] = self.get_tick()
+        with self.lock:
+            self.track_offsets[looper_id] = self.get_tick()
+            self.rearm(looper_id)
 
     def sync_track_starts(self):
         '''resets track offsets of all tracks'''
-        new_start_tick = self.get_tick()
-        for looper_id in self.track_offsets.keys():
-            self.track_offsets[looper_id] = new_start_tick
+        with self.lock:
+            new_start_tick = self.get_tick()
+            for looper_id in self.track_offsets.keys():
+                self.track_offsets[looper_id] = new_start_tick
+                self.rearm(looper_id)
+
+    def get_current_beat(self, looper_id, tempo_map):
+        '''get the current beat of track looper id with tempo_map'''
+        return self.get_beat_at(looper_id, tempo_map, self.time_func())
+
+    def get_beat_at(self, looper_id, tempo_map, at_time):
+        '''get the beat of track looper id with tempo_map at clock time at_time'''
+        seconds = at_time - self.offset - self.track_offsets[looper_id] / self.tps
+        return tempo_map.beat_at(seconds % tempo_map.loop_seconds)
+
+    def get_loop_position(self, looper_id, schedule, tick):
+        '''returns (seconds, beat) into the loop of track looper_id at tick'''
+        seconds = ((tick - self.track_offsets[looper_id]) / self.tps) % schedule.tempo_map.loop_seconds
+        return seconds, schedule.tempo_map.beat_at(seconds)
 
-    def get_current_beat(self, looper_id, bpm, bpl):
-        '''get the current beat of track looper id'''
-        return ((self.get_tick() - self.track_offsets[looper_id]) / self.tps / 60 * bpm) % bpl
+    def set_offset(self, offset):
+        '''moves the start of the clock to clock time offset, e.g. to follow
+           the clock of another looper (see TransportFollower). The tracks
+           keep their offsets in ticks, so they move with it. A clock which
+           hasn't started yet keeps the offset when it starts'''
+        with self.lock:
+            moved = abs(offset - self.offset) >= self.tick_length
+            self.offset = offset
+            self.offset_is_set = True
+            # the queued ticks are a tick or more off
+            if moved:
+                for looper_id in list(self.track_offsets.keys()):
+                    self.rearm(looper_id)
+
+    def set_track_offset(self, looper_id, tick):
+        '''starts the loop of track looper_id at tick, a playing track goes on
+           from the beat it is at now without the notes it jumped over'''
+        with self.lock:
+            self.track_offsets[looper_id] = tick
+            if self.track_is_active.get(looper_id, False) and looper_id in self.schedules:
+                self.synths[looper_id].turn_off_notes()
+                self.seek(looper_id)
+            self.rearm(looper_id)
 
     def sync(self, track_to_sync, reference):
         '''syncs track of track_to_sync to reference track'''
-        if reference in self.track_offsets.keys():
-            self.track_offsets[track_to_sync] = self.track_offsets[reference]
+        with self.lock:
+            if reference in self.track_offsets.keys():
+                self.track_offsets[track_to_sync] = self.track_offsets[reference]
+                self.rearm(track_to_sync)
+
+    def set_late_policy(self, policy, threshold, looper_id=None):
+        '''sets the LatePolicy of track looper_id, or of all the tracks without
+           their own if looper_id is None. Events more than threshold seconds
+           late are late. A policy of None gives the track the default again'''
+        with self.lock:
+            if looper_id is None:
+                self.default_late_policy = (policy, threshold)
+            elif policy is None:
+                self.late_policies.pop(looper_id, None)
+            else:
+                self.late_policies[looper_id] = (policy, threshold)
 
     def set_metronome(self, index, bpm):
         '''Sets metronome to follow track at index, with bpm'''
-        self.metro_track_idx = index
-        self.metro_bpm = bpm
-        self.prev_metro_beat = 0
+        with self.lock:
+            self.metro_track_idx = index
+            self.metro_bpm = bpm
+            self.prev_metro_beat = 0
 
     def release_metronome(self, index):
         '''release metronome at track index'''
-        if index == self.metro_track_idx:
-            self.metro_track_idx = -1
+        with self.lock:
+            if index == self.metro_track_idx:
+                self.metro_track_idx = -1
 
-    def on_update(self):
-        if self.enabled:
-            tick = self.get_tick()
-            # look at all current schedules
-            for looper_id in self.schedules.keys():
-                if looper_id in self.track_is_active.keys() and self.track_is_active[looper_id]:
-                    # tick of loop
-                    looper_tick = (tick - self.track_offsets[looper_id]) % \
-                        self.schedules[looper_id].ticks_per_loop
-                    # if we've looped around, do any remaining noteoffs in the schedule
-                    if looper_tick < self.prev_ticks[looper_id]:
-                        for i in range(self.counters[looper_id], len(self.schedules[looper_id].schedule_ticks)):
-                            # only do noteoffs
-                            if not self.schedules[looper_id].schedule_ticks[i][2]:
-                                self.synths[looper_id].do_command(self.schedules[looper_id].schedule_ticks[i][1], self.schedules[looper_id].schedule_ticks[i][2])
-                        self.counters[looper_id] = 0
-                    # loop through all notes until the note tick is greater than current tick, only play noteons if we do not get the noteoff
-                    note_ons = []
-                    while( self.counters[looper_id] < len(self.schedules[looper_id].schedule_ticks) and self.schedules[looper_id].schedule_ticks[self.counters[looper_id]][0] <= looper_tick):
-                        current_note = self.schedules[looper_id].schedule_ticks[self.counters[looper_id]]
-                        # keep track of all noteons to be played
-                        if current_note[2]:
-                            note_ons.append(self.schedules[looper_id].schedule_ticks[self.counters[looper_id]][1])
-                        else:
-                            self.synths[looper_id].do_command(current_note[1], current_note[2])
-                            if current_note[1] in note_ons:
-                                note_ons.remove(current_note[1])
-                        self.counters[looper_id] += 1
-                    
-                    # do all note ons
-                    for note in note_ons:
-                        self.synths[looper_id].do_command(note, 1)
-                    # update previous tick
-                    self.prev_ticks[looper_id] = looper_tick 
-            # play metronome
+    def freeze_track(self, looper_id):
+        '''stop playing the schedule of track looper_id, it is played from a
+           rendered buffer instead'''
+        with self.lock:
+            self.frozen.add(looper_id)
+            self.synths[looper_id].turn_off_notes()
+            self.rearm(looper_id)
+
+    def thaw_track(self, looper_id):
+        '''play the schedule of frozen track looper_id again, from the current
+           position without the notes that went by while it was frozen'''
+        with self.lock:
+            if looper_id not in self.frozen:
+                return
+            self.frozen.discard(looper_id)
+            if looper_id in self.schedules:
+                self.seek(looper_id)
+            self.rearm(looper_id)
+
+    def rearm(self, looper_id):
+        '''drops the queued entry of track looper_id and, if the track is
+           playing, queues it to be updated right away'''
+        self.generations[looper_id] = self.generations.get(looper_id, 0) + 1
+        if self.track_is_active.get(looper_id, False) and looper_id in self.schedules \
+                and looper_id in self.track_offsets and looper_id not in self.frozen:
+            heapq.heappush(self.queue, (self.get_tick(), looper_id, self.generations[looper_id]))
+
+    def next_queued_tick(self):
+        '''tick at which the next track is due, None if no track is queued.
+           Drops entries which were invalidated by rearm'''
+        while self.queue:
+            due_tick, looper_id, generation = self.queue[0]
+            if generation == self.generations[looper_id]:
+                return due_tick
+            heapq.heappop(self.queue)
+        return None
+
+    def seconds_until_next_event(self):
+        '''time in seconds until the next event of any active track (or the
+           metronome) is due, None if there is nothing to play'''
+        with self.lock:
+            if not self.enabled:
+                return None
+            now = self.time_func()
+            next_tick = self.next_queued_tick()
             if self.use_metronome and self.metro_track_idx >= 0:
-                metro_tick = (tick - self.track_offsets[self.metro_track_idx])
-                metro_beat = (metro_tick / self.tps / 60 * self.metro_bpm)
-                if metro_beat - self.prev_metro_beat >= 1:
-                    self.metro_synth.do_command(60, 1)
-                    self.prev_metro_beat = int(metro_beat)
-                    self.metro_noteon = True
-                # turn off metronome note 0.2 beats later
-                if metro_beat - self.prev_metro_beat >= 0.2 and self.metro_noteon:
-                    self.metro_synth.do_command(60, 0)
-                    self.metro_noteon = False
+                # next metronome note on, or note off if the note is still on
+                metro_beat = self.prev_metro_beat + (0.2 if self.metro_noteon else 1)
+                due_tick = self.track_offsets[self.metro_track_idx] + \
+                    math.ceil(metro_beat * 60 / self.metro_bpm * self.tps)
+                if next_tick is None or due_tick < next_tick:
+                    next_tick = due_tick
+            if next_tick is None:
+                return None
+            return max(0.0, self.offset + next_tick / self.tps - now)
+
+    def on_update(self):
+        with self.lock:
+            if self.enabled:
+                tick = self.get_tick()
+                # only update the tracks which have something due
+                while self.queue and self.queue[0][0] <= tick:
+                    _, looper_id, generation = heapq.heappop(self.queue)
+                    if generation == self.generations[looper_id]:
+                        self.play_track(looper_id, tick)
+                # play metronome
+                if self.use_metronome and self.metro_track_idx >= 0:
+                    metro_tick = (tick - self.track_offsets[self.metro_track_idx])
+                    metro_beat = (metro_tick / self.tps / 60 * self.metro_bpm)
+                    if metro_beat - self.prev_metro_beat >= 1:
+                        self.metro_synth.do_command(60, 1)
+                        self.prev_metro_beat = int(metro_beat)
+                        self.metro_noteon = True
+                    # turn off metronome note 0.2 beats later
+                    if metro_beat - self.prev_metro_beat >= 0.2 and self.metro_noteon:
+                        self.metro_synth.do_command(60, 0)
+                        self.metro_noteon = False
+
+    def record_lateness(self, looper_id, loop_start, tempo_map, event_beats):
+        '''records how late events at event_beats of the loop starting
+           loop_start seconds after the clock started went out'''
+        now = self.time_func()
+        scheduled = self.offset + loop_start + tempo_map.seconds_at_beats(event_beats)
+        self.metrics.record_dispatches(looper_id, (now - scheduled).tolist())
+
+    def play_track(self, looper_id, tick):
+        '''plays the due notes of track looper_id and queues the track again
+           for its next note, or the end of the loop. The position in the loop
+           is turned into a beat with the tempo map of the schedule, so the
+           events never have to be converted when the tempo changes. Each
+           layer has its own counter, only the notes due now are merged'''
+        schedule = self.schedules[looper_id]
+        tempo_map = schedule.tempo_map
+        layers = self.layers[looper_id]
+        counters = self.counters[looper_id]
+        synth = self.synths[looper_id]
+        late_policy = self.late_policies.get(looper_id, self.default_late_policy)
+        play_all = late_policy[0] is LatePolicy.PLAY_ALL
+        # seconds and beat into the loop
+        looper_seconds, looper_beat = self.get_loop_position(looper_id, schedule, tick)
+        loop_start = tick / self.tps - looper_seconds
+        # if we've looped around, do any remaining noteoffs in the schedule
+        if looper_beat < self.prev_beats[looper_id]:
+            for i, layer in enumerate(layers):
+                remaining = layer.events[counters[i]:]
+                note_offs = remaining[~remaining["on"]]
+                if not play_all:
+                    note_offs = self.drop_late(looper_id, i, late_policy, note_offs,
+                                               np.zeros(len(note_offs), dtype=bool))
+                    # the notes of the next loop start over
+                    self.dropped_notes.get(looper_id, {}).pop(i, None)
+                for pitch in note_offs["pitch"].tolist():
+                    synth.do_command(pitch, 0)
+                if self.metrics is not None:
+                    # these were due in the previous loop
+                    self.record_lateness(looper_id, loop_start - tempo_map.loop_seconds, tempo_map,
+                                         note_offs["beat"])
+                counters[i] = 0
+        # all notes up to the current beat are due
+        due = []
+        next_beat = None
+        for i, layer in enumerate(layers):
+            beats = layer.beats
+            start = counters[i]
+            # layers with nothing due are skipped without a search
+            if start < len(beats) and beats[start] <= looper_beat:
+                counters[i] = int(np.searchsorted(beats, looper_beat, side="right"))
+                layer_due = layer.events[start:counters[i]]
+                # a layer's note offs only end the notes of the same layer
+                if not play_all:
+                    ages = looper_seconds - tempo_map.seconds_at_beats(layer_due["beat"])
+                    layer_due = self.drop_late(looper_id, i, late_policy, layer_due,
+                                               ages > late_policy[1])
+                due.append(layer_due)
+            if counters[i] < len(beats):
+                beat = beats[counters[i]]
+                if next_beat is None or beat < next_beat:
+                    next_beat = beat
+        if due:
+            due = due[0] if len(due) == 1 else merge_events(due)
+            # only play noteons if we do not get the noteoff, count of noteons per pitch
+            note_ons = {}
+            for pitch, on in zip(due["pitch"].tolist(), due["on"].tolist()):
+                if on:
+                    note_ons[pitch] = note_ons.get(pitch, 0) + 1
+                else:
+                    synth.do_command(pitch, 0)
+                    if note_ons.get(pitch, 0):
+                        note_ons[pitch] -= 1
+            # do all note ons
+            for pitch, count in note_ons.items():
+                for _ in range(count):
+                    synth.do_command(pitch, 1)
+            if self.metrics is not None:
+                self.record_lateness(looper_id, loop_start, tempo_map, due["beat"])
+        # update previous beat
+        self.prev_beats[looper_id] = looper_beat
+
+        # queue the track for its next note, or the end of the loop
+        if next_beat is not None:
+            event_seconds = tempo_map.seconds_at(next_beat)
+        else:
+            event_seconds = tempo_map.loop_seconds
+        due_tick = tick + max(1, math.ceil((event_seconds - looper_seconds) * self.tps))
+        heapq.heappush(self.queue, (due_tick, looper_id, self.generations[looper_id]))
+
+
+    def drop_late(self, looper_id, layer_index, late_policy, events, late):
+        '''events of layer layer_index of track looper_id which are played
+           under late_policy, late is whether each of them is late. The
+           dropped events are counted in the metrics'''
+        policy, _ = late_policy
+        dropped_notes = self.dropped_notes.setdefault(looper_id, {}).setdefault(layer_index, {})
+        if not dropped_notes and not late.any():
+            return events
+        keep = np.ones(len(events), dtype=bool)
+        for i, (pitch, on, is_late) in enumerate(zip(events["pitch"].tolist(),
+                                                     events["on"].tolist(), late.tolist())):
+            if on and is_late:
+                keep[i] = False
+                if policy is LatePolicy.DROP_LATE:
+                    dropped_notes[pitch] = dropped_notes.get(pitch, 0) + 1
+            elif on:
+                # the next note off ends this note
+                dropped_notes.pop(pitch, None)
+            # a note off is only dropped if its note on was, notes which
+            # started in time always end
+            elif dropped_notes.get(pitch, 0):
+                keep[i] = False
+                dropped_notes[pitch] -= 1
+        if self.metrics is not None:
+            self.metrics.record_dropped(looper_id, len(events) - int(keep.sum()))
+        return events[keep]
+
+
+def merge_events(event_arrays):
+    '''the events of event_arrays in one array sorted by beat'''
+    events = np.concatenate(event_arrays)
+    return events[np.argsort(events["beat"], kind="stable")]
+
+
+class JitterStats(object):
+    '''Keeps statistics of how late the scheduler thread dispatched compared
+       to the deadline it was sleeping towards
+       history (int): number of most recent samples kept for percentiles'''
+    def __init__(self, history=4096):
+        super(JitterStats, self).__init__()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=history)
+
+    def add(self, lateness):
+        '''add a lateness sample in seconds'''
+        self.count += 1
+        self.total += lateness
+        if lateness > self.max:
+            self.max = lateness
+        self.samples.append(lateness)
+
+    def summary(self):
+        '''returns dict with count, mean, max, median and 99th percentile in ms'''
+        if self.count == 0:
+            return {"count": 0, "mean_ms": 0.0, "max_ms": 0.0, "p50_ms": 0.0, "p99_ms": 0.0}
+        ordered = sorted(self.samples)
+        return {"count": self.count,
+                "mean_ms": self.total / self.count * 1000,
+                "max_ms": self.max * 1000,
+                "p50_ms": ordered[len(ordered) // 2] * 1000,
+                "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000}
+
+
+class SchedulerThread(threading.Thread):
+    '''Real time scheduler which runs Clock.on_update on its own thread instead
+       of the Qt event loop. It sleeps until the next due event of all tracks
+       and busy waits the last part so events go out on time.
+       clock (Clock): clock to drive
+       granularity (float): longest time in seconds to sleep before checking
+                    the schedules again (picks up changes made by the gui)
+       spin (float): time in seconds before a deadline to stop sleeping and
+                    busy wait instead'''
+    def __init__(self, clock, granularity=0.005, spin=0.0005):
+        super(SchedulerThread, self).__init__(daemon=True)
+        self.clock = clock
+        self.granularity = granularity
+        self.spin = spin
+        self.running = False
+        self.stats = JitterStats()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            wait = self.clock.seconds_until_next_event()
+            # nothing due soon, check again after granularity
+            if wait is None or wait > self.granularity:
+                time.sleep(self.granularity)
+                continue
+            deadline = self.clock.time_func() + wait
+            if wait > self.spin:
+                time.sleep(wait - self.spin)
+            while self.clock.time_func() < deadline:
+                time.sleep(0) # let other threads have the GIL while spinning
+            self.stats.add(self.clock.time_func() - deadline)
+            self.clock.on_update()
+
+    def stop(self):
+        '''stop the thread and wait for it to finish'''
+        self.running = False
+        self.join()
 
     
+class TempoMap(object):
+    '''Tempo of a loop, bpm from the start of the loop and optional tempo
+       changes inside it. Turns beats into seconds from the start of the loop
+       and back, changing the tempo only rebuilds the few segments.
+       bpm (float): beats per minute at the start of the loop
+       beats_per_loop (float): beats per loop
+       changes (list): (beat, bpm) tempo changes in the loop'''
+    def __init__(self, bpm, beats_per_loop, changes=()):
+        super(TempoMap, self).__init__()
+        self.bpm = bpm
+        self.beats_per_loop = beats_per_loop
+        self.changes = sorted((beat, tempo) for beat, tempo in changes if beat > 0)
+        self.update()
+
+    def update(self):
+        '''rebuilds the segments after the tempo or the length changed'''
+        # start beat, start second and bpm of each segment of constant tempo
+        self.segment_beats = [0]
+        self.segment_seconds = [0.0]
+        self.segment_bpms = [self.bpm]
+        for beat, tempo in self.changes:
+            if beat >= self.beats_per_loop:
+                break
+            self.segment_seconds.append(self.segment_seconds[-1] +
+                                        (beat - self.segment_beats[-1]) * 60 / self.segment_bpms[-1])
+            self.segment_beats.append(beat)
+            self.segment_bpms.append(tempo)
+        self.loop_seconds = self.segment_seconds[-1] + \
+            (self.beats_per_loop - self.segment_beats[-1]) * 60 / self.segment_bpms[-1]
+
+    def set_bpm(self, bpm):
+        self.bpm = bpm
+        self.update()
+
+    def set_beats_per_loop(self, beats_per_loop):
+        self.beats_per_loop = beats_per_loop
+        self.update()
+
+    def set_changes(self, changes):
+        '''replaces the tempo changes with changes, list of (beat, bpm)'''
+        self.changes = sorted((beat, tempo) for beat, tempo in changes if beat > 0)
+        self.update()
+
+    def seconds_at(self, beat):
+        '''seconds from the start of the loop to beat'''
+        i = bisect.bisect_right(self.segment_beats, beat) - 1
+        return self.segment_seconds[i] + (beat - self.segment_beats[i]) * 60 / self.segment_bpms[i]
+
+    def beat_at(self, seconds):
+        '''beat at seconds from the start of the loop'''
+        i = bisect.bisect_right(self.segment_seconds, seconds) - 1
+        return self.segment_beats[i] + (seconds - self.segment_seconds[i]) * self.segment_bpms[i] / 60
+
+    def seconds_at_beats(self, beats):
+        '''seconds_at for an array of beats'''
+        if len(self.segment_beats) == 1:
+            return beats * (60 / self.bpm)
+        knot_beats = self.segment_beats + [self.beats_per_loop]
+        knot_seconds = self.segment_seconds + [self.loop_seconds]
+        return np.interp(beats, knot_beats, knot_seconds)
+
+
+# columns of the schedule: beat of the command, pitch and whether it is a note on
+event_dtype = np.dtype([("beat", np.float64), ("pitch", np.int16), ("on", np.bool_)])
+max_versions = 100 # versions of a schedule kept for undo
+
+class EventLayer(object):
+    '''One take of a schedule, its events sorted by beat. A layer is never
+       changed once it is made, so versions of a schedule and the clock
+       share it without copies
+       events (array): events with event_dtype in any order, kept by the
+                    layer if they are sorted so they must not be changed
+       beats (array): contiguous copy of the beat column of events if the
+                    caller made one and knows they are sorted'''
+    def __init__(self, events, beats=None):
+        super(EventLayer, self).__init__()
+        if beats is None:
+            beats = events["beat"]
+            if np.any(beats[1:] < beats[:-1]):
+                events = events[np.argsort(beats, kind="stable")]
+            # contiguous copy of the beat column for searchsorted
+            beats = np.ascontiguousarray(events["beat"])
+        self.events = events
+        self.events.flags.writeable = False
+        self.beats = beats
+        self.beats.flags.writeable = False
+
+
 class AudioSchedule(object):
-    '''Class used to define the schedule'''
+    '''Class used to define the schedule. The events are kept in layers, one
+       per take. A version of the schedule is a tuple of layers, recording a
+       take adds a version which shares the layers of the one before, so
+       undo and redo only move between versions. The events stay in beats,
+       the tempo map turns them into time when they are played, and the
+       transform (quantize, swing, humanize) is applied to copies of the
+       layers, so the recorded timing is never lost.
+       bpm (int): beats per minute
+       beats_per_loop (int): beats per loop
+       schedule (list): list of tuple beat, pitch, on'''
     def __init__(self, bpm, beats_per_loop, schedule):
         super(AudioSchedule, self).__init__()
-        self.bpm = bpm
-        self.beats_per_loop = beats_per_loop
-        self.schedule_beats = schedule # List of tuple beat, pitch, off
-        self.schedule_ticks = []
-        self.ticks_per_loop = -1
-
-    def get_schedule_ticks(self, tps):
-        self.schedule_ticks = []
-        for note in self.schedule_beats:
-            tick = note[0] / self.bpm * 60 * tps
-            self.schedule_ticks.append((tick, note[1], note[2]))
-
-        self.ticks_per_loop = self.beats_per_loop / self.bpm * 60 * tps
-
-    def sort(self):
-        tmp = sorted(self.schedule_beats, key=lambda x: x[0])
-        self.schedule_beats = tmp
-        
\ No newline at end of file
+        self.tempo_map = TempoMap(bpm, beats_per_loop)
+        self.history = [()] # versions of the schedule, tuples of layers
+        self.version = 0 # index of the current version in history
+        self.buffer = np.zeros(0, dtype=event_dtype) # take being recorded, grows as notes come in
+        self.n_take = 0 # number of events in the take
+        self.replace = False # whether the take replaces the layers instead of adding to them
+        self.merged = None # (layers, events) of the layers and the take, made when they are asked for
+        self.transform = Transform()
+        self.transformed = {} # raw layer -> layer with the transform applied
+        self.transformed_bpl = None # beats per loop the transformed layers wrap at
+        if len(schedule):
+            beats, pitches, on_offs = zip(*schedule)
+            self.set_events(beats, pitches, on_offs)
+
+    @property
+    def bpm(self):
+        '''beats per minute at the start of the loop'''
+        return self.tempo_map.bpm
+
+    @bpm.setter
+    def bpm(self, bpm):
+        self.tempo_map.set_bpm(bpm)
+
+    @property
+    def beats_per_loop(self):
+        return self.tempo_map.beats_per_loop
+
+    @beats_per_loop.setter
+    def beats_per_loop(self, beats_per_loop):
+        self.tempo_map.set_beats_per_loop(beats_per_loop)
+
+    @property
+    def raw_layers(self):
+        '''tuple of the layers of the current version as they were recorded'''
+        return self.history[self.version]
+
+    @property
+    def layers(self):
+        '''tuple of the layers of the current version as they are played, with
+           the transform applied. The transformed layers are cached until the
+           transform or the beats per loop change'''
+        layers = self.history[self.version]
+        if not self.transform.is_active():
+            return layers
+        beats_per_loop = self.tempo_map.beats_per_loop
+        if beats_per_loop != self.transformed_bpl:
+            self.transformed = {}
+            self.transformed_bpl = beats_per_loop
+        # only the layers of the current version are kept
+        self.transformed = {layer: self.transformed.get(layer) or
+                            EventLayer(self.transform.apply(layer.events, beats_per_loop))
+                            for layer in layers}
+        return tuple(self.transformed[layer] for layer in layers)
+
+    def set_transform(self, transform):
+        '''set the Transform applied to the layers when they are played'''
+        self.transform = transform
+        self.transformed = {}
+
+    def shown_layers(self, raw=False):
+        '''layers which are heard along with the take being recorded, as they
+           were recorded if raw'''
+        if self.replace:
+            return ()
+        return self.raw_layers if raw else self.layers
+
+    @property
+    def n_events(self):
+        '''number of events in the layers and the take'''
+        return sum(len(layer.beats) for layer in self.shown_layers(raw=True)) + self.n_take
+
+    @property
+    def events(self):
+        '''structured array of all events as they are played, the layers in
+           order then the take being recorded'''
+        layers = self.shown_layers()
+        if self.merged is None or self.merged[0] != layers:
+            self.merged = (layers, self.join_take(layers))
+        return self.merged[1]
+
+    @property
+    def raw_events(self):
+        '''structured array of all events as they were recorded'''
+        return self.join_take(self.shown_layers(raw=True))
+
+    @property
+    def raw_layer_lengths(self):
+        '''number of events of each layer of raw_events'''
+        lengths = [len(layer.beats) for layer in self.shown_layers(raw=True)]
+        if self.n_take:
+            lengths.append(self.n_take)
+        return lengths
+
+    def join_take(self, layers):
+        '''events of layers followed by the take being recorded'''
+        parts = [layer.events for layer in layers]
+        if self.n_take:
+            parts.append(self.buffer[:self.n_take])
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=event_dtype)
+
+    def set_events(self, beats, pitches, on_offs, layer_lengths=None):
+        '''replace the schedule with the given columns, without undo history.
+           layer_lengths (see LoopingTrack.get_state) splits them into the
+           takes they were recorded in, otherwise they are one layer'''
+        beats = np.array(beats, dtype=np.float64)
+        events = np.empty(len(beats), dtype=event_dtype) # every column is set
+        events["beat"] = beats
+        events["pitch"] = pitches
+        events["on"] = on_offs
+        if layer_lengths:
+            self.set_layers([events[start:end] for start, end in layer_bounds(len(events), layer_lengths)])
+        elif len(events) and not (beats[1:] < beats[:-1]).any():
+            # saved columns are sorted, so the layer is made without sorting
+            # or copying the beats again
+            self.history = [(EventLayer(events, beats),)]
+            self.version = 0
+            self.start_take()
+        else:
+            self.set_layers([events] if len(events) else [])
+
+    def set_layers(self, layer_events):
+        '''replace the schedule with a layer for each of layer_events (event
+           arrays), without undo history'''
+        self.history = [tuple(EventLayer(events) for events in layer_events)]
+        self.version = 0
+        self.start_take()
+
+    def start_take(self, replace=False):
+        '''start recording a take, over the layers or replacing them'''
+        self.n_take = 0
+        self.replace = replace
+        self.merged = None
+
+    def add_event(self, beat, pitch, on):
+        '''append one event to the take, the buffer doubles in size when it
+           is full'''
+        if self.n_take == len(self.buffer):
+            buffer = np.zeros(max(64, 2 * len(self.buffer)), dtype=event_dtype)
+            buffer[:self.n_take] = self.buffer[:self.n_take]
+            self.buffer = buffer
+        self.buffer[self.n_take] = (beat, pitch, on)
+        self.n_take += 1
+        self.merged = None
+
+    def commit_take(self):
+        '''adds the take as a new version with a layer of its events. A take
+           which replaces the layers is added even without events, since the
+           loop was cleared'''
+        if self.n_take or self.replace:
+            layers = self.shown_layers(raw=True)
+            if self.n_take:
+                layers = layers + (EventLayer(self.buffer[:self.n_take].copy()),)
+            # a new take drops the versions which were undone
+            del self.history[self.version + 1:]
+            self.history.append(layers)
+            del self.history[:-max_versions]
+            self.version = len(self.history) - 1
+        self.start_take()
+
+    def can_undo(self):
+        return self.version > 0
+
+    def can_redo(self):
+        return self.version < len(self.history) - 1
+
+    def undo(self):
+        '''go back to the version before the last take'''
+        if self.can_undo():
+            self.version -= 1
+            self.merged = None
+
+    def redo(self):
+        '''go forward to the version of the next take'''
+        if self.can_redo():
+            self.version += 1
+            self.merged = None
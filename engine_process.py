@@ -0,0 +1,353 @@
+import argparse
+import os
+import pickle
+import subprocess
+import sys
+import time
+from clock import Clock, AudioSchedule
+from headless import HeadlessLooper
+from shared_ring import SharedRing
+from synth_wrapper import get_program_selector
+
+command_capacity = 2 ** 22 # bytes of commands in flight
+# commands larger than this (e.g. a posted schedule of a few 100k events) are
+# sent in parts, so any loop fits through the ring a part at a time
+max_message = command_capacity // 4
+snapshot_capacity = 2 ** 16
+
+
+class EngineProcess(object):
+    '''Runs the clock and the synths in a separate process (see
+       EngineServer), so nothing the GUI does holds up playback. The GUI
+       sends commands over a shared memory ring and gets snapshots of the
+       engine's metrics back over another one.
+       n_tracks (int): number of tracks
+       synth_filepath(str): filepath to sf2 file
+       program_filepath(str): filepath to program name file
+       shared_engine (bool): play all tracks on MIDI channels of one synth
+       granularity (float): longest time in seconds the scheduler sleeps
+       deadline (float): seconds an event may be late before it is a miss'''
+    def __init__(self, n_tracks, synth_filepath="./data/FluidR3_GM.sf2",
+                 program_filepath="./data/fluid_synth_programs.txt",
+                 shared_engine=False, granularity=0.005, deadline=0.005):
+        super(EngineProcess, self).__init__()
+        self.commands = SharedRing(capacity=command_capacity)
+        self.snapshots = SharedRing(capacity=snapshot_capacity)
+        arguments = [sys.executable, os.path.abspath(__file__), self.commands.path,
+                     self.snapshots.path, str(n_tracks), "--soundfont", synth_filepath,
+                     "--programs", program_filepath, "--granularity", str(granularity * 1000),
+                     "--deadline", str(deadline * 1000)]
+        if shared_engine:
+            arguments.append("--shared-engine")
+        self.process = subprocess.Popen(arguments)
+        self.snapshot = None # latest snapshot, None until the synths are loaded
+        self.latency = None # output latency of the synths in seconds
+
+    def send(self, *command):
+        '''sends command (a tuple, see EngineServer.apply) to the engine.
+           Commands larger than max_message are sent as ("part", bytes, last)
+           messages which the engine joins. Waits on the calling (GUI) thread
+           while the ring is full, the engine empties it every ms, so only
+           sending a few MB at once waits noticeably'''
+        message = pickle.dumps(command, pickle.HIGHEST_PROTOCOL)
+        if len(message) <= max_message:
+            self.put(message)
+            return
+        for start in range(0, len(message), max_message):
+            last = start + max_message >= len(message)
+            self.put(pickle.dumps(("part", message[start:start + max_message], last),
+                                  pickle.HIGHEST_PROTOCOL))
+
+    def put(self, message):
+        '''puts message on the command ring, waits until there is room'''
+        while not self.commands.put(message):
+            if self.process.poll() is not None:
+                raise RuntimeError("The audio engine process stopped")
+            time.sleep(0.001)
+
+    def poll(self):
+        '''returns the latest snapshot of the engine, None if it hasn't sent
+           one yet'''
+        message = self.snapshots.get()
+        while message is not None:
+            self.snapshot = pickle.loads(message)
+            self.latency = self.snapshot["latency"]
+            message = self.snapshots.get()
+        return self.snapshot
+
+    def stop(self, timeout=5):
+        '''stops the engine process, returns its last snapshot'''
+        if self.process.poll() is None:
+            self.send("stop")
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        snapshot = self.poll()
+        self.commands.close()
+        self.snapshots.close()
+        return snapshot
+
+
+class RemoteSynth(object):
+    '''Stands in for a SynthWrapper in the GUI process: keeps the settings the
+       tracks read back and sends the notes to the synth in the engine process
+       engine (EngineProcess): engine which has the synth
+       target: track index of the synth or "metronome"
+       program_filepath(str): filepath to program name file'''
+    def __init__(self, engine, target, program_filepath):
+        super(RemoteSynth, self).__init__()
+        self.engine = engine
+        self.target = target
+        self.volume = 60
+        self.program = 0
+        self.midi_offset = 60
+        self.program_selector = get_program_selector(program_filepath)
+
+    def set_volume(self, volume):
+        self.volume = volume
+        self.engine.send("synth", self.target, "set_volume", (volume,))
+
+    def set_midi_offset(self, offset):
+        self.midi_offset = offset
+        self.engine.send("synth", self.target, "set_midi_offset", (offset,))
+
+    def set_instrument(self, program):
+        self.program = program
+        self.engine.send("synth", self.target, "set_instrument", (program,))
+
+    def output_latency(self):
+        '''output latency reported by the engine, None until its synths are
+           loaded'''
+        return self.engine.latency
+
+    def turn_off_notes(self):
+        self.engine.send("synth", self.target, "turn_off_notes", ())
+
+    def do_command(self, pitch, off_on):
+        self.engine.send("synth", self.target, "do_command", (pitch, off_on))
+
+
+def forwarded(method):
+    '''makes a Clock method run on the clock of the engine as well, once the
+       GUI's clock has run it. Calls it makes to other forwarded methods are
+       not sent on their own.'''
+    def forward(self, *args):
+        self.depth += 1
+        try:
+            result = method(self, *args)
+        finally:
+            self.depth -= 1
+        if not self.depth:
+            self.send_call(method.__name__, args)
+        return result
+    forward.__doc__ = method.__doc__
+    return forward
+
+
+class RemoteClock(Clock):
+    '''Clock of the GUI process when the engine runs in its own process. It
+       keeps the timing of the tracks (clock and track offsets, schedules and
+       tempo maps) so the GUI turns times into beats without asking the
+       engine, and sends every change to the engine's Clock, which plays the
+       notes. Both processes read the same system wide monotonic clock
+       (time.perf_counter) and the offsets picked here are sent with every
+       change, so they agree on the beat.
+       engine (EngineProcess): engine to send the changes to'''
+    def __init__(self, engine, n_tracks, synths, tps, metro_synth):
+        self.engine = engine
+        self.depth = 0 # nesting of forwarded calls
+        super(RemoteClock, self).__init__(n_tracks, synths, tps, metro_synth=metro_synth)
+
+    def send_call(self, method, args):
+        '''runs method with args on the engine's clock, then gives it the
+           offsets of this clock'''
+        self.engine.send("clock", method, args, self.offset, self.enabled,
+                         dict(self.track_offsets))
+
+    @property
+    def use_metronome(self):
+        return self.metronome_on
+
+    @use_metronome.setter
+    def use_metronome(self, on_off):
+        self.metronome_on = on_off
+        self.engine.send("use_metronome", on_off)
+
+    start = forwarded(Clock.start)
+    disable_track = forwarded(Clock.disable_track)
+    enable_track = forwarded(Clock.enable_track)
+    reset_track_offset = forwarded(Clock.reset_track_offset)
+    sync_track_starts = forwarded(Clock.sync_track_starts)
+    sync = forwarded(Clock.sync)
+    set_metronome = forwarded(Clock.set_metronome)
+    release_metronome = forwarded(Clock.release_metronome)
+    set_late_policy = forwarded(Clock.set_late_policy)
+    set_offset = forwarded(Clock.set_offset)
+    set_track_offset = forwarded(Clock.set_track_offset)
+
+    def post_schedule(self, looper_id, schedule):
+        '''called by loopers to post their new schedules, the engine gets a
+           copy of the layers and the tempo map'''
+        super(RemoteClock, self).post_schedule(looper_id, schedule)
+        tempo_map = schedule.tempo_map
+        self.send_call("post_schedule", (looper_id, [layer.events for layer in schedule.layers],
+                                         tempo_map.bpm, tempo_map.beats_per_loop,
+                                         tempo_map.changes))
+
+    def set_tempo(self, looper_id, schedule, bpm=None, beats_per_loop=None, changes=None):
+        '''changes the tempo map of schedule of track looper_id here and in
+           the engine'''
+        super(RemoteClock, self).set_tempo(looper_id, schedule, bpm, beats_per_loop, changes)
+        self.send_call("set_tempo", (looper_id, bpm, beats_per_loop, changes))
+
+    def rearm(self, looper_id):
+        '''nothing is played from the GUI process'''
+
+    def on_update(self):
+        '''nothing is played from the GUI process'''
+
+
+class EngineServer(object):
+    '''Runs in the engine process: plays the tracks on a HeadlessLooper's
+       clock and synths from its scheduler thread, applies the commands of
+       the GUI and sends back snapshots of the metrics
+       commands_path (str): file of the ring the GUI sends commands on
+       snapshots_path (str): file of the ring the snapshots are sent on
+       n_tracks (int): number of tracks
+       synth_filepath(str): filepath to sf2 file
+       program_filepath(str): filepath to program name file
+       shared_engine (bool): play all tracks on MIDI channels of one synth
+       granularity (float): longest time in seconds the scheduler sleeps
+       deadline (float): seconds an event may be late before it is a miss
+       poll_interval (float): seconds between checks for commands
+       snapshot_interval (float): seconds between snapshots'''
+    def __init__(self, commands_path, snapshots_path, n_tracks, synth_filepath,
+                 program_filepath, shared_engine=False, granularity=0.005, deadline=0.005,
+                 poll_interval=0.001, snapshot_interval=0.05):
+        super(EngineServer, self).__init__()
+        self.commands = SharedRing(commands_path)
+        self.snapshots = SharedRing(snapshots_path)
+        # both processes have the rings mapped, the files would only be left
+        # behind by a crash
+        self.commands.unlink()
+        self.snapshots.unlink()
+        self.parent_pid = os.getppid()
+        self.looper = HeadlessLooper(n_tracks, synth_filepath, program_filepath,
+                                     shared_engine, granularity)
+        self.clock = self.looper.clock
+        self.looper.metrics.deadline = deadline
+        self.schedules = {} # track index -> schedule the clock plays
+        self.parts = [] # parts of a large command received so far
+        self.poll_interval = poll_interval
+        self.snapshot_interval = snapshot_interval
+
+    def get_schedule(self, looper_id):
+        if looper_id not in self.schedules:
+            self.schedules[looper_id] = AudioSchedule(60, 16, [])
+        return self.schedules[looper_id]
+
+    def apply(self, command):
+        '''applies a command from the GUI, one of
+           ("synth", track index or "metronome", method, args)
+           ("clock", method, args, clock offset, enabled, track offsets)
+           ("use_metronome", on_off)'''
+        if command[0] == "synth":
+            _, target, method, args = command
+            synth = self.clock.metro_synth if target == "metronome" else self.looper.synths[target]
+            getattr(synth, method)(*args)
+        elif command[0] == "clock":
+            _, method, args, offset, enabled, track_offsets = command
+            clock = self.clock
+            with clock.lock:
+                if method == "post_schedule":
+                    looper_id, layer_events, bpm, beats_per_loop, changes = args
+                    schedule = self.get_schedule(looper_id)
+                    schedule.tempo_map.bpm = bpm
+                    schedule.tempo_map.beats_per_loop = beats_per_loop
+                    schedule.tempo_map.set_changes(changes)
+                    schedule.set_layers(layer_events)
+                    args = (looper_id, schedule)
+                elif method == "set_tempo":
+                    looper_id, bpm, beats_per_loop, changes = args
+                    args = (looper_id, self.get_schedule(looper_id), bpm, beats_per_loop, changes)
+                getattr(clock, method)(*args)
+                # use the times the GUI picked, so both clocks are on the same beat
+                clock.offset = offset
+                clock.enabled = enabled
+                clock.track_offsets.update(track_offsets)
+        elif command[0] == "use_metronome":
+            self.clock.use_metronome = command[1]
+
+    def send_snapshot(self):
+        '''sends the metrics, dropped if the GUI hasn't read the last ones'''
+        snapshot = {"latency": self.clock.metro_synth.output_latency(),
+                    "metrics": self.looper.metrics.get_dispatch_state(),
+                    "jitter": self.looper.scheduler.stats.summary()}
+        self.snapshots.put(pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL))
+
+    def join_part(self, command):
+        '''adds a ("part", bytes, last) command, returns the large command
+           the parts make up once the last one is in, otherwise None'''
+        _, part, last = command
+        self.parts.append(part)
+        if not last:
+            return None
+        command = pickle.loads(b"".join(self.parts))
+        self.parts = []
+        return command
+
+    def run(self):
+        '''plays until the GUI sends stop or goes away'''
+        self.looper.scheduler.start()
+        next_snapshot = 0
+        running = True
+        while running:
+            message = self.commands.get()
+            while message is not None:
+                command = pickle.loads(message)
+                if command[0] == "part":
+                    command = self.join_part(command)
+                if command is not None:
+                    if command[0] == "stop":
+                        running = False
+                        break
+                    try:
+                        self.apply(command)
+                    except Exception as error:
+                        print("Engine failed to apply %s: %s" % (command[:2], error))
+                message = self.commands.get()
+            now = time.perf_counter()
+            if now >= next_snapshot:
+                self.send_snapshot()
+                next_snapshot = now + self.snapshot_interval
+            # the GUI crashed, this process was handed to another parent
+            if os.getppid() != self.parent_pid:
+                running = False
+            time.sleep(self.poll_interval)
+        self.looper.stop()
+        for synth in self.looper.synths:
+            synth.turn_off_notes()
+        self.send_snapshot()
+        self.commands.close()
+        self.snapshots.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Audio engine process of the GUI, "
+                                                 "started by main.py --engine-process")
+    parser.add_argument("commands", help="ring file the GUI sends commands on")
+    parser.add_argument("snapshots", help="ring file the snapshots are sent on")
+    parser.add_argument("n_tracks", type=int, help="number of tracks")
+    parser.add_argument("--soundfont", default="./data/FluidR3_GM.sf2")
+    parser.add_argument("--programs", default="./data/fluid_synth_programs.txt")
+    parser.add_argument("--shared-engine", action="store_true",
+                        help="play all tracks on MIDI channels of one synth")
+    parser.add_argument("--granularity", type=float, default=5,
+                        help="longest time in ms the scheduler sleeps")
+    parser.add_argument("--deadline", type=float, default=5,
+                        help="ms an event may be late before it counts as a deadline miss")
+    args = parser.parse_args()
+    EngineServer(args.commands, args.snapshots, args.n_tracks, args.soundfont, args.programs,
+                 args.shared_engine, args.granularity / 1000, args.deadline / 1000).run()
@@ -0,0 +1,226 @@
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from render import OfflineRenderer
+from track import LooperState
+
+
+def loop_key(state):
+    '''key of everything that changes the sound of a loop in state (see
+       LoopingTrack.get_state)'''
+    digest = hashlib.sha1()
+    for column, dtype in (("schedule_beats_beats", np.float64),
+                          ("schedule_beats_pitches", np.int16),
+                          ("schedule_beats_onoff", np.bool_)):
+        digest.update(np.ascontiguousarray(state[column], dtype=dtype).tobytes())
+    digest.update(repr([state.get(key) for key in ("bpm", "bpl", "program", "midi_offset",
+                                                   "volume", "tempo_changes", "transform",
+                                                   "layer_lengths")]).encode())
+    return digest.hexdigest()
+
+
+class LoopCache(object):
+    '''Rendered loops by loop key, the least recently used loops are dropped
+       once they take more than max_bytes
+       max_bytes (int): memory the loops may take
+       on_evict (function): called with the key of every dropped loop'''
+    def __init__(self, max_bytes, on_evict=None):
+        super(LoopCache, self).__init__()
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.loops = OrderedDict() # key -> float32 (frames, 2) array, oldest first
+        self.n_bytes = 0
+
+    def get(self, key):
+        '''rendered loop of key or None, marks it as used'''
+        pcm = self.loops.get(key)
+        if pcm is not None:
+            self.loops.move_to_end(key)
+        return pcm
+
+    def put(self, key, pcm):
+        '''adds a rendered loop, returns False if it is larger than the cache'''
+        if pcm.nbytes > self.max_bytes:
+            return False
+        if key in self.loops:
+            self.n_bytes -= self.loops.pop(key).nbytes
+        self.loops[key] = pcm
+        self.n_bytes += pcm.nbytes
+        while self.n_bytes > self.max_bytes:
+            old_key, old_pcm = self.loops.popitem(last=False)
+            self.n_bytes -= old_pcm.nbytes
+            if self.on_evict is not None:
+                self.on_evict(old_key)
+        return True
+
+
+class LoopRenderer(object):
+    '''Renders single loops on one synth without an audio driver, the
+       soundfont is only loaded once
+       synth_filepath(str): filepath to sf2 file
+       program_filepath(str): filepath to program name file
+       samplerate (int): sample rate in Hz'''
+    def __init__(self, synth_filepath, program_filepath, samplerate=44100):
+        super(LoopRenderer, self).__init__()
+        self.synth_filepath = synth_filepath
+        self.program_filepath = program_filepath
+        self.samplerate = samplerate
+        self.engine = None
+
+    def render(self, state):
+        '''renders the loop of state, returns float32 array of shape
+           (frames, 2) in -1 to 1. The loop is rendered twice and the second
+           repetition is kept, so notes ringing over the end of the loop are
+           heard at its start like when it is played live'''
+        renderer = OfflineRenderer({0: state}, self.synth_filepath, self.program_filepath,
+                                   self.samplerate, engine=self.engine)
+        self.engine = renderer.engine
+        mix = renderer.render(2)
+        for synth in renderer.synths:
+            synth.synth.all_sounds_off(synth.channel)
+        self.engine.release_channels()
+        n_frames = int(round(renderer.loop_length() * self.samplerate))
+        return mix[len(mix) - n_frames:] / 32768
+
+
+class FrozenPlayer(object):
+    '''Plays rendered loops on an audio output stream (needs the sounddevice
+       package), each in time with its track on the clock
+       clock (Clock): clock the tracks play on
+       samplerate (int): sample rate of the loops in Hz
+       synth_latency (float): output latency of the live synths in seconds,
+                    the loops are delayed by it to line up with them'''
+    def __init__(self, clock, samplerate=44100, synth_latency=0.0):
+        super(FrozenPlayer, self).__init__()
+        self.clock = clock
+        self.samplerate = samplerate
+        self.synth_latency = synth_latency
+        # track index -> rendered loop, replaced instead of changed so the
+        # audio thread never sees it change while mixing
+        self.loops = {}
+        self.stream = None
+
+    def start(self):
+        '''opens the output stream, raises ImportError without sounddevice'''
+        import sounddevice # deferred, optional dependency only needed to freeze
+        self.stream = sounddevice.OutputStream(samplerate=self.samplerate, channels=2,
+                                               dtype="float32", callback=self.callback)
+        self.stream.start()
+
+    def stop(self):
+        if self.stream is not None:
+            self.stream.close()
+
+    def add(self, index, pcm):
+        loops = dict(self.loops)
+        loops[index] = pcm
+        self.loops = loops
+
+    def remove(self, index):
+        loops = dict(self.loops)
+        loops.pop(index, None)
+        self.loops = loops
+
+    def callback(self, outdata, frames, time_info, status):
+        '''mixes the loops at the position of their tracks when outdata is heard'''
+        outdata.fill(0)
+        clock = self.clock
+        # clock time at which the first frame will be heard
+        heard_at = clock.time_func() + time_info.outputBufferDacTime - time_info.currentTime
+        for index, pcm in self.loops.items():
+            start = clock.offset + clock.track_offsets.get(index, 0) / clock.tps
+            frame = int((heard_at - self.synth_latency - start) * self.samplerate)
+            outdata += pcm[(frame + np.arange(frames)) % len(pcm)]
+
+
+class FreezeManager(object):
+    '''Freezes tracks which played a whole loop in PLAY mode without changes:
+       the loop is rendered in the background and played from the buffer, and
+       the clock stops sending its notes to the synth. Any change to the
+       track plays it live again (see LoopingTrack.unfreeze). Rendered loops
+       are kept in a LoopCache, so a track which goes back to a loop it had
+       before is frozen right away.
+       clock (Clock): clock of the tracks
+       loopers (list): LoopingTracks which may be frozen
+       synth_filepath(str): filepath to sf2 file
+       program_filepath(str): filepath to program name file
+       max_bytes (int): memory the rendered loops may take
+       samplerate (int): sample rate in Hz
+       synth_latency (float): output latency of the live synths in seconds'''
+    def __init__(self, clock, loopers, synth_filepath, program_filepath,
+                 max_bytes=256 * 2 ** 20, samplerate=44100, synth_latency=0.0):
+        super(FreezeManager, self).__init__()
+        self.clock = clock
+        self.loopers = loopers
+        self.cache = LoopCache(max_bytes, self.on_evict)
+        self.renderer = LoopRenderer(synth_filepath, program_filepath, samplerate)
+        self.player = FrozenPlayer(clock, samplerate, synth_latency)
+        # one render at a time, fluidsynth renders faster than real time
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.frozen = {} # track index -> key of the loop it plays
+        self.renders = {} # key -> future of the loop being rendered
+        self.unchanged_since = {} # track index -> tick since which it played unchanged
+        self.loop_keys = {} # track index -> key of its loop, once it played a loop unchanged
+        for looper in loopers:
+            looper.freezer = self
+
+    def start(self):
+        '''starts the audio output of the frozen loops, raises ImportError
+           without sounddevice'''
+        self.player.start()
+
+    def stop(self):
+        self.executor.shutdown(wait=False)
+        self.player.stop()
+
+    def unfreeze(self, index):
+        '''called by track index when it changes, plays it live again'''
+        self.unchanged_since.pop(index, None)
+        self.loop_keys.pop(index, None)
+        if self.frozen.pop(index, None) is not None:
+            self.player.remove(index)
+            self.clock.thaw_track(index)
+
+    def on_evict(self, key):
+        '''plays the tracks of a loop dropped from the cache live again'''
+        for index, frozen_key in list(self.frozen.items()):
+            if frozen_key == key:
+                self.unfreeze(index)
+
+    def on_update(self):
+        '''called regularly from the gui thread, freezes the tracks which
+           played a loop unchanged'''
+        tick = self.clock.get_tick()
+        for looper in self.loopers:
+            index = looper.index
+            if looper.mode != LooperState.PLAY or index in self.frozen \
+                    or not looper.schedule.n_events:
+                continue
+            since = self.unchanged_since.setdefault(index, tick)
+            if tick - since < looper.schedule.tempo_map.loop_seconds * self.clock.tps:
+                continue
+            if index not in self.loop_keys:
+                self.loop_keys[index] = loop_key(looper.get_state())
+            key = self.loop_keys[index]
+            pcm = self.cache.get(key)
+            if pcm is not None:
+                self.freeze(index, key, pcm)
+            elif key in self.renders:
+                render = self.renders[key]
+                if render.done():
+                    del self.renders[key]
+                    if render.exception() is not None:
+                        print("Failed to render loop of track %d: %s" % (index + 1, render.exception()))
+                    elif self.cache.put(key, render.result()):
+                        self.freeze(index, key, render.result())
+                    # don't try again until the track changes
+                    self.unchanged_since[index] = float("inf")
+            else:
+                self.renders[key] = self.executor.submit(self.renderer.render, looper.get_state())
+
+    def freeze(self, index, key, pcm):
+        '''plays track index from the rendered loop pcm'''
+        self.frozen[index] = key
+        self.player.add(index, pcm)
+        self.clock.freeze_track(index)
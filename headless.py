@@ -0,0 +1,148 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from synth_wrapper import SynthWrapper, SynthEngine
+from clock import Clock, SchedulerThread
+from track import LooperState, LoopingTrack
+from session import load_session
+from metrics import TimingMetrics
+from transport import TransportLeader, TransportFollower, default_address, default_port
+
+ticks_per_second = 1024
+
+
+class HeadlessLooper(object):
+    '''The looper without the GUI: the synths, clock and tracks that the main
+       window drives, played by the real time scheduler thread. Nothing here
+       imports Qt, so it can be used from scripts and on machines without a
+       display.
+       n_tracks (int): number of tracks
+       synth_filepath(str): filepath to sf2 file
+       program_filepath(str): filepath to program name file
+       shared_engine (bool): play all tracks on MIDI channels of one synth
+       granularity (float): longest time in seconds the scheduler sleeps'''
+    def __init__(self, n_tracks, synth_filepath="./data/FluidR3_GM.sf2",
+                 program_filepath="./data/fluid_synth_programs.txt",
+                 shared_engine=False, granularity=0.005):
+        super(HeadlessLooper, self).__init__()
+        self.n_tracks = int(n_tracks)
+        self.engine = None
+        if shared_engine:
+            self.engine = SynthEngine(synth_filepath)
+        self.synths = [SynthWrapper(synth_filepath, program_filepath, self.engine, load=False)
+                       for _ in range(self.n_tracks)]
+        metro_synth = SynthWrapper(synth_filepath, program_filepath, self.engine, load=False)
+        # load the soundfonts in parallel, playback needs all of them
+        with ThreadPoolExecutor(max_workers=min(8, self.n_tracks + 1)) as executor:
+            list(executor.map(lambda synth: synth.load(), self.synths + [metro_synth]))
+
+        self.clock = Clock(self.n_tracks, self.synths, ticks_per_second,
+                           self.engine, metro_synth)
+        self.metrics = TimingMetrics()
+        self.clock.metrics = self.metrics
+        self.loopers = [LoopingTrack(i, self.synths[i], self.clock)
+                        for i in range(self.n_tracks)]
+        self.scheduler = SchedulerThread(self.clock, granularity)
+
+    def load_file(self, filename):
+        '''Loads the tracks we have from a saved session'''
+        self.load_states(load_session(filename))
+
+    def load_states(self, states):
+        '''Loads tracks from states (dict of track index -> state dict)'''
+        for i in range(self.n_tracks):
+            if i in states:
+                self.loopers[i].load_from_state(states[i])
+
+    def get_states(self):
+        '''state dicts of all the tracks, as saved by the main window'''
+        return {i: self.loopers[i].get_state() for i in range(self.n_tracks)}
+
+    def play(self):
+        '''Starts all tracks with notes from the beginning of their loops'''
+        for looper in self.loopers:
+            if looper.schedule.n_events:
+                looper.change_state(LooperState.PLAY)
+        self.clock.sync_track_starts()
+        if not self.scheduler.is_alive():
+            self.scheduler.start()
+
+    def stop(self):
+        '''Stops the scheduler and silences all tracks'''
+        if self.scheduler.is_alive():
+            self.scheduler.stop()
+        for looper in self.loopers:
+            looper.change_state(LooperState.DISABLED)
+
+
+def play_session(args):
+    '''plays a saved session until the duration is up or ctrl+c'''
+    states = load_session(args.session)
+    n_tracks = max(states.keys(), default=-1) + 1
+    looper = HeadlessLooper(n_tracks, args.soundfont, args.programs,
+                            args.shared_engine, args.granularity / 1000)
+    looper.load_states(states)
+    looper.play()
+    transport = None
+    if args.transport == "lead":
+        transport = TransportLeader(looper.clock, looper.loopers[0], args.transport_address,
+                                    args.transport_port)
+    elif args.transport == "follow":
+        transport = TransportFollower(looper.clock, looper.loopers, args.transport_port)
+    if transport is not None:
+        transport.start()
+    print("Playing %d tracks from %s, ctrl+c to stop" % (n_tracks, args.session))
+    end = None if args.duration is None else time.perf_counter() + args.duration
+    try:
+        while end is None or time.perf_counter() < end:
+            time.sleep(0.02)
+            if args.transport == "follow":
+                transport.on_update()
+    except KeyboardInterrupt:
+        pass
+    if transport is not None:
+        transport.stop()
+    looper.stop()
+    print(looper.metrics.summary_text())
+
+
+def render_session(args):
+    '''renders a saved session to a wav file'''
+    from render import OfflineRenderer # deferred, only needed to render
+    renderer = OfflineRenderer(load_session(args.session), args.soundfont,
+                               args.programs, args.samplerate)
+    renderer.write_wav(args.output, renderer.render(args.loops))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play or render a saved session without the GUI")
+    parser.add_argument("--soundfont", default="./data/FluidR3_GM.sf2")
+    parser.add_argument("--programs", default="./data/fluid_synth_programs.txt")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    play_parser = commands.add_parser("play", help="play a session on the audio device")
+    play_parser.add_argument("session", help="saved session file")
+    play_parser.add_argument("--duration", type=float, default=None,
+                             help="seconds to play, until ctrl+c by default")
+    play_parser.add_argument("--shared-engine", action="store_true",
+                             help="play all tracks on MIDI channels of one synth")
+    play_parser.add_argument("--granularity", type=float, default=5,
+                             help="longest time in ms the scheduler sleeps")
+    play_parser.add_argument("--transport", default=None, choices=["lead", "follow"],
+                             help="share the transport with other loopers over UDP")
+    play_parser.add_argument("--transport-address", default=default_address,
+                             help="address the leader sends the transport to (default broadcast)")
+    play_parser.add_argument("--transport-port", type=int, default=default_port,
+                             help="UDP port of the transport")
+    play_parser.set_defaults(func=play_session)
+
+    render_parser = commands.add_parser("render", help="render a session to a wav file")
+    render_parser.add_argument("session", help="saved session file")
+    render_parser.add_argument("output", help="wav file to write")
+    render_parser.add_argument("--loops", type=int, default=4,
+                               help="number of repetitions of the longest loop")
+    render_parser.add_argument("--samplerate", type=int, default=44100)
+    render_parser.set_defaults(func=render_session)
+
+    args = parser.parse_args()
+    args.func(args)
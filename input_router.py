@@ -0,0 +1,80 @@
+class EventClock(object):
+    '''Converts the millisecond timestamps of input events to clock time. The
+       event timestamps have their own epoch (e.g. the X server time), the
+       offset to the clock is the smallest difference seen between the clock
+       time an event was handled and its timestamp, which is the event that
+       waited the least in the queue.
+       time_func (function): clock time in seconds
+       wrap (int): timestamps wrap around after this many ms (32 bit)'''
+    def __init__(self, time_func, wrap=2 ** 32):
+        super(EventClock, self).__init__()
+        self.time_func = time_func
+        self.wrap = wrap
+        self.offset = None # clock time - timestamp in seconds
+        self.last_timestamp = None
+
+    def to_clock_time(self, timestamp):
+        '''clock time at which the event with timestamp (ms) happened, the
+           current time if the platform doesn't give timestamps'''
+        now = self.time_func()
+        if not timestamp:
+            return now
+        # timestamps wrapped around or the epoch changed, learn the offset again
+        if self.last_timestamp is not None and timestamp < self.last_timestamp - self.wrap // 2:
+            self.offset = None
+        self.last_timestamp = timestamp
+        offset = now - timestamp / 1000
+        if self.offset is None or offset < self.offset:
+            self.offset = offset
+        return min(now, timestamp / 1000 + self.offset)
+
+
+class InputRouter(object):
+    '''Sends key presses to the tracks which are recording (armed), with the
+       clock time at which the key was pressed so the recorded beat doesn't
+       depend on how long the event waited for the gui thread.
+       loopers (list): LoopingTracks, they tell the router when they are
+                    armed (see LoopingTrack.router)
+       keymap (dict): key text -> pitch index
+       time_func (function): clock time in seconds
+       on_key (function): called with (pitch index, pressed) for every key
+                    press and release, e.g. to show it on the piano'''
+    def __init__(self, loopers, keymap, time_func, on_key=None):
+        super(InputRouter, self).__init__()
+        self.loopers = loopers
+        self.keymap = keymap
+        self.event_clock = EventClock(time_func)
+        self.on_key = on_key
+        self.armed = set() # indexes of the tracks which are recording
+        self.down_keys = set() # keys which are held down
+        for looper in loopers:
+            looper.router = self
+            self.set_armed(looper.index, looper.is_armed())
+
+    def set_armed(self, index, armed):
+        '''called by track index when it starts or stops recording'''
+        if armed:
+            self.armed.add(index)
+        else:
+            self.armed.discard(index)
+
+    def key_event(self, key, text, timestamp, down):
+        '''handles a key press (down True) or release, timestamp is the
+           event's timestamp in ms (0 if unknown). Returns whether the key was
+           used'''
+        if text not in self.keymap:
+            return False
+        # only go off the first time
+        if down == (key in self.down_keys):
+            return False
+        press_time = self.event_clock.to_clock_time(timestamp)
+        if down:
+            self.down_keys.add(key)
+        else:
+            self.down_keys.discard(key)
+        pitch = self.keymap[text]
+        for index in sorted(self.armed):
+            self.loopers[index].on_keystroke(pitch, down, press_time)
+        if self.on_key is not None:
+            self.on_key(pitch, down)
+        return True
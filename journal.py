@@ -0,0 +1,186 @@
+import fcntl
+import json
+import os
+import queue
+import threading
+import numpy as np
+from track import LooperState
+
+# Records are json arrays, one per line:
+#   ["state", track, state dict]      full state of a track (see LoopingTrack.get_state)
+#   ["discarded", track, state dict]  take which was cleared by recording over it
+#   ["params", track, dict]           changed settings, e.g. {"bpm": 120}
+#   ["mode", track, mode name]        track changed mode
+#   ["clear", track]                  schedule was cleared to record a new take
+#   ["note", track, beat, pitch, on]  recorded note
+
+
+class RecordingJournal(threading.Thread):
+    '''Append only journal of recorded notes and track changes so a session
+       can be recovered after a crash. The log functions only put the record
+       on a queue and never block, a background thread writes the records in
+       batches and compacts the file once it has grown.
+       filename (str): path of the journal file
+       flush_interval (float): seconds between writes
+       compact_after (int): number of records after which the file is
+                    rewritten with just the current state of each track
+       lock_file (file): lock of the journal from lock_journal, released
+                    when the journal is closed'''
+    def __init__(self, filename, flush_interval=0.5, compact_after=20000, lock_file=None):
+        super(RecordingJournal, self).__init__(daemon=True)
+        self.filename = filename
+        self.lock_file = lock_file
+        self.flush_interval = flush_interval
+        self.compact_after = compact_after
+        self.queue = queue.SimpleQueue()
+        self.stop_event = threading.Event()
+        self.states = {} # state of each track replayed from the records, used for compaction
+        self.discarded = {} # last discarded take of each track
+        self.n_records = 0 # records written since the last compaction
+        self.journal_file = open(filename, 'w')
+
+    def log_state(self, track, state):
+        '''log the full state of track'''
+        self.queue.put(("state", track, state))
+
+    def log_params(self, track, params):
+        '''log changed settings of track, params is a dict e.g. {"bpm": 120}'''
+        self.queue.put(("params", track, params))
+
+    def log_mode(self, track, mode):
+        '''log mode change of track'''
+        self.queue.put(("mode", track, str(mode)))
+
+    def log_clear(self, track):
+        '''log that the schedule of track was cleared'''
+        self.queue.put(("clear", track))
+
+    def log_note(self, track, beat, pitch, on):
+        '''log a recorded note'''
+        self.queue.put(("note", track, float(beat), int(pitch), bool(on)))
+
+    def run(self):
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        '''write all queued records to the file, compact it if it got too long'''
+        lines = []
+        while True:
+            try:
+                record = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            apply_record(self.states, self.discarded, record)
+            lines.append(json.dumps(record, default=to_json))
+        if not lines:
+            return
+        self.journal_file.write("\n".join(lines) + "\n")
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+        self.n_records += len(lines)
+        if self.n_records > self.compact_after:
+            self.compact()
+
+    def compact(self):
+        '''rewrite the journal with one state record per track'''
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, 'w') as tmp_file:
+            for kind, states in (("discarded", self.discarded), ("state", self.states)):
+                for track, state in states.items():
+                    tmp_file.write(json.dumps((kind, track, state), default=to_json) + "\n")
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        self.journal_file.close()
+        os.replace(tmp_filename, self.filename)
+        self.journal_file = open(self.filename, 'a')
+        self.n_records = 0
+
+    def close(self, remove=True):
+        '''write the remaining records and stop, remove the file if remove is
+           True (clean shutdown, nothing to recover)'''
+        self.stop_event.set()
+        self.join()
+        self.journal_file.close()
+        if remove:
+            try:
+                os.remove(self.filename)
+            except FileNotFoundError:
+                pass
+        if self.lock_file is not None:
+            self.lock_file.close()
+
+
+def lock_journal(filename):
+    '''takes an exclusive lock on filename + ".lock" so only one looper
+       recovers and writes the journal at filename. Returns the open lock
+       file, the lock is held until it is closed, or None if another looper
+       holds it'''
+    lock_file = open(filename + ".lock", 'a')
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def to_json(value):
+    '''converts NumPy arrays and scalars in states for json'''
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("can't write %r to the journal" % (value,))
+
+
+def apply_record(states, discarded, record):
+    '''applies record to states and discarded (dicts of track -> state dict)'''
+    kind, track = record[0], record[1]
+    if kind == "state":
+        state = dict(record[2])
+        for key in ("schedule_beats_beats", "schedule_beats_pitches", "schedule_beats_onoff"):
+            state[key] = list(state[key])
+        states[track] = state
+    elif kind == "discarded":
+        discarded[track] = record[2]
+    # everything else needs the full state of the track first
+    elif track in states:
+        state = states[track]
+        if kind == "params":
+            state.update(record[2])
+        elif kind == "clear":
+            if len(state["schedule_beats_beats"]):
+                discarded[track] = dict(state)
+            state["schedule_beats_beats"] = []
+            state["schedule_beats_pitches"] = []
+            state["schedule_beats_onoff"] = []
+            state.pop("layer_lengths", None)
+        elif kind == "mode":
+            # notes recorded in overdub are a take of their own
+            if record[2] == str(LooperState.OVERDUB):
+                layer_lengths = state.get("layer_lengths", [])
+                n_recorded = len(state["schedule_beats_beats"]) - sum(layer_lengths)
+                if n_recorded:
+                    state["layer_lengths"] = layer_lengths + [n_recorded]
+        elif kind == "note":
+            state["schedule_beats_beats"].append(record[2])
+            state["schedule_beats_pitches"].append(record[3])
+            state["schedule_beats_onoff"].append(record[4])
+
+
+def replay_journal(filename):
+    '''replays the journal at filename, returns (states, discarded): dicts of
+       track -> state dict of the last state of each track and of the last
+       take that was recorded over'''
+    states = {}
+    discarded = {}
+    with open(filename, 'r') as journal_file:
+        for line in journal_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break # last write was cut off by the crash
+            apply_record(states, discarded, record)
+    return states, discarded
@@ -1,171 +1,61 @@
-from PyQt5.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QStackedLayout, QButtonGroup, QRadioButton, QSlider, QSpinBox, QComboBox, QLabel, QPushButton
-from PyQt5.QtGui import QColor, QPalette, QPainter, QPen
-from PyQt5.QtCore import QRect, QPropertyAnimation, QLine
-from enum import Enum
-import numpy as np
+from PyQt5.QtWidgets import QWidget, QAbstractScrollArea, QHBoxLayout, QVBoxLayout, QStackedLayout, QButtonGroup, QRadioButton, QSlider, QSpinBox, QComboBox, QLabel, QPushButton
+from PyQt5.QtGui import QColor, QPalette, QPainter, QPen, QPixmap, QImage
+from PyQt5.QtCore import Qt, QRect, QPropertyAnimation, QLine, QStringListModel
 from synth_wrapper import SynthWrapper, ProgramSelector
-from clock import AudioSchedule
-
-class LooperState(Enum):
-    '''Enum which tracks the state of the looper, whether it is disabled,
-    recording or playing'''
-    DISABLED = 1
-    RECORD = 2
-    PLAY = 3
-
-    def __str__(self):
-        if self.value == self.DISABLED.value:
-            return "DISABLED"
-        elif self.value == self.RECORD.value:
-            return "RECORD"
-        elif self.value == self.PLAY.value:
-            return "PLAY"
-        return "NOT MATCHING"
-
-default_bpm = 60
-default_bpl = 16
-
-class LoopingTrack(object):
-    '''The back end of the looping track'''
-    def __init__(self, index, synth, clock):
-        super(LoopingTrack, self).__init__()
-        self.index = index
-        self.synth = synth
-        self.clock = clock
-        self.bpm = default_bpm
-        self.bpl = default_bpl
-        self.mode = LooperState.DISABLED
-        self.schedule = AudioSchedule(self.bpm, self.bpl, [])
-        self.quantize = False
-        self.quantize_number = 12 # allows for triplets
-        self.new_state_loaded = False # tracks whether to update the clock
-        self.notes_changed = False # updates notes to check to repaint
-        self.synced_to_me = [] # list of tracks synced to this track
-        self.is_synced = False
-
-    def change_state(self, new_state):
-        '''changes state to new_state'''     
-        # if state hasn't changed
-        if new_state == self.mode:
-            return
-        
-        self.synth.turn_off_notes()
-        self.clock.release_metronome(self.index)
-        if new_state == LooperState.DISABLED:
-            self.clock.disable_track(self.index)
-        elif new_state == LooperState.RECORD:
-            self.clock.start()
-            #clear schedule, reset and disable clock
-            self.schedule.schedule_beats = []
-            if not(self.is_synced):
-                self.clock.reset_track_offset(self.index)
-            self.clock.disable_track(self.index)
-
-            # set self to metronome
-            self.clock.set_metronome(self.index, self.bpm)
-        # play state
-        else:
-            # post schedule to be played
-            self.clock.post_schedule(self.index, self.schedule)
-            # start from beginning if previous state was disabled
-            if self.mode == LooperState.DISABLED:
-                self.clock.enable_track(self.index, False)
-            # keep offset when last mode was recording
-            else:
-                self.clock.enable_track(self.index, True)
-        self.mode = new_state
-
-    def set_quantize(self, quantize):
-        '''whether to quantize notes as we record them'''
-        self.quantize = quantize
-
-    def set_bpm(self, bpm):
-        '''update bpm and post new schedule'''
-        self.bpm = bpm
-        self.schedule.bpm = bpm
-        self.clock.post_schedule(self.index, self.schedule)
-
-        for looper in self.synced_to_me:
-            looper.set_bpm(bpm)
-            looper.new_state_loaded = True # update the gui
-
-    def set_bpl(self, bpl):
-        '''update beats per loop and post new schedule'''
-        self.bpl = bpl
-        self.schedule.beats_per_loop = bpl
-        self.clock.post_schedule(self.index, self.schedule)
-        for looper in self.synced_to_me:
-            looper.set_bpl(bpl)
-            looper.new_state_loaded = True # update the gui
-
-    def set_schedule(self, schedule):
-        '''set schedule from loaded file, disable track'''
-        self.change_state(LooperState.DISABLED)
-        self.schedule = schedule
-
-    def set_volume(self, volume):
-        '''sets synth volume'''
-        self.synth.set_volume(volume)
-
-    def get_program_names(self):
-        '''gets current program name from synth'''
-        return self.synth.program_selector.get_program_names()
-    
-    def set_program(self, index):
-        '''sets synth to program at index'''
-        self.synth.set_instrument(index)
-    
-    def set_midi_offset(self, offset):
-        '''sets the midi value of the r key'''
-        self.synth.set_midi_offset(offset)
-
-    def on_keystroke(self, note_idx, up_down):
-        '''plays and records note if in record mode'''
-        if self.mode == LooperState.RECORD:
-            beat = self.clock.get_current_beat(self.index, self.bpm, self.bpl)
-            # quantize beat quantize number
-            if self.quantize:
-                beat = np.round(beat * self.quantize_number) / self.quantize_number
-            # add note to schedule
-            self.schedule.schedule_beats.append((beat, note_idx, up_down))
-            # send command to synth
-            self.synth.do_command(note_idx, up_down)
-
-
-    def get_state(self):
-        '''export state to dict to be saved to file'''
-        state_dic = {}
-        state_dic["bpm"] = self.bpm
-        state_dic["bpl"] = self.bpl
-        state_dic["schedule_beats_beats"] = [beat for beat, _, _ in self.schedule.schedule_beats]
-        state_dic["schedule_beats_pitches"] = [pitch for _, pitch, _ in self.schedule.schedule_beats]
-        state_dic["schedule_beats_onoff"] = [onoff for _, _, onoff in self.schedule.schedule_beats]
-        state_dic["program"] = self.synth.program
-        state_dic["midi_offset"] = self.synth.midi_offset
-        state_dic["volume"] = self.synth.volume
-        return state_dic
-        
-    def load_from_state(self, state_dict):
-        '''import state from dict from save file'''
-        self.change_state(LooperState.DISABLED)
-        self.bpm = state_dict["bpm"]
-        self.bpl = state_dict["bpl"]
-        
-        self.schedule.bpm = self.bpm
-        self.schedule.beats_per_loop = self.bpl
-        self.schedule.schedule_beats = [(beat, pitch, onoff) for beat, pitch, onoff in zip(state_dict["schedule_beats_beats"], state_dict["schedule_beats_pitches"], state_dict["schedule_beats_onoff"])]
-
-        self.set_program(state_dict["program"])
-        self.set_midi_offset(state_dict["midi_offset"])
-        self.set_volume(state_dict["volume"])
-
-        self.new_state_loaded = True
+from track import LooperState, LoopingTrack, default_bpm, default_bpl
+from clock import LatePolicy
+from transforms import note_on_indexes
+import numpy as np
 
 lowest_note = -5
 highest_note =  28
+# longest loop the beats per loop spin box offers, imported loops can be
+# longer and raise it for their track
+max_bpl = 64
+# quantize grids offered in the gui, name -> beats
+quantize_grids = [("1 Beat", 1), ("1/2 Beat", 1 / 2), ("1/3 Beat", 1 / 3), ("1/4 Beat", 1 / 4),
+                  ("1/6 Beat", 1 / 6), ("1/8 Beat", 1 / 8), ("1/12 Beat", 1 / 12), ("1/16 Beat", 1 / 16)]
+# late policies offered in the gui, name -> LatePolicy, None for the default
+late_policies = [("Default", None), ("Play All", LatePolicy.PLAY_ALL),
+                 ("Drop Late", LatePolicy.DROP_LATE), ("Note Offs Only", LatePolicy.NOTE_OFFS_ONLY)]
+
+
+def note_occupancy(events, beats_per_loop, width):
+    '''bool array of pitch rows (highest_note first) by width pixel columns,
+       True where a note of events (structured array with beat, pitch and on
+       columns) is playing. A note over the end of the loop is split in two'''
+    beats = events["beat"]
+    if np.any(beats[1:] < beats[:-1]):
+        events = events[np.argsort(beats, kind="stable")]
+    note_ons = note_on_indexes(events)
+    offs = np.flatnonzero(~events["on"] & (note_ons >= 0))
+    starts = events["beat"][note_ons[offs]]
+    ends = events["beat"][offs]
+    pitches = events["pitch"][offs].astype(np.int64)
+    shown = (pitches >= lowest_note) & (pitches <= highest_note)
+    starts, ends, pitches = starts[shown], ends[shown], pitches[shown]
+    wraps = ends < starts
+    starts = np.concatenate((starts, np.zeros(np.count_nonzero(wraps))))
+    ends = np.concatenate((np.where(wraps, beats_per_loop, ends), ends[wraps]))
+    pitches = np.concatenate((pitches, pitches[wraps]))
+    # every note covers at least one column, the columns it covers are
+    # marked +1 at its first column and -1 after its last
+    scale = width / beats_per_loop
+    first = np.clip((starts * scale).astype(np.int64), 0, width - 1)
+    last = np.clip(np.ceil(ends * scale).astype(np.int64), first + 1, width)
+    rows = highest_note - pitches
+    n_cells = (highest_note + 1 - lowest_note) * (width + 1)
+    changes = np.bincount(rows * (width + 1) + first, minlength=n_cells) - \
+        np.bincount(rows * (width + 1) + last, minlength=n_cells)
+    return np.cumsum(changes.reshape(-1, width + 1), axis=1)[:, :width] > 0
 
 class NoteVisualizer(QWidget):
-    '''Creates the visualization of the notes and the cursor of the current position'''
+    '''Creates the visualization of the notes and the cursor of the current position.
+       The notes are drawn once into an off screen pixmap which is only redrawn
+       when the schedule or the size changes, notes recorded since are added
+       to it as they come in. Once there are more notes than pixel columns
+       they are drawn as an image of which pitches play in each column
+       instead, so drawing takes as long however many notes there are'''
     def __init__(self, looper, color, **kwargs):
         super(NoteVisualizer, self).__init__(**kwargs)
         palette = QPalette()
@@ -186,16 +76,33 @@ class NoteVisualizer(QWidget):
         self.started = False
 
         self.notes = []
+        self.n_plotted = 0 # number of schedule events turned into notes
+        self.seen_pitches = set() # pitches which had an event
+        self.open_notes = {} # pitch -> beat of note on still waiting for its note off
+        self.occupancy = None # pitch rows by pixel columns with a note, when there are too many notes
+
+        # off screen layer with the notes, None when it has to be redrawn
+        self.note_layer = None
+        self.layer_started = False # whether the layer was drawn in color
     
+    def set_looper(self, looper, color):
+        '''show the notes of looper in color'''
+        self.looper = looper
+        self.color = color
+        self.started = looper.mode != LooperState.DISABLED
+        self.plot_schedule()
+        self.on_frame()
+
     def start_anim(self):
         '''start the cursor sweep'''
         self.started = True
+        self.update()
 
     def stop_anim(self):
         '''stop the cursor sweep'''
         self.started = False
         # clear the note sweep and turn notes gray
-        self.repaint()
+        self.update()
 
     def pitch_to_height(self, pitch):
         '''convert note pitch to rectangle height'''
@@ -203,96 +110,154 @@ class NoteVisualizer(QWidget):
         return (top_offset * self.height, 1 / (highest_note + 1 - lowest_note) * self.height)
     
     def add_note(self, pitch, note_start, note_end):
-        '''add note with pitch, start and end'''
+        '''add note with pitch, start and end, draw it on the note layer'''
         top, height = self.pitch_to_height(pitch)
-        note = QRect(note_start * self.width/self.looper.bpl,
-                      top,
-                     (note_end - note_start) * self.width / self.looper.bpl,
-                       height)
+        note = QRect(int(note_start * self.width/self.looper.bpl),
+                      int(top),
+                     int((note_end - note_start) * self.width / self.looper.bpl),
+                       int(height))
         self.notes.append(note)
+        if self.note_layer is not None:
+            painter = QPainter(self.note_layer)
+            self.paint_notes(painter, [note], self.layer_started)
+            painter.end()
+            self.update(note.adjusted(-2, -2, 2, 2))
 
     def clear_notes(self):
         '''clear notes'''
         self.notes = []
+        self.n_plotted = 0
+        self.seen_pitches = set()
+        self.open_notes = {}
+        self.occupancy = None
+        # the whole layer has to be redrawn
+        self.note_layer = None
+        self.update()
 
     def plot_schedule(self):
         '''plots current schedule of notes'''
         # clear existing notes
         self.clear_notes()
-        # separate notes by pitch
-        command_pairs = {}
-        for beat, pitch, on_off in self.looper.schedule.schedule_beats:
-            if pitch not in command_pairs.keys():
-                command_pairs[pitch] = []
+        self.plot_new_events()
+
+    def plot_new_events(self):
+        '''turns the schedule events which were added since the last call into
+           notes, pairing each note on with the next note off of its pitch'''
+        events = self.looper.schedule.events
+        # schedule was cleared or replaced, start over
+        if len(events) < self.n_plotted:
+            self.clear_notes()
+        # too many notes to draw one by one, all events are binned again
+        if self.occupancy is not None or len(events) // 2 > max(1, self.width):
+            if self.occupancy is None or len(events) != self.n_plotted:
+                self.plot_occupancy(events)
+            return
+        new_events = events[self.n_plotted:]
+        for beat, pitch, on_off in zip(new_events["beat"].tolist(), new_events["pitch"].tolist(),
+                                       new_events["on"].tolist()):
+            if pitch not in self.seen_pitches:
+                self.seen_pitches.add(pitch)
                 # first is a note off (carry note over from end of loop)
                 if not on_off:
-                    command_pairs[pitch].append((0, 1))
-            command_pairs[pitch].append((beat, on_off))
-
-        # for each pitch make rectangle from note on and note off events
-        for pitch in command_pairs.keys():
-            on_note = -1 # to track the note on beat
-            looking_for = 1 # whether to find the next on (1) or off not (0)
-            for (beat, on_off) in command_pairs[pitch]:
-                # looking for note on and note is note on
-                if looking_for and on_off:
-                    on_note = beat
-                    looking_for = 0
-                # we already have the note on and the note is a note off
-                elif not looking_for and not on_off:
-                    self.add_note(pitch, on_note, beat)
-                    looking_for = 1
+                    self.open_notes[pitch] = 0
+            # note on for a pitch without a note on
+            if on_off and pitch not in self.open_notes:
+                self.open_notes[pitch] = beat
+            # note off for a pitch with a note on
+            elif not on_off and pitch in self.open_notes:
+                self.add_note(pitch, self.open_notes.pop(pitch), beat)
+        self.n_plotted = len(events)
+
+    def plot_occupancy(self, events):
+        '''bins events into the pitch and pixel column occupancy which is
+           drawn instead of the notes'''
+        self.notes = []
+        self.open_notes = {}
+        self.occupancy = note_occupancy(events, self.looper.bpl, max(1, self.width))
+        self.n_plotted = len(events)
+        self.note_layer = None
+        self.update()
+
+    def paint_occupancy(self, painter, in_color):
+        '''paints the occupancy with painter, stretched over the widget'''
+        color = self.color if in_color else QColor('gray')
+        pixels = np.where(self.occupancy, np.uint32(color.rgb()), np.uint32(QColor("white").rgb()))
+        rows, columns = pixels.shape
+        image = QImage(pixels.data, columns, rows, columns * 4, QImage.Format_RGB32)
+        painter.drawImage(QRect(0, 0, self.width, self.height), image)
+
+    def paint_notes(self, painter, notes, in_color):
+        '''paints notes with painter, in color or gray'''
+        color = self.color if in_color else QColor('gray')
+        painter.setPen(QPen(color, 2))
+        painter.setBrush(color)
+        for note in notes:
+            painter.drawRect(note)
+
+    def render_note_layer(self):
+        '''draws all notes on a new off screen layer'''
+        self.note_layer = QPixmap(max(1, self.width), max(1, self.height))
+        self.note_layer.fill(QColor("white"))
+        self.layer_started = self.started
+        painter = QPainter(self.note_layer)
+        if self.occupancy is not None:
+            self.paint_occupancy(painter, self.started)
+        else:
+            self.paint_notes(painter, self.notes, self.started)
+        painter.end()
 
     def resizeEvent(self, event):
         '''get new width and height on resize'''
         self.width = self.frameGeometry().width()
         self.height = self.frameGeometry().height()
         QWidget.resizeEvent(self, event)
-        self.on_update()
+        # note positions depend on the size
+        self.plot_schedule()
+        self.on_frame()
 
     def paintEvent(self, event):
-        '''paints cursor and notes'''
-        if self.looper.mode == LooperState.RECORD:
-            self.plot_schedule()
+        '''paints the invalidated part of the note layer and the cursor'''
+        if self.note_layer is None or self.layer_started != self.started:
+            self.render_note_layer()
         painter = QPainter(self)
-        # if cursor is moving, paint cursor and notes in color
+        painter.drawPixmap(event.rect(), self.note_layer, event.rect())
+        # if cursor is moving, paint cursor
         if self.started:  
-            painter.setPen(QPen(self.color, 2))
-            painter.setBrush(self.color)
-            for note in self.notes:
-                painter.drawRect(note)
             painter.setPen(QPen(QColor('black'), 2))
             painter.drawLine(self.line)
-        # otherwise paint notes in gray
-        else:
-            painter.eraseRect(0, 0, self.width, self.height)
-            painter.setPen(QPen(QColor('gray'), 2))
-            painter.setBrush(QColor('gray'))
-            for note in self.notes:
-                painter.drawRect(note)
+
+    def cursor_rect(self):
+        '''area covered by the cursor'''
+        return QRect(self.line.x1() - 2, 0, 4, self.height)
     
-    def on_update(self):
-        # paint new cursor position every time
+    def on_frame(self):
+        '''called every display frame, moves the cursor to the position from
+           the clock and only invalidates the old and new cursor strips'''
         if self.started:
-            current_beat = (self.looper.clock.get_current_beat(self.looper.index, self.looper.bpm, self.looper.bpl))
-            x_pos = current_beat * self.width / self.looper.bpl
-            self.line.setLine(x_pos, 0, x_pos, self.height)
-            self.repaint()
+            # add notes recorded since the last frame
+            if self.looper.is_armed():
+                self.plot_new_events()
+            current_beat = self.looper.clock.get_current_beat(self.looper.index,
+                                                              self.looper.schedule.tempo_map)
+            x_pos = int(current_beat * self.width / self.looper.bpl)
+            if x_pos != self.line.x1():
+                self.update(self.cursor_rect())
+                self.line.setLine(x_pos, 0, x_pos, self.height)
+                self.update(self.cursor_rect())
             
 
 
 class LooperGUI(QWidget):
-    '''Front end of the looper'''
-    def __init__(self, index, n_loopers, loopers):
+    '''Front end of the looper. All its settings are read from the track, so
+       the gui can be bound to another track (see TrackListView)
+       program_model (QStringListModel): instrument names shared by all the
+                    looper guis, if None the gui makes its own'''
+    def __init__(self, index, n_loopers, loopers, program_model=None):
         super(LooperGUI, self).__init__()
-
-        palette = QPalette()
-        palette.setColor(palette.Window, QColor.fromHsvF(index / n_loopers, 1, 1))
-        self.setPalette(palette)
         self.setAutoFillBackground(True)
 
-
         self.index = index
+        self.n_loopers = n_loopers
         self.looper = loopers[index]
         self.loopers = loopers
         hlayout = QHBoxLayout()
@@ -317,6 +282,21 @@ class LooperGUI(QWidget):
         self.mode_buttons.addButton(play_button, LooperState.PLAY.value)
         mode_button_layout.addWidget(play_button)
 
+        overdub_button = QRadioButton("Overdub")
+        overdub_button.toggled.connect(self.mode_change)
+        self.mode_buttons.addButton(overdub_button, LooperState.OVERDUB.value)
+        mode_button_layout.addWidget(overdub_button)
+
+        # undo and redo takes
+        undo_redo_layout = QHBoxLayout()
+        self.undo_button = QPushButton("Undo")
+        self.undo_button.clicked.connect(self.undo)
+        undo_redo_layout.addWidget(self.undo_button)
+        self.redo_button = QPushButton("Redo")
+        self.redo_button.clicked.connect(self.redo)
+        undo_redo_layout.addWidget(self.redo_button)
+        mode_button_layout.addLayout(undo_redo_layout)
+
         hlayout.addLayout(mode_button_layout)
 
         # BPM BPL Instrument
@@ -327,29 +307,21 @@ class LooperGUI(QWidget):
         self.bpm_spin_box.setPrefix("Beats per Minute: ")
         bpm_bpl_sync_layout.addWidget(self.bpm_spin_box)
         # bpl spin box
-        self.bpl_spin_box = QSpinBox(minimum=1, maximum=64, value=default_bpl)
+        self.bpl_spin_box = QSpinBox(minimum=1, maximum=max_bpl, value=default_bpl)
         self.bpl_spin_box.editingFinished.connect(self.set_bpl)
         self.bpl_spin_box.setPrefix("Beats per Loop: ")
         bpm_bpl_sync_layout.addWidget(self.bpl_spin_box)
-        # sync combobox
+        # sync combobox, filled with the tracks we can sync to by bind
         self.sync_combobox = QComboBox()
-        self.sync_combobox.addItem("No Sync")
-        # get list of all tracks we can sync to
         self.sync_tracks = []
-        for i in range(n_loopers):
-            if i != index:
-                self.sync_combobox.addItem("Sync to Track " + str(i + 1))
-                self.sync_tracks.append(i)
         bpm_bpl_sync_layout.addWidget(self.sync_combobox)
         self.sync_combobox.currentIndexChanged.connect(self.set_sync)
         hlayout.addLayout(bpm_bpl_sync_layout)
-        self.synced_to = -1
-        self.synced_to_idx = -1
 
         # Volume
         slider_layout = QVBoxLayout()
         self.volume_slider = QSlider(minimum = 0, maximum = 100, value = 60)
-        self.volume_slider.valueChanged.connect(self.looper.set_volume)
+        self.volume_slider.valueChanged.connect(self.set_volume)
         slider_layout.addWidget(self.volume_slider)
         slider_layout.addWidget(QLabel(text = "Volume"))
         hlayout.addLayout(slider_layout)
@@ -358,9 +330,10 @@ class LooperGUI(QWidget):
         i_po_q_layout = QVBoxLayout()
         # instrument
         self.instrument_combobox = QComboBox()
-        self.instrument_combobox.currentIndexChanged.connect(self.looper.set_program)
-        for program_name in self.looper.get_program_names():
-            self.instrument_combobox.addItem(program_name)
+        self.instrument_combobox.currentIndexChanged.connect(self.set_program)
+        if program_model is None:
+            program_model = QStringListModel(self.looper.get_program_names())
+        self.instrument_combobox.setModel(program_model)
         i_po_q_layout.addWidget(self.instrument_combobox)
         # pitch offset
         self.po_spin_box = QSpinBox(minimum=21, maximum=108, value=60)
@@ -372,8 +345,36 @@ class LooperGUI(QWidget):
         self.quantize_button.setCheckable(True)
         self.quantize_button.clicked.connect(self.toggle_quantize)
         i_po_q_layout.addWidget(self.quantize_button)
+        # what the clock does with notes it is too late for
+        self.late_policy_combobox = QComboBox()
+        self.late_policy_combobox.addItems(["Late Notes: " + name for name, _ in late_policies])
+        self.late_policy_combobox.currentIndexChanged.connect(self.set_late_policy)
+        i_po_q_layout.addWidget(self.late_policy_combobox)
         hlayout.addLayout(i_po_q_layout)
 
+        # Quantize grid, strength, swing and humanize, applied as the loop plays
+        transform_layout = QVBoxLayout()
+        self.grid_combobox = QComboBox()
+        self.grid_combobox.addItems(["Grid: " + name for name, _ in quantize_grids])
+        self.grid_combobox.currentIndexChanged.connect(self.set_grid)
+        transform_layout.addWidget(self.grid_combobox)
+        self.strength_spin_box = QSpinBox(minimum=0, maximum=100, value=100)
+        self.strength_spin_box.editingFinished.connect(self.set_strength)
+        self.strength_spin_box.setPrefix("Strength: ")
+        self.strength_spin_box.setSuffix("%")
+        transform_layout.addWidget(self.strength_spin_box)
+        self.swing_spin_box = QSpinBox(minimum=50, maximum=75, value=50)
+        self.swing_spin_box.editingFinished.connect(self.set_swing)
+        self.swing_spin_box.setPrefix("Swing: ")
+        self.swing_spin_box.setSuffix("%")
+        transform_layout.addWidget(self.swing_spin_box)
+        self.humanize_spin_box = QSpinBox(minimum=0, maximum=100, value=0)
+        self.humanize_spin_box.editingFinished.connect(self.set_humanize)
+        self.humanize_spin_box.setPrefix("Humanize: ")
+        self.humanize_spin_box.setSuffix(" ms")
+        transform_layout.addWidget(self.humanize_spin_box)
+        hlayout.addLayout(transform_layout)
+
         # splits the row in half between buttons and the note visualizer
         wrapper_layout = QHBoxLayout()
         wrapper_layout.addLayout(hlayout, stretch=1)
@@ -384,6 +385,54 @@ class LooperGUI(QWidget):
         wrapper_layout.addWidget(self.note_visualizer, stretch=1)
 
         self.setLayout(wrapper_layout)
+        self.bind(index)
+
+    def bind(self, index):
+        '''show track index, sets all widgets from the track without sending
+           the values back to it'''
+        self.index = index
+        self.looper = self.loopers[index]
+        color = QColor.fromHsvF(index / self.n_loopers, 1, 1)
+        palette = QPalette()
+        palette.setColor(palette.Window, color)
+        self.setPalette(palette)
+
+        widgets = self.mode_buttons.buttons() + [
+            self.bpm_spin_box, self.bpl_spin_box, self.sync_combobox, self.volume_slider,
+            self.instrument_combobox, self.po_spin_box, self.quantize_button, self.grid_combobox,
+            self.strength_spin_box, self.swing_spin_box, self.humanize_spin_box,
+            self.late_policy_combobox]
+        for widget in widgets:
+            widget.blockSignals(True)
+        self.mode_buttons.button(self.looper.mode.value).setChecked(True)
+        self.bpm_spin_box.setValue(self.looper.bpm)
+        self.show_bpl()
+        # get list of all tracks we can sync to
+        self.sync_tracks = [i for i in range(self.n_loopers) if i != index]
+        self.sync_combobox.clear()
+        self.sync_combobox.addItem("No Sync")
+        self.sync_combobox.addItems(["Sync to Track " + str(i + 1) for i in self.sync_tracks])
+        if self.looper.synced_to is not None:
+            self.sync_combobox.setCurrentIndex(self.sync_tracks.index(self.looper.synced_to.index) + 1)
+        self.volume_slider.setValue(self.looper.synth.volume)
+        self.instrument_combobox.setCurrentIndex(self.looper.synth.program)
+        self.po_spin_box.setValue(self.looper.synth.midi_offset)
+        transform = self.looper.schedule.transform
+        self.quantize_button.setChecked(transform.quantize)
+        grids = [grid for _, grid in quantize_grids]
+        self.grid_combobox.setCurrentIndex(min(range(len(grids)),
+                                               key=lambda i: abs(grids[i] - transform.grid)))
+        self.strength_spin_box.setValue(round(transform.strength * 100))
+        self.swing_spin_box.setValue(round(transform.swing * 100))
+        self.humanize_spin_box.setValue(round(transform.humanize * 60000 / self.looper.bpm))
+        self.late_policy_combobox.setCurrentIndex(
+            [policy for _, policy in late_policies].index(self.looper.late_policy))
+        for widget in widgets:
+            widget.blockSignals(False)
+        self.update_undo_buttons()
+
+        self.looper.new_state_loaded = False
+        self.note_visualizer.set_looper(self.looper, color)
 
     def mode_change(self, state):
         '''change mode to state'''
@@ -397,87 +446,171 @@ class LooperGUI(QWidget):
             elif mode == LooperState.RECORD:
                 self.note_visualizer.clear_notes()
                 self.note_visualizer.start_anim()
-            else: #play
+            else: #play or overdub
                 self.note_visualizer.start_anim()
                 self.note_visualizer.plot_schedule()
+            self.update_undo_buttons()
+
+    def update_undo_buttons(self):
+        '''enable undo and redo if the track has a take to undo or redo'''
+        self.undo_button.setEnabled(self.looper.can_undo())
+        self.redo_button.setEnabled(self.looper.can_redo())
+
+    def undo(self):
+        '''undo the last take, update visualizer'''
+        self.looper.undo()
+        self.note_visualizer.plot_schedule()
+        self.update_undo_buttons()
+
+    def redo(self):
+        '''redo the last undone take, update visualizer'''
+        self.looper.redo()
+        self.note_visualizer.plot_schedule()
+        self.update_undo_buttons()
 
     def set_bpm(self):
         '''set bpm, update looper and visualizer'''
         self.looper.set_bpm(self.bpm_spin_box.value())
         self.note_visualizer.plot_schedule()
-        self.note_visualizer.bpm = self.bpm_spin_box.value()
-        self.note_visualizer.repaint()
         self.unsync()
 
+    def show_bpl(self):
+        '''shows the beats per loop of the looper, the spin box goes up to it
+           if the loop is longer than max_bpl so it isn't clamped'''
+        self.bpl_spin_box.setMaximum(max(max_bpl, self.looper.bpl))
+        self.bpl_spin_box.setValue(self.looper.bpl)
+
     def set_bpl(self):
         '''set beats per loop, update looper and visualizer'''
         self.looper.set_bpl(self.bpl_spin_box.value())
         self.note_visualizer.plot_schedule()
-        self.note_visualizer.bpl = self.bpl_spin_box.value()
-        self.note_visualizer.repaint()
         self.unsync()
 
+    def set_volume(self, volume):
+        '''set volume of the track'''
+        self.looper.set_volume(volume)
+
+    def set_program(self, index):
+        '''set instrument of the track'''
+        self.looper.set_program(index)
+
     def set_midi_offset(self):
         '''set midi value of \'r\' key, update synth'''
         self.looper.set_midi_offset(self.po_spin_box.value())
 
     def toggle_quantize(self):
-        '''set whether to quantize recorded notes'''
+        '''set whether to quantize the notes of the loop, update visualizer'''
         self.looper.set_quantize(self.quantize_button.isChecked())
+        self.note_visualizer.plot_schedule()
+
+    def set_transform(self, **settings):
+        '''change settings of the quantize, swing and humanize transform of
+           the track, update visualizer'''
+        self.looper.set_transform(**settings)
+        self.note_visualizer.plot_schedule()
+
+    def set_grid(self, index):
+        self.set_transform(grid=quantize_grids[index][1])
+
+    def set_strength(self):
+        self.set_transform(strength=self.strength_spin_box.value() / 100)
+
+    def set_swing(self):
+        self.set_transform(swing=self.swing_spin_box.value() / 100)
+
+    def set_humanize(self):
+        '''set the humanize offsets (ms at the track's tempo) in beats'''
+        self.set_transform(humanize=self.humanize_spin_box.value() / 60000 * self.looper.bpm)
+
+    def set_late_policy(self, index):
+        self.looper.set_late_policy(late_policies[index][1])
 
     def unsync(self):
-        self.looper.is_synced = False
-        if self.synced_to_idx >= 0:
-            self.synced_to.synced_to_me.remove(self.looper)
-            self.synced_to_idx = -1
+        if self.looper.synced_to is not None:
+            self.looper.sync_to(None)
             self.sync_combobox.setCurrentIndex(0)
 
     def set_sync(self, index):
         '''sets whether to sync to another track'''
-        # unsync from previous sync track
-        if self.synced_to_idx >= 0 and self.synced_to != self.sync_tracks[index -1]:
-            self.synced_to.synced_to_me.remove(self.looper)
-        
         # sync to new one
-        if index != 0:
-            self.looper.is_synced = True
-            self.synced_to_idx = self.sync_tracks[index - 1]
-            self.synced_to = self.loopers[self.synced_to_idx]
-            # add self to synced to tracks list
-            self.synced_to.synced_to_me.append(self.looper)
-            # update own bpm, beats per loop, update schedule
-            self.looper.set_bpm(self.synced_to.bpm)
-            self.bpm_spin_box.setValue(self.synced_to.bpm)
-            self.looper.set_bpl(self.synced_to.bpl)
-            self.bpl_spin_box.setValue(self.synced_to.bpl)
-            self.looper.clock.sync(self.index, self.synced_to_idx)
+        if index > 0:
+            self.looper.sync_to(self.loopers[self.sync_tracks[index - 1]])
+            # update own bpm, beats per loop
+            self.bpm_spin_box.setValue(self.looper.bpm)
+            self.show_bpl()
             self.note_visualizer.plot_schedule()
         # no sync
-        else:
-            self.synced_to_idx = -1
-            self.looper.is_synced = False
+        elif index == 0:
+            self.looper.sync_to(None)
 
     def on_update(self):
-        '''update note visualizer, updates gui if the looper state has changed'''
-        self.note_visualizer.on_update()
-        # self.note_visualizer.on_update()
+        '''updates gui if the looper state has changed, the note visualizer
+           cursor is moved by the frame timer'''
         if self.looper.new_state_loaded:
-            self.looper.new_state_loaded = False
-
-            self.bpm_spin_box.setValue(self.looper.bpm)
-            self.bpl_spin_box.setValue(self.looper.bpl)
-
-            # self.note_visualizer.plot_schedule(self.looper.schedule)
-            self.instrument_combobox.setCurrentIndex(self.looper.synth.program)
-            self.po_spin_box.setValue(self.looper.synth.midi_offset)
-            self.volume_slider.setValue(self.looper.synth.volume)
-
-            self.note_visualizer.plot_schedule()
-            self.note_visualizer.repaint()
-            
-            
-
-
-
-
+            # replots the notes, which schedules a repaint
+            self.bind(self.index)
+
+
+class TrackListView(QAbstractScrollArea):
+    '''Scrollable list of the tracks which only has looper guis for the rows
+       in view. The guis are kept in a pool, row i is shown by gui
+       i % pool size, so scrolling by a row only binds one gui to another
+       track. Tracks out of view keep playing without a gui.
+       loopers (list): LoopingTracks of all rows
+       program_model (QStringListModel): instrument names shared by the guis
+       row_height (int): height of a row in pixels'''
+    def __init__(self, loopers, program_model=None, row_height=120, **kwargs):
+        super(TrackListView, self).__init__(**kwargs)
+        self.loopers = loopers
+        self.program_model = program_model
+        self.setFocusPolicy(Qt.NoFocus)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.pool = [] # looper guis, children of the viewport
+        self.shown_guis = [] # guis of the rows in view, updated in place
+        self.add_guis(1)
+        self.row_height = max(row_height, self.pool[0].minimumSizeHint().height())
+        self.verticalScrollBar().setSingleStep(self.row_height // 4)
+
+    def add_guis(self, n_guis):
+        '''grow the pool by n_guis looper guis'''
+        for _ in range(n_guis):
+            index = min(len(self.pool), len(self.loopers) - 1)
+            gui = LooperGUI(index, len(self.loopers), self.loopers, self.program_model)
+            gui.setParent(self.viewport())
+            gui.hide()
+            self.pool.append(gui)
 
+    def resizeEvent(self, event):
+        '''make sure the pool covers the view and update the scroll range'''
+        QAbstractScrollArea.resizeEvent(self, event)
+        height = self.viewport().height()
+        # one extra for the partly visible rows at the top and bottom
+        n_guis = min(len(self.loopers), height // self.row_height + 2)
+        if n_guis > len(self.pool):
+            self.add_guis(n_guis - len(self.pool))
+        scroll_bar = self.verticalScrollBar()
+        scroll_bar.setRange(0, max(0, len(self.loopers) * self.row_height - height))
+        scroll_bar.setPageStep(height)
+        self.layout_rows()
+
+    def scrollContentsBy(self, dx, dy):
+        self.layout_rows()
+
+    def layout_rows(self):
+        '''moves the guis to the rows in view, binding them to their tracks'''
+        scroll = self.verticalScrollBar().value()
+        width = self.viewport().width()
+        first = scroll // self.row_height
+        last = min(len(self.loopers), (scroll + self.viewport().height()) // self.row_height + 1)
+        shown_guis = []
+        for index in range(first, last):
+            gui = self.pool[index % len(self.pool)]
+            if gui.index != index:
+                gui.bind(index)
+            gui.setGeometry(0, index * self.row_height - scroll, width, self.row_height)
+            gui.show()
+            shown_guis.append(gui)
+        for gui in self.pool:
+            if gui not in shown_guis:
+                gui.hide()
+        self.shown_guis[:] = shown_guis
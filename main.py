@@ -1,17 +1,29 @@
+import time
+startup_start = time.perf_counter() # used by the startup report
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QHBoxLayout,
                               QVBoxLayout, QWidget, QLabel, QStackedLayout,
-                                QPushButton, QFileDialog)
+                                QPushButton, QFileDialog, QSpinBox)
 from PyQt5.QtGui import QPalette, QColor
-from PyQt5.QtCore import Qt, QObject, QThread, pyqtSignal
-from synth_wrapper import SynthWrapper
-from looper import LooperGUI, LoopingTrack
-from clock import Clock
-import yaml
+from PyQt5.QtCore import Qt, QObject, QThread, QTimer, QStringListModel, pyqtSignal
+from synth_wrapper import SynthWrapper, SynthEngine, get_program_selector
+from looper import LooperGUI, TrackListView
+from track import LoopingTrack
+from clock import Clock, SchedulerThread, LatePolicy
+from session import load_session, save_session
+from journal import RecordingJournal, lock_journal, replay_journal
+from metrics import TimingMetrics
+from input_router import InputRouter
+from freeze import FreezeManager
+from engine_process import EngineProcess, RemoteClock, RemoteSynth
+from transport import TransportLeader, TransportFollower, default_address, default_port
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import sys
-import time
 import os
+import argparse
 
 ticks_per_second = 1024
+virtual_tracks_after = 8 # more tracks than this are shown in a scrolling list
 
 # maps key on keyboard to pitch (on initiate this is offset by 60 so 
 # 'r' is middle C)
@@ -176,8 +188,11 @@ class ControlPanel(QWidget):
        save_function (function): a function with single string argument to
                     be called on saving
        sync_function (function): a function with no arguments to be called 
-                    on sync button press'''
-    def __init__(self, load_function, save_function, sync_function, metronome_function):
+                    on sync button press
+       latency_function (function): a function with the latency compensation
+                    in ms as argument, -1 for the estimate from the audio driver'''
+    def __init__(self, load_function, save_function, sync_function, metronome_function,
+                 latency_function):
         super(ControlPanel, self).__init__()
 
         #put buttons in horizontal layout
@@ -198,6 +213,13 @@ class ControlPanel(QWidget):
         self.metronome_button.setCheckable(True)
         self.metronome_button.clicked.connect(self.toggle_metronome)
         self.layout.addWidget(self.metronome_button)
+
+        self.latency_spin_box = QSpinBox(minimum=-1, maximum=500, value=-1)
+        self.latency_spin_box.setPrefix("Latency Compensation: ")
+        self.latency_spin_box.setSuffix(" ms")
+        self.show_estimated_latency(None)
+        self.latency_spin_box.valueChanged.connect(latency_function)
+        self.layout.addWidget(self.latency_spin_box)
         self.setLayout(self.layout)
 
         self.load_function = load_function
@@ -219,6 +241,18 @@ class ControlPanel(QWidget):
         '''set whether to quantize recorded notes'''
         self.metronome_function(self.metronome_button.isChecked())
 
+    def show_estimated_latency(self, latency):
+        '''show latency (s) estimated from the audio driver as the auto value'''
+        if latency is None:
+            self.latency_spin_box.setSpecialValueText("Latency Compensation: Auto")
+        else:
+            self.latency_spin_box.setSpecialValueText(
+                "Latency Compensation: Auto (%d ms)" % round(latency * 1000))
+
+    def set_latency(self, latency_ms):
+        '''set the latency compensation in ms, -1 for auto'''
+        self.latency_spin_box.setValue(latency_ms)
+
     def save_file(self):
         '''Opens a file dialog to pick a filename to save to and calls the 
            save function'''
@@ -232,6 +266,47 @@ class ControlPanel(QWidget):
 
 
         
+class MetricsOverlay(QLabel):
+    '''Label drawn over the top right corner of the window which shows the
+       timing metrics
+       metrics (TimingMetrics): metrics to show'''
+    def __init__(self, metrics, parent):
+        super(MetricsOverlay, self).__init__(parent)
+        self.metrics = metrics
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.setStyleSheet("background-color: rgba(0, 0, 0, 160); color: white;"
+                           "font-family: monospace; padding: 4px;")
+        self.on_update()
+
+    def on_update(self):
+        '''show the current metrics'''
+        self.setText(self.metrics.summary_text())
+        self.adjustSize()
+        self.move(self.parent().width() - self.width() - 10, 10)
+        self.raise_()
+
+
+class StartupReport(object):
+    '''Records how long each phase of startup took
+       start (float): time.perf_counter() time at which startup began'''
+    def __init__(self, start):
+        super(StartupReport, self).__init__()
+        self.start = start
+        self.marks = []
+        self.lock = threading.Lock()
+
+    def mark(self, label):
+        '''record that the phase called label just finished'''
+        with self.lock:
+            self.marks.append((label, time.perf_counter() - self.start))
+
+    def report(self):
+        '''returns the report as a string'''
+        with self.lock:
+            return "\n".join("%-24s %8.1f ms" % (label, elapsed * 1000)
+                             for label, elapsed in self.marks)
+
+
 class ThreadSupervisor(QObject):
     '''Calls the main window on_update function'''
     update_signal = pyqtSignal()
@@ -246,20 +321,75 @@ class ThreadSupervisor(QObject):
 class MainWindow(QMainWindow):
     '''The main window of the GUI, contains all other GUI objects and the main
       on_update function'''
-    def __init__(self, n_tracks, **kwargs):
+    latency_estimated = pyqtSignal(float) # from the loading threads to the gui thread
+
+    def __init__(self, n_tracks, realtime=False, granularity=0.005,
+                 shared_engine=False, startup_report=None, journal_path=None,
+                 max_fps=None, metrics_overlay=False, metrics_csv=None,
+                 deadline=0.005, virtual_tracks=False, latency=None, freeze_cache=None,
+                 engine_process=False, late_policy=LatePolicy.PLAY_ALL, late_threshold=0.05,
+                 transport=None, transport_address=default_address, transport_port=default_port,
+                 **kwargs):
         super(MainWindow, self).__init__(**kwargs)
         self.resize(900, 600)
         self.n_tracks = int(n_tracks) # number of tracks
         self.synths = [] # synths for each looper
-        self.down_keys = [] # used to avoid multiple triggers per key event
-
-        # create synths for all the tracks
-        for i in range(self.n_tracks):
-            self.synths.append(SynthWrapper("./data/FluidR3_GM.sf2",
-                                             "./data/fluid_synth_programs.txt"))
 
-        # initialize clock
-        self.clock = Clock(self.n_tracks, self.synths, ticks_per_second)
+        # with a shared engine the tracks are MIDI channels of one synth
+        self.engine = None
+        if shared_engine and not engine_process:
+            self.engine = SynthEngine("./data/FluidR3_GM.sf2")
+
+        # the clock and synths may run in their own process, which the
+        # tracks send their changes to
+        self.engine_process = None
+        self.engine_ready = False
+        if engine_process:
+            self.engine_process = EngineProcess(self.n_tracks, "./data/FluidR3_GM.sf2",
+                                                "./data/fluid_synth_programs.txt",
+                                                shared_engine, granularity, deadline)
+            for i in range(self.n_tracks):
+                self.synths.append(RemoteSynth(self.engine_process, i,
+                                               "./data/fluid_synth_programs.txt"))
+            metro_synth = RemoteSynth(self.engine_process, "metronome",
+                                      "./data/fluid_synth_programs.txt")
+            self.clock = RemoteClock(self.engine_process, self.n_tracks, self.synths,
+                                     ticks_per_second, metro_synth)
+        else:
+            # create synths for all the tracks, the soundfonts are loaded in
+            # the background so the window can open before audio is ready
+            for i in range(self.n_tracks):
+                self.synths.append(SynthWrapper("./data/FluidR3_GM.sf2",
+                                                 "./data/fluid_synth_programs.txt",
+                                                 self.engine, load=False))
+            metro_synth = SynthWrapper("./data/FluidR3_GM.sf2",
+                                       "./data/fluid_synth_programs.txt",
+                                       self.engine, load=False)
+
+            # initialize clock
+            self.clock = Clock(self.n_tracks, self.synths, ticks_per_second,
+                               self.engine, metro_synth)
+        self.metrics = TimingMetrics(deadline)
+        self.clock.metrics = self.metrics
+        self.metrics_csv = metrics_csv
+        # what the clock does with notes it is too late for after a stall
+        self.clock.set_late_policy(late_policy, late_threshold)
+
+        # recorded notes are moved earlier by the output latency, estimated
+        # from the audio driver unless it is set for the session
+        self.estimated_latency = 0.0
+        self.latency_override = None
+        self.default_latency_ms = -1 if latency is None else round(latency * 1000)
+        self.latency_estimated.connect(self.on_latency_estimated)
+
+        self.startup_report = startup_report
+        # the engine process loads its own synths
+        if self.engine_process is None:
+            self.load_synths(self.synths + [metro_synth])
+
+        # instrument names shared by all the looper guis
+        self.program_model = QStringListModel(
+            get_program_selector("./data/fluid_synth_programs.txt").get_program_names())
 
         # initialize loopers
         self.loopers = []
@@ -269,22 +399,56 @@ class MainWindow(QMainWindow):
 
         # initialize control pane widget
         self.control_widget = ControlPanel(self.load_file, self.save_file,
-                                            self.sync_tracks, self.set_metronome)
+                                            self.sync_tracks, self.set_metronome,
+                                            self.set_latency_override)
+        self.control_widget.set_latency(self.default_latency_ms)
         self.layout.addWidget(self.control_widget, stretch=0.5)
 
-        # create the loopers and their GUIS
+        # create the loopers
         for i in range(self.n_tracks):
             self.loopers.append(LoopingTrack(i, self.synths[i], self.clock))
-            gui = LooperGUI(i, self.n_tracks, self.loopers)
-            self.looper_guis.append(gui)
-            self.layout.addWidget(gui, stretch = 1)
+        # with many tracks only the rows in view of a scrolling list have guis
+        if virtual_tracks or self.n_tracks > virtual_tracks_after:
+            self.track_list = TrackListView(self.loopers, self.program_model)
+            self.looper_guis = self.track_list.shown_guis
+            self.layout.addWidget(self.track_list, stretch = 4)
+        # otherwise create a GUI for each looper
+        else:
+            for i in range(self.n_tracks):
+                gui = LooperGUI(i, self.n_tracks, self.loopers, self.program_model)
+                self.looper_guis.append(gui)
+                self.layout.addWidget(gui, stretch = 1)
+
+        # recover the tracks from the journal left by a crash, then start a new one
+        self.journal = None
+        if journal_path is not None:
+            lock_file = lock_journal(journal_path)
+            if lock_file is None:
+                # another looper is using the journal, it isn't a crash
+                journal_path = "%s.%d" % (journal_path, os.getpid())
+                print("Journal in use by another looper, using", journal_path)
+            elif os.path.exists(journal_path):
+                self.recover_journal(journal_path)
+            self.journal = RecordingJournal(journal_path, lock_file=lock_file)
+            for looper in self.loopers:
+                looper.journal = self.journal
+                self.journal.log_state(looper.index, looper.get_state())
+            self.journal.start()
 
         # create piano widget
         self.piano_widget = PianoWidget()
+        # key presses go to the recording loopers
+        self.input_router = InputRouter(self.loopers, keymap, self.clock.time_func,
+                                        self.piano_widget.set_key_press)
         self.layout.addWidget(self.piano_widget, stretch = 1)
         self.widget.setLayout(self.layout)
         self.setCentralWidget(self.widget)
 
+        # timing metrics drawn over the window
+        self.metrics_overlay = None
+        if metrics_overlay:
+            self.metrics_overlay = MetricsOverlay(self.metrics, self)
+
         # Create thread for on_update function
         self.thread = QThread()
         self.thread_supervisor = ThreadSupervisor(self.on_update)
@@ -293,49 +457,158 @@ class MainWindow(QMainWindow):
         self.thread_supervisor.update_signal.connect(self.on_update)
         self.thread.start()
 
+        # cursors are moved at the display refresh rate, capped by max_fps
+        fps = QApplication.primaryScreen().refreshRate() or 60
+        if max_fps is not None:
+            fps = min(fps, max_fps)
+        self.frame_timer = QTimer(self)
+        self.frame_timer.setTimerType(Qt.PreciseTimer)
+        self.frame_timer.timeout.connect(self.on_frame)
+        self.frame_timer.start(int(1000 / fps))
+
+        # loops which play unchanged are rendered once and played from a buffer
+        self.freezer = None
+        if freeze_cache is not None and self.engine_process is not None:
+            print("Freezing loops isn't supported with the engine process, playing them live")
+        elif freeze_cache is not None:
+            self.freezer = FreezeManager(self.clock, self.loopers, "./data/FluidR3_GM.sf2",
+                                         "./data/fluid_synth_programs.txt", freeze_cache)
+            try:
+                self.freezer.start()
+            except ImportError:
+                print("Freezing loops needs the sounddevice package, playing them live")
+                self.freezer.stop()
+                for looper in self.loopers:
+                    looper.freezer = None
+                self.freezer = None
+
+        # the transport is shared with loopers in other processes or on other
+        # machines, this window leads with its first track or follows
+        self.transport_leader = None
+        self.transport_follower = None
+        if transport == "lead":
+            self.transport_leader = TransportLeader(self.clock, self.loopers[0],
+                                                    transport_address, transport_port)
+            self.transport_leader.start()
+        elif transport == "follow":
+            self.transport_follower = TransportFollower(self.clock, self.loopers, transport_port)
+            self.transport_follower.start()
+
+        # real time scheduler plays the notes instead of the gui thread
+        self.scheduler = None
+        if realtime and self.engine_process is None:
+            self.scheduler = SchedulerThread(self.clock, granularity)
+            self.scheduler.start()
+
+    def load_synths(self, synths):
+        '''Loads synths in parallel on background threads'''
+        self.synths_loading = len(synths)
+        self.synths_loading_lock = threading.Lock()
+        executor = ThreadPoolExecutor(max_workers=min(8, len(synths)))
+        for synth in synths:
+            executor.submit(synth.load).add_done_callback(self.on_synth_loaded)
+        executor.shutdown(wait=False)
+
+    def on_synth_loaded(self, future):
+        '''Called from the loading threads when a synth is done loading'''
+        if future.exception() is not None:
+            print("Failed to load synth:", future.exception())
+        with self.synths_loading_lock:
+            self.synths_loading -= 1
+            done = self.synths_loading == 0
+        if done:
+            latency = self.clock.metro_synth.output_latency()
+            if latency is not None:
+                self.latency_estimated.emit(latency)
+        if done and self.startup_report is not None:
+            self.startup_report.mark("audio ready")
+            print(self.startup_report.report())
+
+    def poll_engine(self):
+        '''Shows the metrics of the engine process, once its synths are
+          loaded uses its latency estimate'''
+        snapshot = self.engine_process.poll()
+        if snapshot is None:
+            return
+        self.metrics.load_dispatch_state(snapshot["metrics"])
+        if not self.engine_ready:
+            self.engine_ready = True
+            if snapshot["latency"] is not None:
+                self.on_latency_estimated(snapshot["latency"])
+            if self.startup_report is not None:
+                self.startup_report.mark("audio ready")
+                print(self.startup_report.report())
+
+    def on_latency_estimated(self, latency):
+        '''Uses the output latency estimated from the audio driver unless the
+          session overrides it'''
+        self.estimated_latency = latency
+        if self.freezer is not None:
+            self.freezer.player.synth_latency = latency
+        self.control_widget.show_estimated_latency(latency)
+        self.apply_latency()
+
+    def set_latency_override(self, latency_ms):
+        '''Sets the latency compensation of the session in ms, -1 to use the
+          estimate'''
+        self.latency_override = None if latency_ms < 0 else latency_ms / 1000
+        self.apply_latency()
+
+    def apply_latency(self):
+        '''Sets the latency compensation of the clock'''
+        if self.latency_override is None:
+            self.clock.latency_compensation = self.estimated_latency
+        else:
+            self.clock.latency_compensation = self.latency_override
+
     def keyPressEvent(self, event):
-        '''Sends a key down to each of the loopers if it is the first instance
-          of the key down'''
+        '''Sends a key down to the recording loopers with the time of the
+          event'''
         if event.isAutoRepeat():
             return
-        # only go off the first time
-        if not event.key() in self.down_keys and event.text() in keymap:            
-            self.down_keys.append(event.key())
-            for i in range(self.n_tracks):
-                self.loopers[i].on_keystroke(keymap[event.text()], True)
-                self.piano_widget.set_key_press(keymap[event.text()], True)
-
+        self.input_router.key_event(event.key(), event.text(), event.timestamp(), True)
 
     def keyReleaseEvent(self, event):
-        '''Sends a key up to each of the loopers if it is the first instance
-          of key up after a key down'''
+        '''Sends a key up to the recording loopers with the time of the
+          event'''
         if event.isAutoRepeat():
             return
-        if event.key() in self.down_keys and event.text() in keymap:
-            self.down_keys.remove(event.key())
-
-            for i in range(self.n_tracks):
-                self.loopers[i].on_keystroke(keymap[event.text()], False)
-                self.piano_widget.set_key_press(keymap[event.text()], False)
+        self.input_router.key_event(event.key(), event.text(), event.timestamp(), False)
 
     def load_file(self, filename):
-        '''Loads schedules from yaml file at filename and sends them to the
-          looper GUIs'''
-        load_file = open(filename, 'r')
-        load_dict = yaml.safe_load(load_file)
-        for i in range(len(load_dict.keys())):
-            if i < self.n_tracks:
+        '''Loads schedules from binary or yaml file at filename and sends them
+          to the looper GUIs, only the tracks we have are read'''
+        load_dict = load_session(filename)
+        for i in range(self.n_tracks):
+            if i in load_dict:
                 self.loopers[i].load_from_state(load_dict[i])
+        self.control_widget.set_latency(
+            load_dict.metadata.get("latency_compensation_ms", self.default_latency_ms))
 
 
     def save_file(self, filename):
-        '''Saves current looper states in yaml file with given filename'''
-        save_file = open(filename, 'w')
+        '''Saves current looper states in file with given filename, yaml if
+          it ends in .yaml or .yml and binary otherwise'''
         out_dict = {} 
         for i in range(self.n_tracks):
             out_dict[i] = self.loopers[i].get_state()
-        yaml.dump(out_dict, save_file)
-        save_file.close()
+        metadata = {}
+        if self.latency_override is not None:
+            metadata["latency_compensation_ms"] = round(self.latency_override * 1000)
+        save_session(filename, out_dict, metadata)
+
+    def recover_journal(self, journal_path):
+        '''Loads the tracks from the journal at journal_path, takes that were
+          recorded over are saved next to it so they can be loaded'''
+        states, discarded = replay_journal(journal_path)
+        for i in range(self.n_tracks):
+            if i in states:
+                self.loopers[i].load_from_state(states[i])
+        print("Recovered %d tracks from %s" % (len(states), journal_path))
+        if discarded:
+            save_session(journal_path + ".discarded", discarded)
+            print("Takes that were recorded over were saved to %s.discarded"
+                  % journal_path)
 
     def sync_tracks(self):
         '''Resets offsets for each track so they all start playing together'''
@@ -346,9 +619,45 @@ class MainWindow(QMainWindow):
 
     def on_update(self):
         '''Triggers on_update for clock and all looper guis'''
-        self.clock.on_update()
+        if self.engine_process is not None:
+            self.poll_engine()
+        elif self.scheduler is None:
+            self.clock.on_update()
         for looper_gui in self.looper_guis:
             looper_gui.on_update()
+        if self.metrics_overlay is not None:
+            self.metrics_overlay.on_update()
+        if self.freezer is not None:
+            self.freezer.on_update()
+        if self.transport_follower is not None:
+            self.transport_follower.on_update()
+
+    def on_frame(self):
+        '''Moves the cursors of all note visualizers'''
+        for looper_gui in self.looper_guis:
+            looper_gui.note_visualizer.on_frame()
+
+    def closeEvent(self, event):
+        '''Stops the real time scheduler and prints its jitter stats'''
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            print("Scheduler jitter:", self.scheduler.stats.summary())
+        if self.engine_process is not None:
+            snapshot = self.engine_process.stop()
+            if snapshot is not None:
+                self.metrics.load_dispatch_state(snapshot["metrics"])
+                print("Scheduler jitter:", snapshot["jitter"])
+        if self.metrics_csv is not None:
+            self.metrics.export_csv(self.metrics_csv)
+        if self.freezer is not None:
+            self.freezer.stop()
+        for transport in (self.transport_leader, self.transport_follower):
+            if transport is not None:
+                transport.stop()
+        # clean exit, nothing to recover
+        if self.journal is not None:
+            self.journal.close()
+        QMainWindow.closeEvent(self, event)
 
 
 
@@ -357,7 +666,81 @@ class MainWindow(QMainWindow):
 
 if __name__ == "__main__":
     # pass in how many tracks with command line argument
+    parser = argparse.ArgumentParser(description="Loop Station")
+    parser.add_argument("n_tracks", type=int, help="number of tracks")
+    parser.add_argument("--realtime", action="store_true",
+                        help="play notes from a dedicated scheduler thread")
+    parser.add_argument("--granularity", type=float, default=5,
+                        help="longest sleep of the scheduler thread in ms")
+    parser.add_argument("--shared-engine", action="store_true",
+                        help="play all tracks on MIDI channels of one shared synth")
+    parser.add_argument("--startup-report", action="store_true",
+                        help="print how long each phase of startup took")
+    parser.add_argument("--journal", default="./loop_station.journal",
+                        help="crash recovery journal, recovered on startup if it exists")
+    parser.add_argument("--no-journal", action="store_true",
+                        help="don't keep a crash recovery journal")
+    parser.add_argument("--max-fps", type=float, default=None,
+                        help="cap the frame rate of the cursor animation")
+    parser.add_argument("--metrics-overlay", action="store_true",
+                        help="show timing metrics over the window")
+    parser.add_argument("--metrics-csv", default=None,
+                        help="export timing metrics to this csv file on exit")
+    parser.add_argument("--virtual-tracks", action="store_true",
+                        help="show the tracks in a scrolling list which only creates guis for "
+                             "the tracks in view (always used above %d tracks)" % virtual_tracks_after)
+    parser.add_argument("--latency", type=float, default=None,
+                        help="ms recorded notes are moved earlier to make up for the audio output "
+                             "latency, estimated from the audio driver by default")
+    parser.add_argument("--freeze", action="store_true",
+                        help="play loops which repeat unchanged from a rendered buffer instead of "
+                             "the synth (needs sounddevice)")
+    parser.add_argument("--freeze-cache", type=float, default=256,
+                        help="MB of memory for the rendered loops")
+    parser.add_argument("--deadline", type=float, default=5,
+                        help="ms an event may be late before it counts as a deadline miss")
+    parser.add_argument("--engine-process", action="store_true",
+                        help="run the clock and synths in their own process so the gui can't "
+                             "delay playback")
+    parser.add_argument("--late-policy", default="play-all",
+                        choices=[policy.option for policy in LatePolicy],
+                        help="what to do with notes which are more than --late-threshold late "
+                             "when the clock wakes up late")
+    parser.add_argument("--late-threshold", type=float, default=50,
+                        help="ms a note may be late before the late policy applies")
+    parser.add_argument("--transport", default=None, choices=["lead", "follow"],
+                        help="share the transport with loopers in other processes or on other "
+                             "machines over UDP, as the leader or a follower")
+    parser.add_argument("--transport-address", default=default_address,
+                        help="address the leader sends the transport to (default broadcast)")
+    parser.add_argument("--transport-port", type=int, default=default_port,
+                        help="UDP port of the transport")
+    args = parser.parse_args()
+    startup_report = None
+    if args.startup_report:
+        startup_report = StartupReport(startup_start)
+        startup_report.mark("imports")
     app = QApplication([])
-    window = MainWindow(sys.argv[1])
+    window = MainWindow(args.n_tracks, realtime=args.realtime,
+                        granularity=args.granularity / 1000,
+                        shared_engine=args.shared_engine,
+                        startup_report=startup_report,
+                        journal_path=None if args.no_journal else args.journal,
+                        max_fps=args.max_fps,
+                        metrics_overlay=args.metrics_overlay,
+                        metrics_csv=args.metrics_csv,
+                        deadline=args.deadline / 1000,
+                        virtual_tracks=args.virtual_tracks,
+                        latency=None if args.latency is None else args.latency / 1000,
+                        freeze_cache=int(args.freeze_cache * 2 ** 20) if args.freeze else None,
+                        engine_process=args.engine_process,
+                        late_policy=LatePolicy.from_option(args.late_policy),
+                        late_threshold=args.late_threshold / 1000,
+                        transport=args.transport,
+                        transport_address=args.transport_address,
+                        transport_port=args.transport_port)
     window.show()
+    if startup_report is not None:
+        startup_report.mark("window shown")
+        print(startup_report.report())
     app.exec()
\ No newline at end of file
@@ -0,0 +1,149 @@
+import bisect
+import csv
+
+# upper bounds of the histogram buckets in seconds, from 10 us to about 10 s
+# with two buckets per doubling
+bucket_bounds = [1e-5 * 2 ** (i / 2) for i in range(41)]
+
+
+class LatencyHistogram(object):
+    '''Histogram of latencies in seconds with log spaced buckets. Adding a
+       sample only increments counters, so the writing thread (the clock or
+       the gui) never waits on a lock. Readers may see a sample half added,
+       which is fine for statistics.'''
+    def __init__(self):
+        super(LatencyHistogram, self).__init__()
+        self.counts = [0] * (len(bucket_bounds) + 1) # last bucket is overflow
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        '''add a sample in seconds, negative samples (early) count as 0'''
+        latency = max(0.0, latency)
+        self.counts[bisect.bisect_left(bucket_bounds, latency)] += 1
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+
+    def get_state(self):
+        '''the counters as a dict, to copy the histogram to another process'''
+        return {"counts": list(self.counts), "count": self.count,
+                "total": self.total, "max": self.max}
+
+    def load_from_state(self, state):
+        '''replaces the counters with those of get_state'''
+        self.counts = list(state["counts"])
+        self.count = state["count"]
+        self.total = state["total"]
+        self.max = state["max"]
+
+    def percentile(self, fraction):
+        '''upper bound in seconds of the bucket holding the given fraction of
+           samples, e.g. 0.99'''
+        target = fraction * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target and cumulative > 0:
+                return bucket_bounds[i] if i < len(bucket_bounds) else self.max
+        return 0.0
+
+    def summary(self):
+        '''dict with count, mean, max, median and 99th percentile in ms'''
+        mean = self.total / self.count if self.count else 0.0
+        return {"count": self.count,
+                "mean_ms": mean * 1000,
+                "max_ms": self.max * 1000,
+                "p50_ms": self.percentile(0.5) * 1000,
+                "p99_ms": self.percentile(0.99) * 1000}
+
+
+class TimingMetrics(object):
+    '''Timing of the looper: how late each event went out compared to its
+       scheduled time, latency from key press to the synth command, the
+       number of events per track which missed the deadline and the number
+       dropped by the late policy of the clock (see LatePolicy)
+       deadline (float): seconds an event may be late before it is a miss'''
+    def __init__(self, deadline=0.005):
+        super(TimingMetrics, self).__init__()
+        self.deadline = deadline
+        self.dispatch_lateness = LatencyHistogram()
+        self.keystroke_latency = LatencyHistogram()
+        self.dispatched = {} # track -> number of events dispatched
+        self.deadline_misses = {} # track -> number of events later than deadline
+        self.dropped = {} # track -> number of late events which were not played
+
+    def record_dispatches(self, track, lateness):
+        '''record events of track which went out lateness seconds (iterable)
+           after their scheduled time'''
+        misses = 0
+        n_events = 0
+        for late in lateness:
+            self.dispatch_lateness.add(late)
+            n_events += 1
+            if late > self.deadline:
+                misses += 1
+        self.dispatched[track] = self.dispatched.get(track, 0) + n_events
+        if misses:
+            self.deadline_misses[track] = self.deadline_misses.get(track, 0) + misses
+
+    def record_dropped(self, track, n_events):
+        '''record n_events events of track which were too late to be played'''
+        if n_events:
+            self.dropped[track] = self.dropped.get(track, 0) + n_events
+
+    def record_keystroke(self, latency):
+        '''record seconds between a key press and its synth command'''
+        self.keystroke_latency.add(latency)
+
+    def get_dispatch_state(self):
+        '''the dispatch counters as a dict, for the metrics of a clock in
+           another process'''
+        return {"lateness": self.dispatch_lateness.get_state(),
+                "dispatched": dict(self.dispatched),
+                "deadline_misses": dict(self.deadline_misses),
+                "dropped": dict(self.dropped)}
+
+    def load_dispatch_state(self, state):
+        '''replaces the dispatch counters with those of get_dispatch_state'''
+        self.dispatch_lateness.load_from_state(state["lateness"])
+        self.dispatched = dict(state["dispatched"])
+        self.deadline_misses = dict(state["deadline_misses"])
+        self.dropped = dict(state.get("dropped", {}))
+
+    def summary(self):
+        '''dict of the dispatch and keystroke summaries and per track misses'''
+        return {"dispatch": self.dispatch_lateness.summary(),
+                "keystroke": self.keystroke_latency.summary(),
+                "deadline_misses": dict(self.deadline_misses),
+                "dropped": dict(self.dropped)}
+
+    def summary_text(self):
+        '''short multi line summary for the overlay'''
+        dispatch = self.dispatch_lateness.summary()
+        keystroke = self.keystroke_latency.summary()
+        return ("dispatch late: mean %.2f ms  p99 %.2f ms  max %.2f ms\n"
+                "key to note:   mean %.2f ms  p99 %.2f ms  max %.2f ms\n"
+                "deadline misses: %d of %d events, %d dropped"
+                % (dispatch["mean_ms"], dispatch["p99_ms"], dispatch["max_ms"],
+                   keystroke["mean_ms"], keystroke["p99_ms"], keystroke["max_ms"],
+                   sum(self.deadline_misses.values()), sum(self.dispatched.values()),
+                   sum(self.dropped.values())))
+
+    def export_csv(self, filename):
+        '''writes the histograms and per track counts to a csv file'''
+        with open(filename, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(["metric", "key", "value"])
+            for name, histogram in (("dispatch_lateness", self.dispatch_lateness),
+                                    ("keystroke_latency", self.keystroke_latency)):
+                for key, value in histogram.summary().items():
+                    writer.writerow([name, key, value])
+                for bound, count in zip(bucket_bounds + [float("inf")], histogram.counts):
+                    writer.writerow([name, "bucket_le_ms_%g" % (bound * 1000), count])
+            for track in sorted(set(self.dispatched) | set(self.dropped)):
+                writer.writerow(["dispatched", track, self.dispatched.get(track, 0)])
+                writer.writerow(["deadline_misses", track, self.deadline_misses.get(track, 0)])
+                writer.writerow(["dropped", track, self.dropped.get(track, 0)])
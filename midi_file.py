@@ -0,0 +1,239 @@
+import struct
+import numpy as np
+from synth_wrapper import get_program_selector
+from transforms import played_beats
+
+# Standard MIDI Files: a header chunk then one chunk per track, each a list of
+# events with variable length delta times in ticks (division ticks per beat)
+header_magic = b"MThd"
+track_magic = b"MTrk"
+chunk_struct = struct.Struct(">4sI")
+header_struct = struct.Struct(">HHH") # format, number of tracks, division
+midi_extensions = (".mid", ".midi")
+
+default_division = 480 # ticks per beat of exported files
+default_tempo = 500000 # microseconds per beat, 120 bpm
+drum_channel = 9
+drum_bank = 128
+default_midi_offset = 60 # imported pitches are relative to middle C
+default_volume = 60
+
+# number of data bytes of the channel messages, by the high nibble of the status
+channel_data_lengths = {0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2}
+
+
+def is_midi_file(filename):
+    '''whether filename starts with the Standard MIDI File header'''
+    with open(filename, 'rb') as midi_file:
+        return midi_file.read(len(header_magic)) == header_magic
+
+
+def read_chunks(midi_file):
+    '''yields (kind, data) of the chunks of midi_file one at a time'''
+    while True:
+        header = midi_file.read(chunk_struct.size)
+        if len(header) < chunk_struct.size:
+            return
+        kind, length = chunk_struct.unpack(header)
+        yield kind, midi_file.read(length)
+
+
+def parse_track(data):
+    '''parses the events of a track chunk, returns (notes, tempo, beats per
+       bar, programs): notes maps channel -> (ticks, pitches, on_offs) lists,
+       tempo is the first tempo in microseconds per beat or None, beats per
+       bar from the first time signature or None and programs maps channel
+       -> first program number'''
+    notes = {}
+    programs = {}
+    tempo = None
+    beats_per_bar = None
+    tick = 0
+    position = 0
+    status = 0
+    end = len(data)
+    while position < end:
+        # variable length delta time, 7 bits per byte
+        delta = 0
+        while True:
+            byte = data[position]
+            position += 1
+            delta = (delta << 7) | (byte & 0x7F)
+            if byte < 0x80:
+                break
+        tick += delta
+        byte = data[position]
+        # meta and sysex events, they don't change the running status
+        if byte == 0xFF or byte == 0xF0 or byte == 0xF7:
+            position += 1
+            if byte == 0xFF:
+                meta_type = data[position]
+                position += 1
+            length = 0
+            while True:
+                length_byte = data[position]
+                position += 1
+                length = (length << 7) | (length_byte & 0x7F)
+                if length_byte < 0x80:
+                    break
+            if byte == 0xFF:
+                if meta_type == 0x51 and tempo is None:
+                    tempo = int.from_bytes(data[position:position + 3], "big")
+                elif meta_type == 0x58 and beats_per_bar is None:
+                    # numerator and denominator as a power of 2, in quarter notes
+                    beats_per_bar = data[position] * 4 / 2 ** data[position + 1]
+                elif meta_type == 0x2F:
+                    break
+            position += length
+            continue
+        if byte >= 0x80:
+            status = byte
+            position += 1
+        # else running status, the previous status is repeated
+        kind = status & 0xF0
+        channel = status & 0x0F
+        if kind not in channel_data_lengths:
+            raise ValueError("the event at byte %d of a track has no channel status byte" % position)
+        if kind == 0x90 or kind == 0x80:
+            pitch = data[position]
+            # note on with velocity 0 is a note off
+            on = kind == 0x90 and data[position + 1] > 0
+            if channel not in notes:
+                notes[channel] = ([], [], [])
+            channel_notes = notes[channel]
+            channel_notes[0].append(tick)
+            channel_notes[1].append(pitch)
+            channel_notes[2].append(on)
+        elif kind == 0xC0 and channel not in programs:
+            programs[channel] = data[position]
+        position += channel_data_lengths[kind]
+    return notes, tempo, beats_per_bar, programs
+
+
+def read_midi_file(filename, program_filepath="./data/fluid_synth_programs.txt"):
+    '''Reads a Standard MIDI File, returns mapping of track index -> state
+       dict (see LoopingTrack.get_state). Every channel of every track with
+       notes becomes a track, in order. The loop is the length of the file
+       rounded up to whole bars, at the first tempo of the file.'''
+    channel_notes = [] # (channel, program, notes) for every track and channel
+    tempo = None
+    beats_per_bar = None
+    with open(filename, 'rb') as midi_file:
+        chunks = read_chunks(midi_file)
+        kind, data = next(chunks, (None, b""))
+        if kind != header_magic:
+            raise ValueError("%s is not a Standard MIDI File" % filename)
+        _, _, division = header_struct.unpack_from(data)
+        if division & 0x8000:
+            raise ValueError("%s uses SMPTE time, only ticks per beat are supported" % filename)
+        # read the tracks one chunk at a time
+        for kind, data in chunks:
+            if kind != track_magic:
+                continue # unknown chunks are skipped
+            try:
+                notes, track_tempo, track_beats_per_bar, programs = parse_track(data)
+            except IndexError:
+                raise ValueError("%s has a track which ends in the middle of an event" % filename)
+            except ValueError as error:
+                raise ValueError("%s is not a valid Standard MIDI File, %s" % (filename, error))
+            tempo = tempo or track_tempo
+            beats_per_bar = beats_per_bar or track_beats_per_bar
+            for channel in sorted(notes.keys()):
+                channel_notes.append((channel, programs.get(channel, 0), notes[channel]))
+
+    bpm = round(60e6 / (tempo or default_tempo))
+    beats_per_bar = beats_per_bar or 4
+    program_selector = get_program_selector(program_filepath)
+    states = {}
+    for track, (channel, program, (ticks, pitches, on_offs)) in enumerate(channel_notes):
+        beats = np.array(ticks, dtype=np.float64) / division
+        # loop over whole bars, at least one
+        n_bars = max(1, int(np.ceil(beats.max() / beats_per_bar)))
+        bank = drum_bank if channel == drum_channel else 0
+        states[track] = {"bpm": bpm,
+                         "bpl": int(np.ceil(n_bars * beats_per_bar)),
+                         "schedule_beats_beats": beats,
+                         "schedule_beats_pitches": np.array(pitches, dtype=np.int16) - default_midi_offset,
+                         "schedule_beats_onoff": np.array(on_offs, dtype=np.bool_),
+                         "program": find_program(program_selector, bank, program),
+                         "midi_offset": default_midi_offset,
+                         "volume": default_volume}
+    return states
+
+
+def find_program(program_selector, bank, preset):
+    '''index of (bank, preset) in program_selector, 0 if it isn't there'''
+    try:
+        return program_selector.program_tuples.index((bank, preset))
+    except ValueError:
+        return 0
+
+
+def encode_variable_length(value):
+    '''value as a MIDI variable length quantity'''
+    encoded = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        encoded.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(encoded)
+
+
+def track_chunk(events):
+    '''track chunk of events, a list of (tick, bytes) sorted by tick'''
+    data = bytearray()
+    tick = 0
+    for event_tick, event in events:
+        data += encode_variable_length(event_tick - tick)
+        data += event
+        tick = event_tick
+    data += encode_variable_length(0) + b"\xFF\x2F\x00" # end of track
+    return chunk_struct.pack(track_magic, len(data)) + bytes(data)
+
+
+def write_midi_file(filename, states, program_filepath="./data/fluid_synth_programs.txt",
+                    division=default_division):
+    '''Writes states (dict of track index -> state dict) to a format 1 Standard
+       MIDI File with one loop of every track. The file has the tempo of the
+       first track, the beats of tracks at other tempos are scaled so they
+       keep their timing. Notes are written as they are played, with the
+       quantize, swing and humanize transform of their track applied.'''
+    program_selector = get_program_selector(program_filepath)
+    tracks = sorted(states.keys())
+    reference_bpm = states[tracks[0]]["bpm"] if tracks else 60e6 / default_tempo
+    tempo = int(round(60e6 / reference_bpm))
+    chunks = [track_chunk([(0, b"\xFF\x51\x03" + tempo.to_bytes(3, "big"))])]
+
+    melodic_channels = [channel for channel in range(16) if channel != drum_channel]
+    for number, track in enumerate(tracks):
+        state = states[track]
+        bank, preset = program_selector.get_program_from_index(state["program"])
+        if bank == drum_bank:
+            channel = drum_channel
+        else:
+            channel = melodic_channels[number % len(melodic_channels)]
+        name = ("Track %d" % (track + 1)).encode()
+        events = [(0, b"\xFF\x03" + encode_variable_length(len(name)) + name)]
+        if bank != drum_bank and bank != 0:
+            events.append((0, bytes([0xB0 | channel, 0, bank & 0x7F])))
+        events.append((0, bytes([0xC0 | channel, preset & 0x7F])))
+
+        beats = played_beats(state)
+        pitches = np.asarray(state["schedule_beats_pitches"], dtype=np.int64) + state["midi_offset"]
+        on_offs = np.asarray(state["schedule_beats_onoff"], dtype=np.bool_)
+        ticks = np.round(beats * reference_bpm / state["bpm"] * division).astype(np.int64)
+        order = np.argsort(ticks, kind="stable")
+        statuses = np.where(on_offs, 0x90, 0x80) | channel
+        velocity = min(127, max(1, int(state["volume"])))
+        velocities = np.where(on_offs, velocity, 64)
+        messages = np.stack([statuses, np.clip(pitches, 0, 127), velocities], axis=1)
+        message_bytes = messages.astype(np.uint8)[order].tobytes()
+        events.extend(zip(ticks[order].tolist(),
+                          (message_bytes[i:i + 3] for i in range(0, len(message_bytes), 3))))
+        chunks.append(track_chunk(events))
+
+    with open(filename, 'wb') as midi_file:
+        midi_file.write(chunk_struct.pack(header_magic, header_struct.size))
+        midi_file.write(header_struct.pack(1, len(chunks), division))
+        for chunk in chunks:
+            midi_file.write(chunk)
@@ -0,0 +1,133 @@
+import argparse
+import math
+import time
+import wave
+import numpy as np
+from synth_wrapper import SynthWrapper, SynthEngine
+from clock import AudioSchedule
+from transforms import Transform
+from session import load_session
+
+
+class OfflineRenderer(object):
+    '''Renders saved tracks to audio faster than real time, without an audio
+       device. Each track's schedule is played against virtual time and the
+       samples are pulled from the synths block by block.
+       states (dict): track index -> state dict (see LoopingTrack.get_state)
+       synth_filepath(str): filepath to sf2 file
+       program_filepath(str): filepath to program name file
+       samplerate (int): sample rate of the output in Hz
+       block_size (int): largest number of frames pulled from a synth at once
+       engine (SynthEngine): engine without audio driver to reuse, a new one
+                    is made if None'''
+    def __init__(self, states, synth_filepath, program_filepath,
+                 samplerate=44100, block_size=512, engine=None):
+        super(OfflineRenderer, self).__init__()
+        self.samplerate = samplerate
+        self.block_size = block_size
+        self.engine = engine
+        if engine is None:
+            self.engine = SynthEngine(synth_filepath, start_audio=False,
+                                      samplerate=samplerate)
+        self.synths = [] # synth of each track
+        self.schedules = [] # schedule of each track
+        for index in sorted(states.keys()):
+            state = states[index]
+            synth = SynthWrapper(synth_filepath, program_filepath, self.engine)
+            synth.set_instrument(state["program"])
+            synth.set_midi_offset(state["midi_offset"])
+            synth.set_volume(state["volume"])
+            schedule = AudioSchedule(state["bpm"], state["bpl"], [])
+            schedule.tempo_map.set_changes(state.get("tempo_changes", []))
+            schedule.set_transform(Transform(**state.get("transform", {})))
+            schedule.set_events(state["schedule_beats_beats"],
+                                state["schedule_beats_pitches"],
+                                state["schedule_beats_onoff"],
+                                state.get("layer_lengths"))
+            self.synths.append(synth)
+            self.schedules.append(schedule)
+
+    def loop_length(self):
+        '''length in seconds of the longest loop'''
+        return max([schedule.tempo_map.loop_seconds
+                    for schedule in self.schedules], default=0)
+
+    def get_events(self, duration):
+        '''returns list of (time, on_off, track, pitch) of all the notes played
+           before duration seconds, sorted by time'''
+        times, on_offs, tracks, pitches = [], [], [], []
+        for track, schedule in enumerate(self.schedules):
+            events = schedule.events
+            loop_seconds = schedule.tempo_map.loop_seconds
+            n_repeats = math.ceil(duration / loop_seconds)
+            # time of every event in every repetition of the loop
+            track_times = (np.arange(n_repeats)[:, None] * loop_seconds +
+                           schedule.tempo_map.seconds_at_beats(events["beat"])[None, :]).ravel()
+            keep = track_times < duration
+            times.append(track_times[keep])
+            on_offs.append(np.tile(events["on"], n_repeats)[keep])
+            pitches.append(np.tile(events["pitch"], n_repeats)[keep])
+            tracks.append(np.full(np.count_nonzero(keep), track))
+        if not times:
+            return []
+        times, on_offs, tracks, pitches = [np.concatenate(column) for column in
+                                           (times, on_offs, tracks, pitches)]
+        # note offs go before note ons at the same time, like the clock
+        order = np.lexsort((on_offs, times))
+        return list(zip(times[order].tolist(), on_offs[order].tolist(),
+                        tracks[order].tolist(), pitches[order].tolist()))
+
+    def render_frames(self, mix, start, end):
+        '''adds the output of all synths from frame start to end to mix'''
+        while start < end:
+            n_frames = min(self.block_size, end - start)
+            for synth, _ in self.engine.synths:
+                mix[start:start + n_frames] += \
+                    synth.get_samples(n_frames).reshape(-1, 2)
+            start += n_frames
+
+    def render(self, n_loops):
+        '''renders n_loops repetitions of the longest loop, returns float
+           array of shape (frames, 2) in int16 range'''
+        duration = n_loops * self.loop_length()
+        n_frames = int(round(duration * self.samplerate))
+        mix = np.zeros((n_frames, 2), dtype=np.float32)
+        frame = 0
+        for event_time, on_off, track, pitch in self.get_events(duration):
+            event_frame = min(n_frames, int(event_time * self.samplerate))
+            self.render_frames(mix, frame, event_frame)
+            frame = event_frame
+            self.synths[track].do_command(pitch, on_off)
+        self.render_frames(mix, frame, n_frames)
+        return mix
+
+    def write_wav(self, filename, mix):
+        '''writes mix to a 16 bit stereo wav file'''
+        data = np.clip(mix, -32768, 32767).astype('<i2')
+        with wave.open(filename, 'wb') as wav_file:
+            wav_file.setnchannels(2)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(self.samplerate)
+            wav_file.writeframes(data.tobytes())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render a saved session to a wav file")
+    parser.add_argument("session", help="saved session file")
+    parser.add_argument("output", help="wav file to write")
+    parser.add_argument("--loops", type=int, default=4,
+                        help="number of repetitions of the longest loop")
+    parser.add_argument("--samplerate", type=int, default=44100)
+    parser.add_argument("--soundfont", default="./data/FluidR3_GM.sf2")
+    parser.add_argument("--programs", default="./data/fluid_synth_programs.txt")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    renderer = OfflineRenderer(load_session(args.session), args.soundfont,
+                               args.programs, args.samplerate)
+    mix = renderer.render(args.loops)
+    renderer.write_wav(args.output, mix)
+    elapsed = time.perf_counter() - start
+    duration = len(mix) / args.samplerate
+    print("Rendered %.1f s of audio in %.2f s (%.0fx real time)"
+          % (duration, elapsed, duration / max(elapsed, 1e-9)))
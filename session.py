@@ -0,0 +1,172 @@
+import json
+import mmap
+import struct
+import numpy as np
+from midi_file import is_midi_file, read_midi_file, write_midi_file, midi_extensions
+
+# binary session layout (little endian):
+#   header: magic, version, number of tracks, length of the json metadata
+#   json metadata (session wide settings)
+#   track index: one entry per track with its index, number of events, offset
+#                of its event data and its settings
+#   event data of each track: beats (float64), pitches (int16), on/off (uint8)
+binary_magic = b"LOOPSES\0"
+binary_version = 1
+header_struct = struct.Struct("<8sIII")
+track_struct = struct.Struct("<iIQddiii")
+
+yaml_extensions = (".yaml", ".yml")
+yaml_metadata_key = "metadata" # tracks are saved under their int index
+# settings of a track kept in the metadata of binary sessions, by track index
+metadata_track_keys = ("tempo_changes", "transform", "layer_lengths", "late_policy")
+
+
+class SessionDict(dict):
+    '''Tracks of a yaml or MIDI session, dict of track index -> state dict
+       with the session wide settings in metadata like SessionFile'''
+    def __init__(self, states, metadata=None):
+        super(SessionDict, self).__init__(states)
+        self.metadata = metadata or {}
+
+
+class SessionFile(object):
+    '''Read only view of a binary session file. The file is memory mapped and
+       a track is only read when it is accessed, its event columns are NumPy
+       arrays backed by the file.
+       filename (str): path of the binary session file'''
+    def __init__(self, filename):
+        super(SessionFile, self).__init__()
+        with open(filename, 'rb') as session_file:
+            self.buffer = mmap.mmap(session_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_tracks, metadata_length = header_struct.unpack_from(self.buffer, 0)
+        if magic != binary_magic or version > binary_version:
+            raise ValueError("%s is not a supported binary session file" % filename)
+        position = header_struct.size
+        self.metadata = json.loads(self.buffer[position:position + metadata_length].decode())
+        position += metadata_length
+        self.index = {} # track index -> index entry
+        for _ in range(n_tracks):
+            entry = track_struct.unpack_from(self.buffer, position)
+            self.index[entry[0]] = entry[1:]
+            position += track_struct.size
+
+    def keys(self):
+        return self.index.keys()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, track):
+        return track in self.index
+
+    def __getitem__(self, track):
+        '''state dict of track (see LoopingTrack.get_state)'''
+        n_events, offset, bpm, bpl, program, midi_offset, volume = self.index[track]
+        state = {"bpm": as_number(bpm),
+                 "bpl": as_number(bpl),
+                 "schedule_beats_beats": np.frombuffer(self.buffer, np.float64, n_events, offset),
+                 "schedule_beats_pitches": np.frombuffer(self.buffer, np.int16, n_events,
+                                                         offset + 8 * n_events),
+                 "schedule_beats_onoff": np.frombuffer(self.buffer, np.bool_, n_events,
+                                                       offset + 10 * n_events),
+                 "program": program,
+                 "midi_offset": midi_offset,
+                 "volume": volume}
+        # tempo changes inside the loop, transforms, loops of several takes and
+        # late policies of single tracks are rare, they are kept in the metadata
+        for key in metadata_track_keys:
+            value = self.metadata.get(key, {}).get(str(track))
+            if value:
+                state[key] = value
+        return state
+
+
+def as_number(value):
+    '''returns value as int if it is a whole number, the gui spin boxes need ints'''
+    return int(value) if float(value).is_integer() else value
+
+
+def is_binary_session(filename):
+    '''whether filename starts with the binary session magic bytes'''
+    with open(filename, 'rb') as session_file:
+        return session_file.read(len(binary_magic)) == binary_magic
+
+
+def load_session(filename):
+    '''Loads the track states saved in filename, returns mapping of track
+       index -> state dict (see LoopingTrack.get_state) with the session wide
+       settings in its metadata attribute. The format is picked
+       from the file contents (binary, Standard MIDI File or yaml), binary
+       sessions are read lazily.'''
+    if is_binary_session(filename):
+        return SessionFile(filename)
+    if is_midi_file(filename):
+        return SessionDict(read_midi_file(filename))
+    import yaml # deferred, only needed for yaml files
+    with open(filename, 'r') as load_file:
+        states = yaml.safe_load(load_file)
+    metadata = states.pop(yaml_metadata_key, None)
+    return SessionDict(states, metadata)
+
+
+def save_session(filename, states, metadata=None):
+    '''Saves states (dict of track index -> state dict) to filename, as yaml if
+       the extension is .yaml or .yml, as a Standard MIDI File if it is .mid
+       or .midi and in the binary format otherwise'''
+    if filename.lower().endswith(yaml_extensions):
+        save_yaml_session(filename, states, metadata)
+    elif filename.lower().endswith(midi_extensions):
+        write_midi_file(filename, states)
+    else:
+        save_binary_session(filename, states, metadata)
+
+
+def save_yaml_session(filename, states, metadata=None):
+    '''Saves states to yaml file filename'''
+    import yaml # deferred, only needed for yaml files
+    out_dict = {}
+    if metadata:
+        out_dict[yaml_metadata_key] = metadata
+    for track, state in states.items():
+        out_dict[track] = {key: (value.tolist() if isinstance(value, np.ndarray) else value)
+                           for key, value in state.items()}
+    with open(filename, 'w') as save_file:
+        yaml.dump(out_dict, save_file)
+
+
+def save_binary_session(filename, states, metadata=None):
+    '''Saves states to binary session file filename'''
+    metadata = dict(metadata or {})
+    for key in metadata_track_keys:
+        values = {str(track): state[key] for track, state in states.items() if state.get(key)}
+        if values:
+            metadata[key] = values
+    metadata_bytes = json.dumps(metadata).encode()
+    tracks = sorted(states.keys())
+    offset = header_struct.size + len(metadata_bytes) + track_struct.size * len(tracks)
+    # event data starts 8 byte aligned
+    index_padding = -offset % 8
+    offset += index_padding
+    index = []
+    columns = []
+    for track in tracks:
+        state = states[track]
+        beats = np.asarray(state["schedule_beats_beats"], dtype='<f8')
+        pitches = np.asarray(state["schedule_beats_pitches"], dtype='<i2')
+        on_offs = np.asarray(state["schedule_beats_onoff"], dtype=np.uint8)
+        index.append(track_struct.pack(track, len(beats), offset, state["bpm"], state["bpl"],
+                                       state["program"], state["midi_offset"], state["volume"]))
+        columns.extend((beats, pitches, on_offs))
+        # keep the next track's beats 8 byte aligned
+        offset += len(beats) * 11
+        padding = -offset % 8
+        columns.append(np.zeros(padding, dtype=np.uint8))
+        offset += padding
+    with open(filename, 'wb') as save_file:
+        save_file.write(header_struct.pack(binary_magic, binary_version, len(tracks),
+                                           len(metadata_bytes)))
+        save_file.write(metadata_bytes)
+        save_file.write(b"".join(index))
+        save_file.write(bytes(index_padding))
+        for column in columns:
+            save_file.write(column.tobytes())
@@ -0,0 +1,95 @@
+import mmap
+import os
+import struct
+import tempfile
+import numpy as np
+
+length_struct = struct.Struct("<I") # length in bytes before every message
+# the write and read positions are on their own cache lines, so the two
+# processes don't keep taking the line from each other
+header_size = 128
+write_slot = 0 # index of the write position in the header as uint64
+read_slot = 8 # index of the read position
+# rings are memory mapped files, on linux in memory only
+shared_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+class SharedRing(object):
+    '''Ring buffer of byte messages in a memory mapped file, for one process
+       to send messages to one other process without locks or system calls.
+       The sender only moves the write position and the receiver only the
+       read position. Both count bytes since the ring was created, so the
+       ring is empty when they are equal. Every message is its length then
+       its bytes, wrapping around the end of the buffer.
+       path (str): file of a ring made by the other process, a new ring is
+                    made if None
+       capacity (int): bytes of messages a new ring holds'''
+    def __init__(self, path=None, capacity=2 ** 22):
+        super(SharedRing, self).__init__()
+        self.owner = path is None
+        if self.owner:
+            fd, path = tempfile.mkstemp(prefix="loop_station_", suffix=".ring", dir=shared_dir)
+            os.ftruncate(fd, header_size + capacity)
+        else:
+            fd = os.open(path, os.O_RDWR)
+            capacity = os.fstat(fd).st_size - header_size
+        self.path = path
+        self.capacity = capacity
+        self.map = mmap.mmap(fd, header_size + capacity)
+        os.close(fd)
+        self.positions = np.frombuffer(self.map, dtype=np.uint64, count=header_size // 8)
+        self.buffer = memoryview(self.map)[header_size:]
+
+    def put(self, message):
+        '''adds message (bytes) to the ring, returns False if there is no
+           room for it until the receiver catches up'''
+        size = length_struct.size + len(message)
+        if size > self.capacity:
+            raise ValueError("message of %d bytes is larger than the ring" % len(message))
+        write = int(self.positions[write_slot])
+        if size > self.capacity - (write - int(self.positions[read_slot])):
+            return False
+        self.copy_in(write, length_struct.pack(len(message)))
+        self.copy_in(write + length_struct.size, message)
+        # the message is only seen by the receiver once the position moves
+        self.positions[write_slot] = write + size
+        return True
+
+    def get(self):
+        '''takes the oldest message out of the ring, None if it is empty'''
+        read = int(self.positions[read_slot])
+        if read == int(self.positions[write_slot]):
+            return None
+        length, = length_struct.unpack(self.copy_out(read, length_struct.size))
+        message = self.copy_out(read + length_struct.size, length)
+        self.positions[read_slot] = read + length_struct.size + length
+        return message
+
+    def copy_in(self, position, data):
+        '''writes data at position, wrapping around the end of the buffer'''
+        start = position % self.capacity
+        first = min(len(data), self.capacity - start)
+        self.buffer[start:start + first] = data[:first]
+        self.buffer[:len(data) - first] = data[first:]
+
+    def copy_out(self, position, length):
+        '''bytes at position, wrapping around the end of the buffer'''
+        start = position % self.capacity
+        first = min(length, self.capacity - start)
+        return bytes(self.buffer[start:start + first]) + bytes(self.buffer[:length - first])
+
+    def unlink(self):
+        '''removes the file, the ring stays mapped in the processes which
+           opened it'''
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        '''unmaps the ring, the process which made it also removes the file'''
+        self.buffer.release()
+        del self.positions
+        self.map.close()
+        if self.owner:
+            self.unlink()
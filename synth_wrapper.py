@@ -1,18 +1,94 @@
-import fluidsynth
+import threading
 
-class SynthWrapper(fluidsynth.Synth):
-    '''Wrapper class for fluidsynth.Synth to include program selection
+class SynthEngine(object):
+    '''Pool of fluidsynth.Synth objects which hands out MIDI channels, so many
+       tracks can share one loaded soundfont and one audio stream. A new synth
+       is only created once all the channels of the previous ones are in use.
        synth_filepath(str): filepath to sf2 file
-       program_filepath(str): filepath to program name file'''
-    def __init__(self, synth_filepath, program_filepath):
+       channels_per_synth(int): number of MIDI channels handed out per synth
+       start_audio(bool): whether to start an audio driver for each synth,
+                    without one samples are pulled with get_samples
+       samplerate(int): sample rate of the synths in Hz'''
+    def __init__(self, synth_filepath, channels_per_synth=16, start_audio=True,
+                 samplerate=44100):
+        super(SynthEngine, self).__init__()
+        self.synth_filepath = synth_filepath
+        self.channels_per_synth = channels_per_synth
+        self.start_audio = start_audio
+        self.samplerate = samplerate
+        self.synths = [] # list of (synth, sfid)
+        self.n_allocated = 0
+        self.lock = threading.Lock()
+
+    def add_synth(self):
+        '''creates a new synth, loads the soundfont and starts its audio driver'''
+        import fluidsynth # deferred, loading the library slows down startup
+        # fluidsynth needs at least 16 midi channels
+        synth = fluidsynth.Synth(samplerate=self.samplerate,
+                                 channels=max(16, self.channels_per_synth))
+        sfid = synth.sfload(self.synth_filepath)
+        if self.start_audio:
+            synth.start()
+        self.synths.append((synth, sfid))
+
+    def allocate_channel(self):
+        '''returns (synth, sfid, channel) for the next free MIDI channel'''
+        with self.lock:
+            synth_idx, channel = divmod(self.n_allocated, self.channels_per_synth)
+            if synth_idx == len(self.synths):
+                self.add_synth()
+            self.n_allocated += 1
+            synth, sfid = self.synths[synth_idx]
+            return synth, sfid, channel
+
+    def release_channels(self):
+        '''hands out the channels from the first one again, the synths that
+           used them must not be used anymore'''
+        with self.lock:
+            self.n_allocated = 0
+
+
+def estimate_output_latency(synth):
+    '''seconds of audio buffered by the audio driver of synth (period size *
+       periods / sample rate), None if the settings can't be read'''
+    period_size = synth.get_setting("audio.period-size")
+    periods = synth.get_setting("audio.periods")
+    samplerate = synth.get_setting("synth.sample-rate")
+    if not (period_size and periods and samplerate):
+        return None
+    return period_size * periods / samplerate
+
+
+class SynthWrapper(object):
+    '''Wrapper around one MIDI channel of a fluidsynth.Synth to include program selection
+       synth_filepath(str): filepath to sf2 file
+       program_filepath(str): filepath to program name file
+       engine(SynthEngine): engine to get the channel from, if None the
+                    wrapper gets its own synth
+       load(bool): whether to load the synth now, otherwise load() has to be
+                    called (can be done from another thread). Until then
+                    notes are ignored.'''
+    def __init__(self, synth_filepath, program_filepath, engine=None, load=True):
         super(SynthWrapper, self).__init__()
-        self.sfid = self.sfload(synth_filepath)
+        if engine is None:
+            engine = SynthEngine(synth_filepath, 1)
+        self.engine = engine
+        self.synth = None
+        self.sfid = -1
+        self.channel = -1
+        self.ready = threading.Event()
         self.volume = 60
         self.program = 0
         self.midi_offset = 60
-        self.program_selector = ProgramSelector(program_filepath)
-        self.start()
-        self.set_instrument(0)
+        self.program_selector = get_program_selector(program_filepath)
+        if load:
+            self.load()
+
+    def load(self):
+        '''gets a channel from the engine and selects the current program'''
+        self.synth, self.sfid, self.channel = self.engine.allocate_channel()
+        self.ready.set()
+        self.set_instrument(self.program)
     
     def set_volume(self, volume):
         '''sets synth volume'''
@@ -23,20 +99,32 @@ class SynthWrapper(fluidsynth.Synth):
         self.midi_offset = offset
 
     def set_instrument(self, program):
-        '''sets synth to instrument at index specified by program'''
-        banknum, presetnum = self.program_selector.get_program_from_index(program)
-        self.program_select(0, self.sfid, banknum, presetnum)
+        '''sets synth channel to instrument at index specified by program'''
         self.program = program
+        # applied by load() if the synth isn't loaded yet
+        if self.ready.is_set():
+            banknum, presetnum = self.program_selector.get_program_from_index(program)
+            self.synth.program_select(self.channel, self.sfid, banknum, presetnum)
+
+    def output_latency(self):
+        '''estimated seconds from a note command until it is heard, None if
+           the synth isn't loaded yet'''
+        if not self.ready.is_set():
+            return None
+        return estimate_output_latency(self.synth)
 
     def turn_off_notes(self):
-        self.all_notes_off(0)
+        if self.ready.is_set():
+            self.synth.all_notes_off(self.channel)
 
     def do_command(self, pitch, off_on):
         '''instructs synth to turn on or off a note at pitch'''
+        if not self.ready.is_set():
+            return
         if off_on:
-            self.noteon(0, pitch + self.midi_offset, self.volume)
+            self.synth.noteon(self.channel, pitch + self.midi_offset, self.volume)
         else:
-            self.noteoff(0, pitch + self.midi_offset)
+            self.synth.noteoff(self.channel, pitch + self.midi_offset)
         
 
 class ProgramSelector(object):
@@ -57,4 +145,12 @@ class ProgramSelector(object):
         return self.program_strings
     
     def get_program_from_index(self, index):
-        return self.program_tuples[index]
\ No newline at end of file
+        return self.program_tuples[index]
+
+program_selectors = {} # ProgramSelector for each program file, shared by all synths
+
+def get_program_selector(program_file):
+    '''returns the ProgramSelector of program_file, the file is only parsed once'''
+    if program_file not in program_selectors:
+        program_selectors[program_file] = ProgramSelector(program_file)
+    return program_selectors[program_file]
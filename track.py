@@ -0,0 +1,309 @@
+from enum import Enum
+from clock import AudioSchedule, LatePolicy
+from transforms import Transform
+
+
+class LooperState(Enum):
+    '''Enum which tracks the state of the looper, whether it is disabled,
+    recording, playing or recording over the loop while it plays'''
+    DISABLED = 1
+    RECORD = 2
+    PLAY = 3
+    OVERDUB = 4
+
+    def __str__(self):
+        if self.value == self.DISABLED.value:
+            return "DISABLED"
+        elif self.value == self.RECORD.value:
+            return "RECORD"
+        elif self.value == self.PLAY.value:
+            return "PLAY"
+        elif self.value == self.OVERDUB.value:
+            return "OVERDUB"
+        return "NOT MATCHING"
+
+default_bpm = 60
+default_bpl = 16
+
+class LoopingTrack(object):
+    '''The back end of the looping track'''
+    def __init__(self, index, synth, clock):
+        super(LoopingTrack, self).__init__()
+        self.index = index
+        self.synth = synth
+        self.clock = clock
+        self.bpm = default_bpm
+        self.bpl = default_bpl
+        self.mode = LooperState.DISABLED
+        self.schedule = AudioSchedule(self.bpm, self.bpl, [])
+        self.new_state_loaded = False # tracks whether to update the clock
+        self.notes_changed = False # updates notes to check to repaint
+        self.synced_to_me = [] # list of tracks synced to this track
+        self.is_synced = False
+        self.synced_to = None # track this track is synced to
+        self.journal = None # RecordingJournal that recorded notes and changes are logged to
+        self.router = None # InputRouter which sends key presses while recording
+        self.freezer = None # FreezeManager which plays the loop from a rendered buffer
+        self.transport = None # TransportFollower which sets the start of the loop
+        self.late_policy = None # LatePolicy of the track, None for the clock's default
+
+    def follows_transport(self):
+        '''whether the start of the loop was set by the transport, so the
+           track keeps it instead of starting over'''
+        return self.transport is not None and self.transport.locked
+
+    def change_state(self, new_state):
+        '''changes state to new_state'''     
+        # if state hasn't changed
+        if new_state == self.mode:
+            return
+        self.unfreeze()
+        
+        self.synth.turn_off_notes()
+        self.clock.release_metronome(self.index)
+        # the take recorded so far becomes a layer of the loop
+        if self.is_armed():
+            self.schedule.commit_take()
+        if new_state == LooperState.DISABLED:
+            self.clock.disable_track(self.index)
+        elif new_state == LooperState.RECORD:
+            self.clock.start()
+            #record a take which replaces the loop, reset and disable clock
+            self.schedule.start_take(replace=True)
+            if self.journal is not None:
+                self.journal.log_clear(self.index)
+            if not(self.is_synced) and not self.follows_transport():
+                self.clock.reset_track_offset(self.index)
+            self.clock.disable_track(self.index)
+
+            # set self to metronome
+            self.clock.set_metronome(self.index, self.bpm)
+        # play and overdub states play the loop
+        else:
+            # post schedule to be played
+            self.clock.post_schedule(self.index, self.schedule)
+            # start from beginning if previous state was disabled, unless the
+            # start is set by the transport
+            if self.mode == LooperState.DISABLED:
+                self.clock.enable_track(self.index, self.follows_transport())
+            # keep offset when last mode was recording
+            elif self.mode == LooperState.RECORD:
+                self.clock.enable_track(self.index, True)
+            # otherwise the loop was playing and goes on from where it is
+            if new_state == LooperState.OVERDUB:
+                self.schedule.start_take()
+                self.clock.set_metronome(self.index, self.bpm)
+        self.mode = new_state
+        if self.journal is not None:
+            self.journal.log_mode(self.index, new_state)
+        if self.router is not None:
+            self.router.set_armed(self.index, self.is_armed())
+
+    def is_armed(self):
+        '''whether the track records key presses'''
+        return self.mode == LooperState.RECORD or self.mode == LooperState.OVERDUB
+
+    def can_undo(self):
+        '''whether there is a take to undo, not while recording'''
+        return not self.is_armed() and self.schedule.can_undo()
+
+    def can_redo(self):
+        '''whether there is an undone take to redo, not while recording'''
+        return not self.is_armed() and self.schedule.can_redo()
+
+    def undo(self):
+        '''go back to the loop before the last take'''
+        if self.can_undo():
+            self.schedule.undo()
+            self.layers_changed()
+            if self.journal is not None:
+                self.journal.log_state(self.index, self.get_state())
+
+    def redo(self):
+        '''bring back the last undone take'''
+        if self.can_redo():
+            self.schedule.redo()
+            self.layers_changed()
+            if self.journal is not None:
+                self.journal.log_state(self.index, self.get_state())
+
+    def layers_changed(self):
+        '''plays the current layers of the schedule from the current beat'''
+        self.unfreeze()
+        # notes of a layer which is gone would never get their note off
+        self.synth.turn_off_notes()
+        self.clock.post_schedule(self.index, self.schedule)
+        self.new_state_loaded = True # update the gui
+
+    def unfreeze(self):
+        '''play the loop live again, called on any change to its sound'''
+        if self.freezer is not None:
+            self.freezer.unfreeze(self.index)
+
+    def log_params(self, **params):
+        '''log changed settings to the journal'''
+        if self.journal is not None:
+            self.journal.log_params(self.index, params)
+
+    def set_quantize(self, quantize):
+        '''whether to quantize the notes of the loop'''
+        self.set_transform(quantize=quantize)
+
+    def set_transform(self, **settings):
+        '''change settings of the quantize, swing and humanize transform (see
+           Transform), the loop plays with them right away and the notes keep
+           the timing they were recorded with'''
+        transform = self.schedule.transform.replace(**settings)
+        if transform.get_state() == self.schedule.transform.get_state():
+            return
+        self.schedule.set_transform(transform)
+        self.log_params(transform=self.schedule.transform.get_state())
+        self.layers_changed()
+
+    def set_bpm(self, bpm):
+        '''update bpm, only the tempo map of the schedule changes'''
+        self.bpm = bpm
+        self.clock.set_tempo(self.index, self.schedule, bpm=bpm)
+        self.log_params(bpm=bpm)
+        self.unfreeze()
+
+        for looper in self.synced_to_me:
+            looper.set_bpm(bpm)
+            looper.new_state_loaded = True # update the gui
+
+    def set_bpl(self, bpl):
+        '''update beats per loop, only the tempo map of the schedule changes'''
+        self.bpl = bpl
+        self.clock.set_tempo(self.index, self.schedule, beats_per_loop=bpl)
+        # transformed notes wrap around at the end of the loop
+        if self.schedule.transform.is_active():
+            self.clock.post_schedule(self.index, self.schedule)
+        self.log_params(bpl=bpl)
+        self.unfreeze()
+        for looper in self.synced_to_me:
+            looper.set_bpl(bpl)
+            looper.new_state_loaded = True # update the gui
+
+    def set_tempo_changes(self, changes):
+        '''set tempo changes inside the loop, list of (beat, bpm), the loop
+           starts at the track's bpm'''
+        changes = [(float(beat), float(bpm)) for beat, bpm in changes]
+        self.clock.set_tempo(self.index, self.schedule, changes=changes)
+        self.log_params(tempo_changes=changes)
+        self.unfreeze()
+
+    def sync_to(self, track):
+        '''sync bpm, beats per loop and start time to track, unsync if track
+           is None'''
+        if self.synced_to is not None:
+            self.synced_to.synced_to_me.remove(self)
+        self.synced_to = track
+        self.is_synced = track is not None
+        if track is not None:
+            track.synced_to_me.append(self)
+            self.set_bpm(track.bpm)
+            self.set_bpl(track.bpl)
+            self.clock.sync(self.index, track.index)
+
+    def set_schedule(self, schedule):
+        '''set schedule from loaded file, disable track'''
+        self.change_state(LooperState.DISABLED)
+        self.schedule = schedule
+
+    def set_volume(self, volume):
+        '''sets synth volume'''
+        self.synth.set_volume(volume)
+        self.log_params(volume=volume)
+        self.unfreeze()
+
+    def set_late_policy(self, policy):
+        '''sets what the clock does with the notes of the track it is too
+           late for (see LatePolicy), None for the clock's default. The
+           threshold is the default's'''
+        self.late_policy = policy
+        self.clock.set_late_policy(policy, self.clock.default_late_policy[1], self.index)
+        self.log_params(late_policy=None if policy is None else policy.option)
+
+    def get_program_names(self):
+        '''gets current program name from synth'''
+        return self.synth.program_selector.get_program_names()
+    
+    def set_program(self, index):
+        '''sets synth to program at index'''
+        self.synth.set_instrument(index)
+        self.log_params(program=index)
+        self.unfreeze()
+    
+    def set_midi_offset(self, offset):
+        '''sets the midi value of the r key'''
+        self.synth.set_midi_offset(offset)
+        self.log_params(midi_offset=offset)
+        self.unfreeze()
+
+    def on_keystroke(self, note_idx, up_down, press_time=None):
+        '''plays and records note if in record or overdub mode, press_time is
+           the clock time of the key press, the note is recorded at the beat
+           of that time instead of the current beat. The player reacts to what
+           they hear, so the beat is moved earlier by the clock's latency
+           compensation'''
+        if self.is_armed():
+            record_time = press_time if press_time is not None else self.clock.time_func()
+            beat = self.clock.get_beat_at(self.index, self.schedule.tempo_map,
+                                          record_time - self.clock.latency_compensation)
+            # add note to schedule
+            self.schedule.add_event(beat, note_idx, up_down)
+            if self.journal is not None:
+                self.journal.log_note(self.index, beat, note_idx, up_down)
+            # send command to synth
+            if press_time is not None and self.clock.metrics is not None:
+                self.clock.metrics.record_keystroke(self.clock.time_func() - press_time)
+            self.synth.do_command(note_idx, up_down)
+
+
+    def get_state(self):
+        '''export state to dict to be saved to file'''
+        state_dic = {}
+        state_dic["bpm"] = self.bpm
+        state_dic["bpl"] = self.bpl
+        # the notes as they were recorded, the transform is saved on its own
+        events = self.schedule.raw_events
+        state_dic["schedule_beats_beats"] = events["beat"].copy()
+        state_dic["schedule_beats_pitches"] = events["pitch"].copy()
+        state_dic["schedule_beats_onoff"] = events["on"].copy()
+        state_dic["program"] = self.synth.program
+        state_dic["midi_offset"] = self.synth.midi_offset
+        state_dic["volume"] = self.synth.volume
+        if self.schedule.tempo_map.changes:
+            state_dic["tempo_changes"] = [list(change) for change in self.schedule.tempo_map.changes]
+        if not self.schedule.transform.is_default():
+            state_dic["transform"] = self.schedule.transform.get_state()
+        if self.late_policy is not None:
+            state_dic["late_policy"] = self.late_policy.option
+        # takes are transformed on their own, so loops of several takes keep
+        # where each one starts in the columns
+        layer_lengths = self.schedule.raw_layer_lengths
+        if len(layer_lengths) > 1:
+            state_dic["layer_lengths"] = layer_lengths
+        return state_dic
+        
+    def load_from_state(self, state_dict):
+        '''import state from dict from save file'''
+        self.change_state(LooperState.DISABLED)
+        self.bpm = state_dict["bpm"]
+        self.bpl = state_dict["bpl"]
+        
+        self.clock.set_tempo(self.index, self.schedule, self.bpm, self.bpl,
+                             state_dict.get("tempo_changes", []))
+        self.schedule.set_transform(Transform(**state_dict.get("transform", {})))
+        self.schedule.set_events(state_dict["schedule_beats_beats"], state_dict["schedule_beats_pitches"], state_dict["schedule_beats_onoff"],
+                                 state_dict.get("layer_lengths"))
+
+        self.set_program(state_dict["program"])
+        self.set_midi_offset(state_dict["midi_offset"])
+        self.set_volume(state_dict["volume"])
+        late_policy = state_dict.get("late_policy")
+        self.set_late_policy(None if late_policy is None else LatePolicy.from_option(late_policy))
+        if self.journal is not None:
+            self.journal.log_state(self.index, self.get_state())
+
+        self.new_state_loaded = True
@@ -0,0 +1,152 @@
+import numpy as np
+
+
+class Transform(object):
+    '''Quantize, swing and humanize settings of a schedule. They are applied
+       to a copy of the recorded takes when they are played, the takes keep
+       the timing they were recorded with so the settings can be changed or
+       turned off at any time (see AudioSchedule.layers)
+       quantize (bool): whether notes are moved towards the grid
+       grid (float): spacing of the grid in beats
+       strength (float): 0 to 1, how far notes are moved towards the grid
+       swing (float): 0.5 (straight) to 0.75, where the odd grid lines fall
+                    between the even ones, 2/3 is a triplet feel
+       humanize (float): standard deviation in beats of random offsets added
+                    to the notes
+       seed (int): seed of the random offsets, a note is always played with
+                    the same offset for the same seed, whichever take it is in'''
+    fields = ("quantize", "grid", "strength", "swing", "humanize", "seed")
+
+    def __init__(self, quantize=False, grid=1 / 12, strength=1.0, swing=0.5, humanize=0.0, seed=0):
+        super(Transform, self).__init__()
+        if grid <= 0:
+            raise ValueError("grid must be positive, not %r" % grid)
+        self.quantize = bool(quantize)
+        self.grid = float(grid)
+        self.strength = min(max(float(strength), 0.0), 1.0)
+        self.swing = min(max(float(swing), 0.5), 0.75)
+        self.humanize = max(float(humanize), 0.0)
+        self.seed = int(seed)
+
+    def get_state(self):
+        '''settings as a dict, the keyword arguments of Transform'''
+        return {field: getattr(self, field) for field in self.fields}
+
+    def replace(self, **settings):
+        '''copy of the transform with some settings changed'''
+        return Transform(**dict(self.get_state(), **settings))
+
+    def is_default(self):
+        return self.get_state() == default_state
+
+    def is_active(self):
+        '''whether the transform changes the timing of any note'''
+        return (self.quantize and self.strength > 0) or self.humanize > 0
+
+    def apply(self, events, beats_per_loop):
+        '''returns a copy of events (structured array with beat, pitch and on
+           columns) with the transform applied in one pass over the columns.
+           Note offs move along with their note on so notes keep their length,
+           beats moved past the end of the loop wrap around to its start'''
+        beats = events["beat"]
+        shift = np.zeros(len(events))
+        if self.quantize:
+            slots = np.round(beats / self.grid)
+            # swing delays the odd grid lines by part of a grid step
+            targets = (slots + (slots % 2 == 1) * (2 * self.swing - 1)) * self.grid
+            shift = self.strength * (targets - beats)
+        if self.humanize > 0:
+            shift = shift + self.humanize * note_noise(self.seed, beats, events["pitch"])
+        note_ons = note_on_indexes(events)
+        shift = np.where(note_ons >= 0, shift[note_ons], 0.0)
+        transformed = events.copy()
+        transformed["beat"] = (beats + shift) % beats_per_loop
+        return transformed
+
+
+default_state = Transform().get_state()
+
+
+def mix_bits(values):
+    '''splitmix64 finalizer of uint64 values, every bit of the result
+       depends on every bit of the value'''
+    values = values + np.uint64(0x9E3779B97F4A7C15)
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def note_noise(seed, beats, pitches):
+    '''standard normal random value for each note at beats with pitches,
+       hashed from the seed, beat and pitch so a note gets the same value
+       whichever take or file it is in'''
+    # + 0.0 so -0.0 and 0.0 have the same bits
+    keys = np.ascontiguousarray(beats + 0.0, dtype=np.float64).view(np.uint64)
+    keys = mix_bits(keys ^ mix_bits(np.asarray(pitches).astype(np.uint64)
+                                    ^ mix_bits(np.array([seed % 2 ** 64], dtype=np.uint64))))
+    # two uniform values in (0, 1) for the Box-Muller transform
+    uniform1 = ((keys >> np.uint64(11)).astype(np.float64) + 0.5) / 2 ** 53
+    uniform2 = ((mix_bits(keys) >> np.uint64(11)).astype(np.float64) + 0.5) / 2 ** 53
+    return np.sqrt(-2 * np.log(uniform1)) * np.cos(2 * np.pi * uniform2)
+
+
+def note_on_indexes(events):
+    '''index of the note on of every event in events (sorted by beat): the
+       event itself for note ons, the last note on of the same pitch before it
+       for note offs and -1 for note offs without a note on. A note off before
+       the first note on of its pitch ends the last note on of the loop, which
+       rang over the end of the loop'''
+    n_events = len(events)
+    positions = np.arange(n_events)
+    # events grouped by pitch, sorted by beat within a pitch
+    order = np.argsort(events["pitch"], kind="stable")
+    pitches = events["pitch"][order]
+    group_starts = np.ones(n_events, dtype=bool)
+    group_starts[1:] = pitches[1:] != pitches[:-1]
+    group_ends = np.ones(n_events, dtype=bool)
+    group_ends[:-1] = group_starts[1:]
+    # first and last position of the group of every position
+    starts = np.maximum.accumulate(np.where(group_starts, positions, 0))
+    ends = np.minimum.accumulate(np.where(group_ends, positions, n_events)[::-1])[::-1]
+    last_on = np.maximum.accumulate(np.where(events["on"][order], positions, -1))
+    paired = np.where(last_on >= starts, last_on, last_on[ends])
+    paired = np.where(paired >= starts, paired, -1)
+    indexes = np.empty(n_events, dtype=np.int64)
+    indexes[order] = np.where(paired >= 0, order[paired], -1)
+    return indexes
+
+
+def layer_bounds(n_events, layer_lengths=None):
+    '''(start, end) of each take in n_events saved events, from the
+       layer_lengths of a state (see LoopingTrack.get_state). Events after
+       the last take are a take of their own'''
+    bounds = []
+    start = 0
+    for length in layer_lengths or ():
+        end = min(start + int(length), n_events)
+        if end > start:
+            bounds.append((start, end))
+        start = end
+    if start < n_events:
+        bounds.append((start, n_events))
+    return bounds
+
+
+def played_beats(state):
+    '''beats of the events of state (see LoopingTrack.get_state) as they are
+       played, with the transform of the state applied to each take'''
+    beats = np.asarray(state["schedule_beats_beats"], dtype=np.float64)
+    transform = Transform(**state.get("transform", {}))
+    if not transform.is_active():
+        return beats
+    pitches = np.asarray(state["schedule_beats_pitches"])
+    on_offs = np.asarray(state["schedule_beats_onoff"])
+    played = np.empty(len(beats))
+    for start, end in layer_bounds(len(beats), state.get("layer_lengths")):
+        order = start + np.argsort(beats[start:end], kind="stable")
+        events = np.zeros(len(order), dtype=[("beat", np.float64), ("pitch", np.int16), ("on", np.bool_)])
+        events["beat"] = beats[order]
+        events["pitch"] = pitches[order]
+        events["on"] = on_offs[order]
+        played[order] = transform.apply(events, state["bpl"])["beat"]
+    return played
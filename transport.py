@@ -0,0 +1,252 @@
+import random
+import socket
+import struct
+import threading
+from collections import deque
+import numpy as np
+from session import as_number
+
+# transport message: magic, version, id of the leader, sequence number, time
+# the leader sent it, leader clock offset, ticks per second, start tick and
+# bpm of the reference track
+message_struct = struct.Struct("<6sHIIdddqd")
+transport_magic = b"LOOPTR"
+transport_version = 2
+default_port = 9777
+default_address = "255.255.255.255" # broadcast to the local network and this machine
+deadband = 0.0002 # seconds the clocks may be apart without a correction
+
+
+class TransportMessage(object):
+    '''Transport of a leader as sent over UDP'''
+    def __init__(self, leader_id, sequence, sent_at, clock_offset, tps, start_tick, bpm):
+        super(TransportMessage, self).__init__()
+        self.leader_id = leader_id
+        self.sequence = sequence
+        self.sent_at = sent_at # leader clock time
+        self.clock_offset = clock_offset # leader clock time at which its clock started
+        self.tps = tps
+        self.start_tick = start_tick
+        self.bpm = bpm
+
+    def to_bytes(self):
+        return message_struct.pack(transport_magic, transport_version, self.leader_id,
+                                   self.sequence, self.sent_at, self.clock_offset, self.tps,
+                                   self.start_tick, self.bpm)
+
+    @staticmethod
+    def from_bytes(data):
+        '''message in data, None if it isn't a transport message'''
+        if len(data) != message_struct.size:
+            return None
+        fields = message_struct.unpack(data)
+        if fields[0] != transport_magic or fields[1] != transport_version:
+            return None
+        return TransportMessage(*fields[2:])
+
+
+class DriftEstimate(object):
+    '''Estimates the offset between the leader's clock and this process's
+       clock from the time messages were sent and received. Every sample is
+       the offset plus the time the message took, so the smallest sample of
+       each window of samples is kept. A line is fit through those, its slope
+       is how fast the clocks drift apart.
+       window (int): samples of which the smallest is kept
+       n_windows (int): smallest samples the line is fit through
+       max_step (float): seconds a sample may be below the line before the
+                    leader's clock is taken to have jumped and the estimate
+                    starts over'''
+    def __init__(self, window=8, n_windows=16, max_step=0.01):
+        super(DriftEstimate, self).__init__()
+        self.window = window
+        self.max_step = max_step
+        self.samples = [] # (leader time, offset) of the current window
+        self.minimums = deque(maxlen=n_windows) # smallest (leader time, offset) of the last windows
+
+    def reset(self):
+        self.samples = []
+        self.minimums.clear()
+
+    def add(self, sent_at, received_at):
+        '''adds a message sent at leader clock time sent_at and received at
+           local clock time received_at'''
+        offset = received_at - sent_at
+        # no message arrives before it was sent
+        if self.minimums and offset < self.offset_at(sent_at) - self.max_step:
+            self.reset()
+        self.samples.append((sent_at, offset))
+        if len(self.samples) == self.window:
+            self.minimums.append(min(self.samples, key=lambda sample: sample[1]))
+            self.samples = []
+
+    def offset_at(self, leader_time):
+        '''local clock time - leader clock time at leader_time, None before
+           the first sample'''
+        points = list(self.minimums)
+        if self.samples:
+            points.append(min(self.samples, key=lambda sample: sample[1]))
+        if not points:
+            return None
+        if len(points) < 3:
+            return min(offset for _, offset in points)
+        times, offsets = np.array(points).T
+        slope, intercept = np.polyfit(times - times[-1], offsets, 1)
+        return intercept + slope * (leader_time - times[-1])
+
+
+class TransportLeader(threading.Thread):
+    '''Broadcasts the transport of this looper over UDP every interval
+       seconds: when its clock started, when the loop of the reference track
+       started and its tempo. TransportFollowers in other processes or on
+       other machines lock their clocks to it.
+       clock (Clock): clock of the looper
+       looper (LoopingTrack): reference track
+       address (str): address the messages are sent to, the broadcast address
+                    reaches every follower on the network
+       port (int): UDP port of the followers
+       interval (float): seconds between messages'''
+    def __init__(self, clock, looper, address=default_address, port=default_port, interval=0.05):
+        super(TransportLeader, self).__init__(daemon=True)
+        self.clock = clock
+        self.looper = looper
+        self.destination = (address, port)
+        self.interval = interval
+        self.leader_id = random.getrandbits(32) # followers start over when the leader changes
+        self.sequence = 0
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.stopped = threading.Event()
+
+    def message(self):
+        '''the current transport, None until the clock started'''
+        clock = self.clock
+        with clock.lock:
+            if not clock.enabled:
+                return None
+            message = TransportMessage(self.leader_id, self.sequence, clock.time_func(),
+                                       clock.offset, clock.tps,
+                                       clock.track_offsets.get(self.looper.index, 0),
+                                       self.looper.bpm)
+        self.sequence = (self.sequence + 1) % 2 ** 32
+        return message
+
+    def send(self):
+        message = self.message()
+        if message is None:
+            return
+        try:
+            self.socket.sendto(message.to_bytes(), self.destination)
+        except OSError as error:
+            print("Failed to send transport:", error)
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.send()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        self.socket.close()
+
+
+class TransportFollower(threading.Thread):
+    '''Receives the transport of a TransportLeader and locks this looper to
+       it. The clock's offset is moved so its ticks are the leader's ticks,
+       then the loops of the tracks start at the start tick of the leader's
+       reference track. Small differences between the clocks are corrected by
+       moving the offset at most max_slew seconds per update, so the loops
+       don't jump. Only the tempo_loopers take the leader's tempo (and the
+       tracks synced to them), the beats per loop of every track stay its own.
+       Messages are received on this thread, on_update applies the latest.
+       clock (Clock): clock of the looper
+       loopers (list): LoopingTracks which follow the leader
+       port (int): UDP port the leader sends to
+       tempo_loopers (list): LoopingTracks which play at the leader's tempo,
+                    the first of loopers if None
+       max_slew (float): seconds the clock offset moves per update at most
+       max_error (float): seconds the clock may be off before it jumps to
+                    the leader instead'''
+    def __init__(self, clock, loopers, port=default_port, max_slew=0.0005, max_error=0.05,
+                 tempo_loopers=None):
+        super(TransportFollower, self).__init__(daemon=True)
+        self.clock = clock
+        self.loopers = loopers
+        self.tempo_loopers = loopers[:1] if tempo_loopers is None else tempo_loopers
+        self.max_slew = max_slew
+        self.max_error = max_error
+        self.estimate = DriftEstimate()
+        self.message = None # last message received
+        self.offset = None # local clock time - leader clock time when it was received
+        self.locked = False # whether the tracks got the leader's start and tempo
+        self.lock = threading.Lock()
+        # every follower on this machine gets the broadcast messages
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("", port))
+        self.socket.settimeout(0.1)
+        self.stopped = threading.Event()
+
+    def start(self):
+        '''locks the loopers to the transport and starts receiving it'''
+        for looper in self.loopers:
+            looper.transport = self
+        super(TransportFollower, self).start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                data = self.socket.recv(message_struct.size + 1)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self.receive(TransportMessage.from_bytes(data), self.clock.time_func())
+
+    def receive(self, message, received_at):
+        '''adds message received at local clock time received_at'''
+        if message is None:
+            return
+        with self.lock:
+            if self.message is None or message.leader_id != self.message.leader_id:
+                self.estimate.reset()
+            # udp messages may come out of order
+            elif message.sequence <= self.message.sequence:
+                return
+            self.estimate.add(message.sent_at, received_at)
+            self.message = message
+            self.offset = self.estimate.offset_at(message.sent_at)
+
+    def on_update(self):
+        '''called regularly from the gui thread, moves the clock and the
+           tracks towards the leader's transport'''
+        with self.lock:
+            message, offset = self.message, self.offset
+        if message is None:
+            return
+        clock = self.clock
+        target = message.clock_offset + offset
+        error = target - clock.offset
+        if not clock.enabled or abs(error) > self.max_error:
+            clock.set_offset(target)
+        elif abs(error) > deadband:
+            clock.set_offset(clock.offset + min(max(error, -self.max_slew), self.max_slew))
+        start_tick = int(round(message.start_tick * clock.tps / message.tps))
+        bpm = as_number(message.bpm)
+        for looper in self.tempo_loopers:
+            if looper.bpm != bpm:
+                looper.set_bpm(bpm)
+                looper.new_state_loaded = True # update the gui
+        for looper in self.loopers:
+            if clock.track_offsets.get(looper.index) != start_tick:
+                clock.set_track_offset(looper.index, start_tick)
+        self.locked = True
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        self.socket.close()
+        for looper in self.loopers:
+            looper.transport = None